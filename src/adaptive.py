@@ -0,0 +1,131 @@
+from time import perf_counter
+
+import numpy as np
+
+from instrumentation import stats
+from models import FastOpenPose, OpenPoseModel
+
+
+class PersonSizePolicy:
+
+    """Chooses the smallest input size at which the smallest person of the previous frame is still large enough.
+
+    Small or distant people get more pixels, close-ups run at the cheapest size. The size of a person is the longer
+    side of the box around its joints, so people lying down count too; people with fewer than min_joints joints are
+    ignored, their box says little. Without such people in the previous frame, the largest size searches for them.
+    """
+
+    def __init__(self, sizes, min_person_size=96, min_joints=4):
+        """
+        :param sizes: list of int - input sizes to choose from
+        :param min_person_size: int - size in input pixels the smallest person should have
+        :param min_joints: int - joints a person needs to count
+        """
+
+        self.sizes = sorted(sizes)
+        self.min_person_size = min_person_size
+        self.min_joints = min_joints
+        self.person_size = None
+
+    def choose(self, frame_shape):
+        if self.person_size is None:
+            return self.sizes[-1]
+        # person size at input size s is person_size * s / max(frame_shape), as images are resized with padding
+        for size in self.sizes:
+            if self.person_size * size / max(frame_shape[:2]) >= self.min_person_size:
+                return size
+        return self.sizes[-1]
+
+    def update(self, size, keypoints, frame_shape, latency_ms):
+        self.person_size = None
+        if len(keypoints) == 0:
+            return
+        xy = np.asarray(keypoints, dtype=np.float64)[:, :, :2]
+        xy = xy[(~np.isnan(xy).any(axis=-1)).sum(axis=1) >= self.min_joints]
+        if len(xy) == 0:
+            return
+        sizes = (np.nanmax(xy, axis=1) - np.nanmin(xy, axis=1)).max(axis=1)
+        sizes = sizes[sizes > 0]
+        self.person_size = float(sizes.min()) if len(sizes) else None
+
+
+class LatencyBudgetPolicy:
+
+    """Chooses the largest input size whose recent latency fits into a budget per frame.
+
+    Latencies are tracked per size as exponential moving averages; sizes never run are estimated from a measured one
+    by the ratio of their pixel counts.
+    """
+
+    def __init__(self, sizes, budget_ms, smoothing=0.2):
+        """
+        :param sizes: list of int - input sizes to choose from
+        :param budget_ms: float - latency budget of one frame
+        :param smoothing: float - weight of the newest latency in the moving averages
+        """
+
+        self.sizes = sorted(sizes)
+        self.budget_ms = budget_ms
+        self.smoothing = smoothing
+        self.latencies = dict()
+
+    def choose(self, frame_shape):
+        if not self.latencies:
+            return self.sizes[0]
+        fitting = [size for size in self.sizes if self.estimate(size) <= self.budget_ms]
+        return fitting[-1] if fitting else self.sizes[0]
+
+    def estimate(self, size):
+        if size in self.latencies:
+            return self.latencies[size]
+        known = min(self.latencies, key=lambda s: abs(s - size))
+        return self.latencies[known] * (size / known) ** 2
+
+    def update(self, size, keypoints, frame_shape, latency_ms):
+        if size in self.latencies:
+            latency_ms = self.smoothing * latency_ms + (1 - self.smoothing) * self.latencies[size]
+        self.latencies[size] = latency_ms
+
+
+class AdaptiveFastOpenPose:
+
+    """FastOpenPose graphs at several square input sizes sharing one set of weights, one of them chosen per frame.
+
+    All graphs wrap the same OpenPoseModel, so the pool holds the weights once, and all are built up front, so
+    switching the size costs nothing. Use like this:
+        pose = AdaptiveFastOpenPose(weights_path, config_path, sizes=(184, 256, 368))
+        for frame in frames:
+            keypoints = pose.predict(frame)
+    """
+
+    def __init__(self, weights_path, config_path, sizes=(184, 256, 368), policy=None, **kwargs):
+        """
+        :param sizes: list of int - input sizes, height and width, of the graphs
+        :param policy: object with choose(frame_shape) returning a size and update(size, keypoints, frame_shape,
+            latency_ms) called after every frame, PersonSizePolicy(sizes) by default
+        :param kwargs: further arguments of FastOpenPose, e.g. max_peaks
+        """
+
+        openpose_raw = OpenPoseModel().create_model()
+        if weights_path is not None:  # randomly initialized, e.g. for benchmarks
+            openpose_raw.load_weights(weights_path)
+        self.poses = {size: FastOpenPose(weights_path, config_path, (size, size), openpose_raw=openpose_raw, **kwargs)
+                      for size in sizes}
+        self.policy = PersonSizePolicy(sizes) if policy is None else policy
+        self.last_size = None
+
+    def predict(self, img):
+        """Returns the (n_people, 18, 3) key-points of img, see FastOpenPose.predict_batch."""
+
+        size = self.policy.choose(img.shape)
+        t = perf_counter()
+        keypoints = self.poses[size].predict_batch([img])[0]
+        self.policy.update(size, keypoints, img.shape, (perf_counter() - t) * 1000)
+        self.last_size = size
+        stats.count('input_size', size)
+        return keypoints
+
+    def predict_batch(self, imgs):
+        """Frames are run one by one, as the size of every frame depends on the previous one."""
+
+        return [self.predict(img) for img in imgs]
@@ -0,0 +1,369 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import numpy as np
+
+from export import measure_latency
+from models import FastOpenPose, FeatureExtractor, HourglassPose, OpenPose
+
+# default OpenPose parameters, used when no config file is given
+DEFAULT_CONFIG = """[param]
+use_gpu = 0
+GPUdeviceNumber = 0
+modelID = 1
+octave = 3
+starting_range = 0.8
+ending_range = 2
+scale_search = 0.5, 1, 1.5, 2
+thre1 = 0.1
+thre2 = 0.05
+thre3 = 0.5
+min_num = 4
+mid_num = 10
+crop_ratio = 2.5
+bbox_ratio = 0.25
+
+[models]
+[[1]]
+boxsize = 368
+padValue = 128
+stride = 8
+"""
+
+
+class SyntheticScene:
+
+    """Heatmaps and PAFs of n_people synthetic skeletons plus n_noise_peaks distractor peaks.
+
+    The maps look like outputs of FastOpenPoseModel at input resolution, masked_heatmap has the in-graph NMS applied.
+    """
+
+    # COCO joints of a standing person, relative to its bounding box
+    skeleton = np.array([[.50, .10], [.50, .20], [.35, .20], [.30, .35], [.28, .50], [.65, .20], [.70, .35],
+                         [.72, .50], [.42, .52], [.42, .72], [.42, .92], [.58, .52], [.58, .72], [.58, .92],
+                         [.47, .08], [.53, .08], [.44, .10], [.56, .10]])
+
+    def __init__(self, n_people, shape=(184, 184), n_noise_peaks=0, sigma=2., thre1=0.1, seed=0):
+        rng = np.random.RandomState(seed)
+        self.h, self.w = shape
+        self.n_people = n_people
+
+        person_h = self.h / max(2., np.sqrt(n_people) + 1)
+        origins = rng.uniform([0, 0], [self.w - person_h, self.h - person_h], (n_people, 2))
+        self.keypoints = origins[:, np.newaxis] + self.skeleton * person_h
+
+        ys, xs = np.mgrid[:self.h, :self.w]
+        heatmap = np.zeros((self.h, self.w, 19), dtype=np.float32)
+        for part in range(18):
+            centers = self.keypoints[:, part]
+            if n_noise_peaks:
+                centers = np.concatenate([centers, rng.uniform([0, 0], [self.w, self.h], (n_noise_peaks, 2))])
+            for x, y in centers:
+                gaussian = np.exp(-((xs - x) ** 2 + (ys - y) ** 2) / (2 * sigma ** 2))
+                np.maximum(heatmap[:, :, part], gaussian, out=heatmap[:, :, part])
+        heatmap[:, :, 18] = 1 - heatmap[:, :, :18].max(axis=-1)
+        self.heatmap = heatmap
+
+        paf = np.zeros((self.h, self.w, 38), dtype=np.float32)
+        for k, (a, b) in enumerate(OpenPose.limb_seq):
+            channels = [x - 19 for x in OpenPose.map_idx[k]]
+            for person in self.keypoints:
+                start, end = person[a - 1], person[b - 1]
+                vec = end - start
+                norm = np.linalg.norm(vec)
+                if norm == 0:
+                    continue
+                vec = vec / norm
+                dx, dy = xs - start[0], ys - start[1]
+                along = dx * vec[0] + dy * vec[1]
+                across = np.abs(dx * vec[1] - dy * vec[0])
+                on_limb = (along >= 0) & (along <= norm) & (across <= sigma)
+                paf[on_limb, channels[0]] = vec[0]
+                paf[on_limb, channels[1]] = vec[1]
+        self.paf = paf
+
+        padded = np.pad(heatmap, ((1, 1), (1, 1), (0, 0)))
+        peaks = ((heatmap >= padded[:-2, 1:-1]) & (heatmap >= padded[2:, 1:-1]) &
+                 (heatmap >= padded[1:-1, :-2]) & (heatmap >= padded[1:-1, 2:]) & (heatmap >= thre1))
+        self.masked_heatmap = (heatmap * peaks)[np.newaxis]
+
+    def sparse_peaks(self, max_peaks):
+        """Returns the (1, 18, max_peaks, 3) x, y and score of the top peaks, like FastOpenPoseModel with max_peaks."""
+
+        flat = self.masked_heatmap[0, :, :, :18].transpose(2, 0, 1).reshape(18, -1)
+        indices = np.argsort(-flat, axis=1, kind='stable')[:, :max_peaks]
+        scores = np.take_along_axis(flat, indices, axis=1)
+        return np.stack([indices % self.w, indices // self.w, scores], axis=-1).astype(np.float32)[np.newaxis]
+
+
+class Benchmark:
+
+    """Latency and throughput of the model forward and every post-processing stage on synthetic scenes.
+
+    Use like this:
+        results = Benchmark(config_path).run(people=(1, 4, 8))
+        Benchmark.save(results, 'bench.json')
+        Benchmark.compare(results, Benchmark.load('baseline.json'))
+    """
+
+    def __init__(self, config_path=None, weights_path=None, input_shape=(184, 184), repeats=50,
+                 frame_shape=(1080, 1920), n_noise_peaks=0, include_model=True, max_peaks=32):
+        """
+        :param config_path: str - OpenPose config, DEFAULT_CONFIG if None
+        :param weights_path: str - model weights, a randomly initialized model has the same latency
+        :param frame_shape: (height, width) of the frame key-points are mapped and drawn onto
+        :param max_peaks: int - see FastOpenPose, 0 benchmarks the dense masked heatmap
+        """
+
+        self.config_path = config_path
+        self.weights_path = weights_path
+        self.input_shape = input_shape
+        self.repeats = repeats
+        self.frame_shape = frame_shape
+        self.n_noise_peaks = n_noise_peaks
+        self.include_model = include_model
+        self.max_peaks = max_peaks
+        self.pose = None
+
+    def run(self, people=(1, 4, 8)):
+        """Returns {'meta': {...}, 'results': {'people_<n>': {stage: latency statistics}}}."""
+
+        if self.pose is None:
+            self.pose = self._create_pose()
+
+        results = dict()
+        for n_people in people:
+            case = 'people_{}'.format(n_people)
+            results[case] = self.run_case(n_people)
+            for stage, row in results[case].items():
+                print('{:>10} {:>24}: {:9.3f} ms (p95 {:9.3f} ms), {:9.1f} calls/sec'.format(
+                    case, stage, row['p50_ms'], row['p95_ms'], row['calls_per_sec']))
+
+        meta = {'input_shape': list(self.input_shape),
+                'frame_shape': list(self.frame_shape),
+                'repeats': self.repeats,
+                'n_noise_peaks': self.n_noise_peaks,
+                'max_peaks': self.max_peaks,
+                'python': sys.version.split()[0],
+                'numpy': np.__version__,
+                'machine': platform.machine(),
+                'processor': platform.processor()}
+        return {'meta': meta, 'results': results}
+
+    def run_case(self, n_people):
+        pose = self.pose
+        scene = SyntheticScene(n_people, self.input_shape, self.n_noise_peaks,
+                               thre1=pose.openpose_model.thre1, seed=n_people)
+        frame = np.zeros(self.frame_shape + (3,), dtype=np.uint8)
+        fe = FeatureExtractor()
+        max_peaks = pose.openpose_model.max_peaks
+        peaks = scene.masked_heatmap if max_peaks is None else scene.sparse_peaks(max_peaks)
+
+        all_peaks = pose._get_peaks(peaks)
+        connection_all, special_k = pose._get_connections(scene.paf, all_peaks)
+        subset, candidate = pose._get_subset(all_peaks, special_k, connection_all)
+        org_h, org_w = self.frame_shape
+        h, w = self.input_shape
+        transformed_candidate = pose.inverse_transform_kps(org_h, org_w, h, w, candidate)
+        kps = pose._extract_keypoints(subset[0], transformed_candidate) if len(subset) else [None] * 18
+
+        stages = [('peaks', lambda: pose._get_peaks(peaks)),
+                  ('connections', lambda: pose._get_connections(scene.paf, all_peaks)),
+                  ('subset', lambda: pose._get_subset(all_peaks, special_k, connection_all)),
+                  ('inverse_transform_kps', lambda: pose.inverse_transform_kps(org_h, org_w, h, w, candidate)),
+                  ('generate_features', lambda: fe.generate_features(kps)),
+                  ('drawing', lambda: pose.draw_inverse_transformed_parts(frame, all_peaks, subset,
+                                                                          transformed_candidate))]
+        if self.include_model:
+            batch = np.random.uniform(0, 255, (1, h, w, 3)).astype(np.float32)
+            stages.append(('model_forward', lambda: pose.model.predict(batch, verbose=0)))
+
+        print('people_{}: {} people and {} peaks found'.format(n_people, len(subset), len(candidate)))
+        return {name: self.time(func, self.repeats) for name, func in stages}
+
+    def run_frame(self, poses):
+        """Returns the per frame latency of predict_batch of every pipeline in poses on a frame of frame_shape.
+
+        Compares e.g. FastOpenPose with the single person HourglassPose end to end, resizing and decoding included.
+        With random weights FastOpenPose finds hardly any peaks, run measures its post-processing on real loads.
+
+        :param poses: dict - name: pipeline with a predict_batch method
+        """
+
+        frame = np.random.RandomState(0).randint(0, 256, self.frame_shape + (3,)).astype(np.uint8)
+        rows = dict()
+        for name, pose in poses.items():
+            pose.predict_batch([frame])  # builds the predict function
+            rows[name] = self.time(lambda: pose.predict_batch([frame]), self.repeats)
+            print('{:>10} {:>24}: {:9.3f} ms (p95 {:9.3f} ms), {:9.1f} frames/sec'.format(
+                'frame', name, rows[name]['p50_ms'], rows[name]['p95_ms'], rows[name]['calls_per_sec']))
+        return rows
+
+    @staticmethod
+    def parity(n_scenes=30, shape=(184, 184), thre1=0.1, thre2=0.05, mid_num=10, atol=1e-3):
+        """Checks that the float32 post-processing finds the same people as the original float64 one.
+
+        Seeded scenes with 1 to 10 people and 0 to 3 distractor peaks per part run through the legacy peaks,
+        connections and grouping of OpenPose and through the current ones, both on the heatmap of OpenPose and on
+        the masked heatmap of FastOpenPose. Candidates must agree within atol, and so must the connections, except
+        that limbs of equal score may be picked in another order. Both groupings get the current connections, their
+        peak ids and part counts must be equal and their scores agree within atol. Prints and returns the list of
+        mismatches.
+        """
+
+        mismatches = list()
+        n_ties = 0
+        for seed in range(n_scenes):
+            scene = SyntheticScene(1 + seed % 10, shape, n_noise_peaks=seed % 4, thre1=thre1, seed=seed)
+            legacy_peaks = {'openpose': OpenPose._get_peaks_legacy(scene.heatmap.astype(np.float64), thre1),
+                            'fast_openpose': FastOpenPose._get_peaks(scene.masked_heatmap.astype(np.float64))}
+            peaks = {'openpose': OpenPose._get_peaks(scene.heatmap, thre1),
+                     'fast_openpose': FastOpenPose._get_peaks(scene.masked_heatmap)}
+            for pipeline in ('openpose', 'fast_openpose'):
+                case = 'seed {} {}'.format(seed, pipeline)
+                legacy_candidate = np.array([peak for part_peaks in legacy_peaks[pipeline] for peak in part_peaks],
+                                            dtype=np.float64).reshape(-1, 4)
+                legacy_connections, legacy_special_k = OpenPose._get_connections_legacy(
+                    scene.paf.astype(np.float64), legacy_peaks[pipeline], thre2, shape, mid_num)
+                connection_all, special_k = OpenPose._get_connections(scene.paf, peaks[pipeline], thre2, shape[0],
+                                                                      mid_num)
+                candidate = np.concatenate(peaks[pipeline]).reshape(-1, 4)
+                subset, scores = OpenPose._group_people(candidate, special_k, connection_all)
+                legacy_subset = OpenPose._group_people_legacy(candidate.astype(np.float64), special_k, connection_all)
+
+                if candidate.shape != legacy_candidate.shape or not np.allclose(candidate, legacy_candidate,
+                                                                                 atol=atol):
+                    mismatches.append((case, 'candidate'))
+                    continue
+                if special_k != legacy_special_k:
+                    mismatches.append((case, 'limbs without peaks'))
+                    continue
+                for k in range(len(OpenPose.map_idx)):
+                    if k in special_k:
+                        continue
+                    (ids, limb_scores), (legacy_ids, legacy_scores) = connection_all[k], legacy_connections[k]
+                    if ids.shape != legacy_ids.shape:
+                        mismatches.append((case, 'connections of limb {}'.format(k)))
+                    elif np.array_equal(ids, legacy_ids) and np.allclose(limb_scores, legacy_scores, atol=atol):
+                        continue
+                    elif np.allclose(np.sort(limb_scores), np.sort(legacy_scores), atol=atol):
+                        n_ties += 1
+                    else:
+                        mismatches.append((case, 'connections of limb {}'.format(k)))
+                if len(subset) != len(legacy_subset):
+                    mismatches.append((case, '{} people instead of {}'.format(len(subset), len(legacy_subset))))
+                elif not np.array_equal(subset[:, :18], legacy_subset[:, :18]) or \
+                        not np.array_equal(subset[:, 18], legacy_subset[:, 19]):
+                    mismatches.append((case, 'subset ids'))
+                elif not np.allclose(scores, legacy_subset[:, 18], atol=atol):
+                    mismatches.append((case, 'subset scores'))
+        for case, what in mismatches:
+            print('{}: {} differs from legacy post-processing'.format(case, what))
+        print('{} cases, {} mismatches, {} limbs with ties picked in another order'.format(2 * n_scenes,
+                                                                                         len(mismatches), n_ties))
+        return mismatches
+
+    @staticmethod
+    def time(func, repeats):
+        row = measure_latency(lambda _: func(), [None] * repeats)
+        row['calls_per_sec'] = 1000 / row['mean_ms'] if row['mean_ms'] > 0 else float('inf')
+        return row
+
+    @staticmethod
+    def save(results, path):
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def compare(results, baseline, tolerance=0.1):
+        """Prints the p50 ratio of every stage against baseline and returns the list of regressions.
+
+        A stage regressed if it is more than tolerance slower than in baseline.
+        """
+
+        regressions = list()
+        for case, stages in results['results'].items():
+            for stage, row in stages.items():
+                base = baseline['results'].get(case, dict()).get(stage)
+                if base is None or base['p50_ms'] == 0:
+                    continue
+                ratio = row['p50_ms'] / base['p50_ms']
+                if ratio > 1 + tolerance:
+                    label = 'REGRESSION'
+                    regressions.append((case, stage, ratio))
+                elif ratio < 1 - tolerance:
+                    label = 'speedup'
+                else:
+                    label = ''
+                print('{:>10} {:>24}: {:9.3f} -> {:9.3f} ms ({:5.2f}x) {}'.format(
+                    case, stage, base['p50_ms'], row['p50_ms'], 1 / ratio, label))
+        return regressions
+
+    def _create_pose(self):
+        if self.config_path is not None:
+            return FastOpenPose(self.weights_path, self.config_path, self.input_shape, max_peaks=self.max_peaks)
+
+        # the settings are parsed while the pose is built, the file is not needed afterwards
+        fd, config_path = tempfile.mkstemp(suffix='.config')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(DEFAULT_CONFIG)
+            return FastOpenPose(self.weights_path, config_path, self.input_shape, max_peaks=self.max_peaks)
+        finally:
+            os.remove(config_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks OpenPose model forward and post-processing stages.')
+    parser.add_argument('--config', default=None, help='OpenPose config file, built-in defaults if omitted')
+    parser.add_argument('--weights', default=None, help='model weights, random weights if omitted')
+    parser.add_argument('--people', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--noise-peaks', type=int, default=0, help='distractor peaks per part')
+    parser.add_argument('--input-shape', type=int, nargs=2, default=[184, 184])
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--max-peaks', type=int, default=32, help='peaks per part returned by the model, 0 for dense')
+    parser.add_argument('--no-model', action='store_true', help='skip the model forward benchmark')
+    parser.add_argument('--hourglass', type=int, nargs=2, default=None, metavar=('STACKS', 'FILTERS'),
+                        help='also compare per frame latency with a single person HourglassPose of this size')
+    parser.add_argument('--output', default='bench_output.json')
+    parser.add_argument('--baseline', default=None, help='JSON of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--parity', type=int, default=None, metavar='SCENES',
+                        help='only check post-processing against the legacy one on this many seeded scenes')
+    args = parser.parse_args(argv)
+
+    if args.parity is not None:
+        return 1 if Benchmark.parity(args.parity, tuple(args.input_shape)) else 0
+
+    benchmark = Benchmark(args.config, args.weights, tuple(args.input_shape), args.repeats,
+                          n_noise_peaks=args.noise_peaks, include_model=not args.no_model,
+                          max_peaks=args.max_peaks)
+    results = benchmark.run(args.people)
+    if args.hourglass is not None:
+        n_stacks, n_filters = args.hourglass
+        poses = {'fast_openpose': benchmark.pose,
+                 'hourglass_{}x{}'.format(n_stacks, n_filters): HourglassPose(None, n_stacks=n_stacks,
+                                                                             n_filters=n_filters)}
+        results['results']['frame'] = benchmark.run_frame(poses)
+    Benchmark.save(results, args.output)
+    print('Results saved to', args.output)
+
+    if args.baseline is not None:
+        regressions = Benchmark.compare(results, Benchmark.load(args.baseline), args.tolerance)
+        if regressions:
+            print('{} stages regressed.'.format(len(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,199 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+import os
+
+import numpy as np
+
+from instrumentation import stats
+
+
+class ResultCache:
+
+    """Content-addressed LRU cache of inference results, optionally backed by a directory.
+
+    Entries are dicts of numpy arrays keyed by a hash of the image bytes and the inference settings, so a resubmitted
+    image is answered without running the model. Stored arrays are read-only copies, so neither the caller nor a
+    later user of an entry can change it. The memory part holds at most max_bytes of arrays and evicts the
+    least recently used entries; with cache_dir every entry is also written as .npz file, and the directory is
+    trimmed to max_disk_bytes by dropping the least recently used files. The sizes and use order of the files are
+    scanned once when the cache is created and kept up to date in memory, so a write does not list the directory;
+    files other processes write later are only counted once this cache loads them. Use like this:
+        cache = ResultCache(max_bytes=64 * 2 ** 20, cache_dir='pose_cache')
+        pose = FastOpenPose(weights_path, config_path, cache=cache)
+        ...
+        print(cache.metrics())
+    """
+
+    def __init__(self, max_bytes=64 * 2 ** 20, cache_dir=None, max_disk_bytes=1024 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()
+        self.n_bytes = 0
+        self.lock = Lock()
+        self.n_hits = 0
+        self.n_disk_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+        self.disk_files = OrderedDict()  # key: file size, least recently used first
+        self.n_disk_bytes = 0
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._scan()
+
+    @staticmethod
+    def key(array, tag):
+        """Returns the hex digest of the bytes, shape and dtype of array together with repr(tag)."""
+
+        array = np.ascontiguousarray(array)
+        digest = blake2b(digest_size=16)
+        digest.update(array.view(np.uint8).data if array.size else b'')
+        digest.update(repr((array.shape, array.dtype.str, tag)).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def file_signature(path):
+        """Returns the absolute path, size and modification time of path for tags, so changed files change keys."""
+
+        if path is None:
+            return None
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return path, None, None
+        status = os.stat(path)
+        return path, status.st_size, status.st_mtime_ns
+
+    def get(self, key):
+        """Returns the dict of read-only arrays stored under key, or None."""
+
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.n_hits += 1
+                stats.count('cache_hit', 1)
+                return value
+
+        value = self._load(key)
+        with self.lock:
+            if value is None:
+                self.n_misses += 1
+                stats.count('cache_hit', 0)
+                return None
+            self.n_disk_hits += 1
+            stats.count('cache_hit', 1)
+            self._insert(key, value)
+        return value
+
+    def put(self, key, value):
+        """Stores value, a dict of numpy arrays, under key."""
+
+        value = {name: self._read_only(np.array(array)) for name, array in value.items()}
+        with self.lock:
+            self._insert(key, value)
+        if self.cache_dir is not None:
+            self._save(key, value)
+
+    def get_or_compute(self, key, compute):
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def features(self, fe, keypoints):
+        """Returns fe.generate_features(keypoints), an array of joint angles in degrees or None, cached by the
+        key-points."""
+
+        points = np.array([[np.nan, np.nan] if kp is None else kp[:2] for kp in keypoints], dtype=np.float64)
+        key = self.key(points, ('features', fe.points_comb.tobytes()))
+        value = self.get(key)
+        if value is None:
+            features = fe.generate_features(keypoints)
+            self.put(key, {'features': np.array([np.nan if f is None else f for f in features], dtype=np.float64)})
+            return features
+        return np.array([None if np.isnan(f) else f for f in value['features']])
+
+    def metrics(self):
+        with self.lock:
+            n_requests = self.n_hits + self.n_disk_hits + self.n_misses
+            return {'hits': self.n_hits,
+                    'disk_hits': self.n_disk_hits,
+                    'misses': self.n_misses,
+                    'hit_rate': (self.n_hits + self.n_disk_hits) / n_requests if n_requests else 0.,
+                    'entries': len(self.entries),
+                    'bytes': self.n_bytes,
+                    'evictions': self.n_evictions}
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def _insert(self, key, value):
+        if key in self.entries:
+            self.n_bytes -= self._size(self.entries.pop(key))
+        self.entries[key] = value
+        self.n_bytes += self._size(value)
+        while self.n_bytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.n_bytes -= self._size(evicted)
+            self.n_evictions += 1
+
+    @staticmethod
+    def _read_only(array):
+        array.flags.writeable = False
+        return array
+
+    @staticmethod
+    def _size(value):
+        return sum(array.nbytes for array in value.values())
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _load(self, key):
+        if self.cache_dir is None or not os.path.exists(self._path(key)):
+            return None
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                value = {name: self._read_only(data[name]) for name in data.files}
+        except (OSError, ValueError):  # removed by _trim of another process or partially written
+            return None
+        os.utime(path)  # most recently used, for the scan of the next cache on this directory
+        with self.lock:
+            if key not in self.disk_files:  # written by another process
+                self._add_file(key, os.path.getsize(path))
+            self.disk_files.move_to_end(key)
+        return value
+
+    def _save(self, key, value):
+        path = self._path(key)
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, **value)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self._add_file(key, os.path.getsize(path))
+            self._trim()
+
+    def _scan(self):
+        files = [entry for entry in os.scandir(self.cache_dir)
+                 if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz')]
+        for entry in sorted(files, key=lambda e: e.stat().st_mtime):
+            self._add_file(entry.name[:-len('.npz')], entry.stat().st_size)
+        self._trim()
+
+    def _add_file(self, key, size):
+        self.n_disk_bytes += size - self.disk_files.pop(key, 0)
+        self.disk_files[key] = size
+
+    def _trim(self):
+        while self.n_disk_bytes > self.max_disk_bytes and self.disk_files:
+            key, size = self.disk_files.popitem(last=False)
+            self.n_disk_bytes -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:  # removed by another process meanwhile
+                pass
@@ -9,6 +9,7 @@ from scipy.io import loadmat
 
 import numpy as np
 import pandas as pd
+import cv2
 
 import tensorflow as tf
 
@@ -22,6 +23,11 @@ class MPII:
         train_ds, test_ds = mpii.generate_dataset()
     """
 
+    # COCO joints (OpenPose order) for every MPII joint, heatmaps of several COCO joints are averaged. Pelvis, upper
+    # neck and head top have no COCO counterpart and are approximated by hips, neck/nose and eyes/ears.
+    coco_to_mpii = [[10], [9], [8], [11], [12], [13], [8, 11], [1], [0, 1], [14, 15, 16, 17],
+                    [4], [3], [2], [5], [6], [7]]
+
     def __init__(self,
                  path='pose_dataset',
                  test_size=0.1,
@@ -43,10 +49,11 @@ class MPII:
         self.train_ind = None
         self.test_ind = None
 
-    def generate_dataset(self):
+    def generate_dataset(self, input_shape=None):
         """Generates and prepares MPII dataset.
 
-        Returns tf.dataset instances for train and test sets.
+        Returns tf.dataset instances for train and test sets. If input_shape (height, width) is given, images and
+        belief maps are resized with padding to it, so that batches have a fixed shape.
         """
         self._download()
         self._save_joints()
@@ -59,8 +66,8 @@ class MPII:
         test_img = self.image_paths[self.test_ind]
         test_tfrecord = self.tfrecord_paths[self.test_ind]
 
-        train_ds = self.create_dataset(train_img, train_tfrecord)
-        test_ds = self.create_dataset(test_img, test_tfrecord)
+        train_ds = self.create_dataset(train_img, train_tfrecord, input_shape)
+        test_ds = self.create_dataset(test_img, test_tfrecord, input_shape)
         return train_ds, test_ds
 
     def _download(self):
@@ -304,7 +311,7 @@ class MPII:
             writer.write(my_example_str)
         return file_path
 
-    def create_dataset(self, img_paths, tfrecord_paths):
+    def create_dataset(self, img_paths, tfrecord_paths, input_shape=None):
         def load_and_preprocess_image(path):
             image = tf.io.read_file(path)
             return preprocess_image(image)
@@ -334,6 +341,9 @@ class MPII:
         def load_data(img_path, tfr):
             img = load_and_preprocess_image(img_path)
             belief_maps = parse_bm(tfr)
+            if input_shape is not None:
+                img = tf.image.resize_with_pad(img, input_shape[0], input_shape[1])
+                belief_maps = tf.image.resize_with_pad(belief_maps, input_shape[0], input_shape[1])
             return img, belief_maps
 
         img_ds = tf.data.Dataset.from_tensor_slices(img_paths)
@@ -0,0 +1,176 @@
+from hashlib import blake2b
+import os
+
+import numpy as np
+
+import tensorflow as tf
+from tensorflow import keras as tfk
+import cv2
+
+from data_handler import MPII
+from export import measure_latency
+from models import CPM, OpenPoseModel
+
+
+class TeacherCache:
+
+    """Runs the OpenPose teacher once over a set of images and caches its heatmaps on disk.
+
+    Heatmaps are stored at the network's stride (8) either as dense float16 arrays or as sparse float16 values above
+    sparse_threshold, both compressed. Cache files are named by a hash of the image's absolute path, the input shape,
+    the storage mode and the teacher weights, so same-named images of different directories and caches of other
+    settings never mix. Images that are already cached are skipped, so an interrupted run resumes.
+    Use like this:
+        cache = TeacherCache(weights_path, 'teacher_cache')
+        cache_paths = cache.build(image_paths)
+    """
+
+    storage_modes = ('float16', 'sparse')
+
+    def __init__(self, weights_path, cache_dir, input_shape=(368, 368), storage='float16', sparse_threshold=0.01):
+        if storage not in self.storage_modes:
+            raise ValueError('storage must be one of {}, got {}'.format(self.storage_modes, storage))
+        self.weights_path = weights_path
+        self.cache_dir = cache_dir
+        self.input_h, self.input_w = input_shape
+        self.storage = storage
+        self.sparse_threshold = sparse_threshold
+        self.teacher = None
+
+    def build(self, image_paths, batch_size=8):
+        """Caches teacher heatmaps for image_paths and returns the cache path of every image."""
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        cache_paths = [self.cache_path(p) for p in image_paths]
+        todo = [(i, c) for i, c in zip(image_paths, cache_paths) if not os.path.exists(c)]
+        print('{} of {} images already cached.'.format(len(image_paths) - len(todo), len(image_paths)))
+
+        if todo and self.teacher is None:
+            self.teacher = OpenPoseModel().create_model()
+            self.teacher.load_weights(self.weights_path)
+
+        for start in range(0, len(todo), batch_size):
+            batch = todo[start: start + batch_size]
+            images = np.stack([self.load_image(img_path, self.input_h, self.input_w) * 255 for img_path, _ in batch])
+            _, heatmaps = self.teacher.predict(images)
+            for (_, cache_path), heatmap in zip(batch, heatmaps):
+                self._save(cache_path, heatmap[:, :, :18])
+        return cache_paths
+
+    def cache_path(self, img_path):
+        file_name = os.path.splitext(os.path.basename(img_path))[0]
+        key = (os.path.abspath(img_path), self.input_h, self.input_w, self.storage, self.sparse_threshold,
+               self._weights_signature())
+        digest = blake2b(repr(key).encode(), digest_size=8).hexdigest()
+        return os.path.join(self.cache_dir, '{}-{}.npz'.format(file_name, digest))
+
+    def _weights_signature(self):
+        """Path, size and modification time of the teacher weights, retrained weights invalidate the cache."""
+
+        path = os.path.abspath(self.weights_path)
+        if not os.path.exists(path):
+            return path, None, None
+        status = os.stat(path)
+        return path, status.st_size, status.st_mtime_ns
+
+    def _save(self, cache_path, heatmap):
+        if self.storage == 'float16':
+            np.savez_compressed(cache_path, heatmap=heatmap.astype(np.float16))
+        else:
+            flat = heatmap.ravel()
+            indices = np.flatnonzero(flat > self.sparse_threshold).astype(np.uint32)
+            np.savez_compressed(cache_path,
+                                indices=indices,
+                                values=flat[indices].astype(np.float16),
+                                shape=np.array(heatmap.shape))
+
+    @staticmethod
+    def load(cache_path):
+        """Returns the cached heatmap as a dense float32 array of shape (h / 8, w / 8, 18)."""
+
+        with np.load(cache_path) as data:
+            if 'heatmap' in data:
+                return data['heatmap'].astype(np.float32)
+            heatmap = np.zeros(np.prod(data['shape']), dtype=np.float32)
+            heatmap[data['indices']] = data['values']
+            return heatmap.reshape(data['shape'])
+
+    @staticmethod
+    def load_image(img_path, h, w):
+        """Reads a BGR image like OpenPose does and returns it resized with padding and normalized to [0, 1]."""
+
+        img = cv2.imread(img_path)
+        return tf.image.resize_with_pad(img.astype(np.float32) / 255, h, w).numpy()
+
+
+class DistillationTrainer:
+
+    """Trains a CPM student against heatmaps of the OpenPose teacher cached by TeacherCache.
+
+    Use like this:
+        cache = TeacherCache(weights_path, 'teacher_cache')
+        trainer = DistillationTrainer(joint_map=MPII.coco_to_mpii)
+        student = trainer.fit(image_paths, cache.build(image_paths), epochs=10)
+    """
+
+    def __init__(self,
+                 input_shape=(368, 368),
+                 joint_map=MPII.coco_to_mpii,
+                 batch_size=16,
+                 learning_rate=1e-3,
+                 dropout_rate=0.1):
+        """
+        :param joint_map: list - for every student joint, the list of COCO joints whose teacher heatmaps are averaged
+            into its target, None keeps the 18 COCO joints. The student's n_parts is len(joint_map).
+        """
+
+        self.input_h, self.input_w = input_shape
+        self.joint_map = joint_map if joint_map is not None else [[i] for i in range(18)]
+        self.n_parts = len(self.joint_map)
+        self.batch_size = batch_size
+        self.student_def = CPM(input_shape=(self.input_h, self.input_w, 3),
+                               dropout_rate=dropout_rate,
+                               n_parts=self.n_parts)
+        self.student = self.student_def.create_model()
+        self.student.compile(optimizer=tfk.optimizers.Adam(learning_rate), loss='mse')
+
+    def remap(self, heatmap):
+        """Maps an (h, w, 18) COCO heatmap to the student joints, (h, w, n_parts)."""
+
+        return np.stack([heatmap[:, :, joints].mean(axis=-1) for joints in self.joint_map], axis=-1)
+
+    def create_dataset(self, image_paths, cache_paths):
+        def gen():
+            order = np.random.permutation(len(image_paths))
+            for i in order:
+                img = TeacherCache.load_image(image_paths[i], self.input_h, self.input_w)
+                target = self.remap(TeacherCache.load(cache_paths[i]))
+                yield img, target
+
+        stride_h, stride_w = self.student.output_shape[1:3]
+        ds = tf.data.Dataset.from_generator(gen,
+                                            output_types=(tf.float32, tf.float32),
+                                            output_shapes=((self.input_h, self.input_w, 3),
+                                                           (stride_h, stride_w, self.n_parts)))
+        return ds.repeat().batch(self.batch_size).prefetch(tf.data.experimental.AUTOTUNE)
+
+    def fit(self, image_paths, cache_paths, epochs=10):
+        ds = self.create_dataset(image_paths, cache_paths)
+        steps_per_epoch = max(1, len(image_paths) // self.batch_size)
+        self.student.fit(ds, steps_per_epoch=steps_per_epoch, epochs=epochs)
+        return self.student
+
+    def cost_report(self, n_runs=10):
+        """Prints parameters and CPU latency of teacher and student at the training input shape."""
+
+        teacher = OpenPoseModel().create_model()
+        inputs = [np.random.uniform(0, 1, (1, self.input_h, self.input_w, 3)).astype(np.float32)
+                  for _ in range(n_runs)]
+        report = list()
+        for name, model, scale in [('teacher', teacher, 255), ('student', self.student, 1)]:
+            row = dict(model=name,
+                       params=model.count_params(),
+                       **measure_latency(lambda x: model(x * scale, training=False), inputs))
+            report.append(row)
+            print('{model:>8}: {params:>10} params, {mean_ms:8.1f} ms (p95 {p95_ms:8.1f} ms)'.format(**row))
+        return report
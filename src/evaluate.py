@@ -0,0 +1,224 @@
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+import json
+import os
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+import cv2
+
+from data_handler import MPII
+
+
+class Evaluator:
+
+    """PCKh and OKS based AP of a multi-person pose model on MPII annotations.
+
+    The predictor needs a predict_batch(images) method returning, per image, an array of shape (n_people, 18, 3)
+    with x, y and score of the COCO joints, NaN for missing ones, e.g. FastOpenPose. Image loading, inference and
+    scoring of consecutive batches run concurrently. Use like this:
+        mpii = MPII()
+        mpii.generate_dataset()
+        evaluator = Evaluator(FastOpenPose(weights_path, config_path), mpii)
+        results = evaluator.evaluate()
+    """
+
+    # per joint OKS falloff, COCO values of the corresponding joints
+    mpii_sigmas = np.array([.089, .087, .107, .107, .087, .089, .107, .079,
+                            .079, .035, .062, .072, .079, .079, .072, .062])
+    mpii_joint_names = ['r_ankle', 'r_knee', 'r_hip', 'l_hip', 'l_knee', 'l_ankle', 'pelvis', 'thorax',
+                        'upper_neck', 'head_top', 'r_wrist', 'r_elbow', 'r_shoulder', 'l_shoulder', 'l_elbow',
+                        'l_wrist']
+
+    def __init__(self,
+                 predictor,
+                 mpii,
+                 batch_size=16,
+                 joint_map=MPII.coco_to_mpii,
+                 pckh_threshold=0.5,
+                 oks_thresholds=np.arange(0.5, 0.96, 0.05)):
+        """
+        :param mpii: MPII - dataset handler, if its train/test split exists only test images are evaluated
+        :param joint_map: list - COCO joints averaged into every MPII joint
+        """
+
+        self.predictor = predictor
+        self.mpii = mpii
+        self.batch_size = batch_size
+        self.joint_map = joint_map
+        self.pckh_threshold = pckh_threshold
+        self.oks_thresholds = oks_thresholds
+        self.ground_truth = self._load_ground_truth()
+
+    def evaluate(self, max_images=None):
+        """Returns a dict with per joint and mean PCKh, per joint OKS AP and person level OKS AP."""
+
+        filenames = sorted(self.ground_truth)[:max_images]
+        if not filenames:
+            raise ValueError('No images to evaluate, the ground truth is empty or max_images is 0.')
+        batches = [filenames[i: i + self.batch_size] for i in range(0, len(filenames), self.batch_size)]
+        matches = list()
+
+        t = time()
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            next_images = pool.submit(self._load_images, batches[0])
+            scoring = None
+            for i, batch in enumerate(batches):
+                images = next_images.result()
+                if i + 1 < len(batches):
+                    next_images = pool.submit(self._load_images, batches[i + 1])
+                predictions = self.predictor.predict_batch(images)
+                if scoring is not None:
+                    matches.append(scoring.result())
+                scoring = pool.submit(self._score_batch, batch, predictions)
+            matches.append(scoring.result())
+        print('Evaluated {} images in {:.1f} s'.format(len(filenames), time() - t))
+
+        return self._summarize(matches)
+
+    @staticmethod
+    def gate(results, baseline, max_drop=0.01):
+        """Returns False if mean PCKh or OKS AP of results dropped by more than max_drop relative to baseline."""
+
+        passed = True
+        for key in ('pckh_mean', 'oks_ap'):
+            drop = baseline[key] - results[key]
+            if drop > max_drop:
+                print('Accuracy gate failed: {} dropped from {:.4f} to {:.4f}'.format(key, baseline[key], results[key]))
+                passed = False
+        return passed
+
+    def _load_ground_truth(self):
+        """Maps image file names to joints (n_people, 16, 2), annotated (n_people, 16) and head sizes (n_people,).
+
+        Joints marked with negative coordinates have no annotation. Occluded joints are annotated and count, as in
+        the MPII benchmark, so is_visible is not used. People without head_rect are skipped, PCKh has no scale for
+        them.
+        """
+
+        filenames = None
+        if self.mpii.test_ind is not None:
+            filenames = set(os.path.basename(self.mpii.image_paths[i]) for i in self.mpii.test_ind)
+
+        people = dict()
+        with open(self.mpii.joints_path) as f:
+            for line in f:
+                record = json.loads(line)
+                if filenames is not None and record['filename'] not in filenames:
+                    continue
+                if record['head_rect'] is None:
+                    continue
+                joints = np.array([record['joint_pos'][str(j)] for j in range(self.mpii.n_parts)], dtype=np.float64)
+                annotated = (joints >= 0).all(axis=1)
+                x1, y1, x2, y2 = record['head_rect']
+                head_size = 0.6 * np.linalg.norm([x2 - x1, y2 - y1])
+                people.setdefault(record['filename'], list()).append((joints, annotated, head_size))
+
+        return {filename: (np.stack([p[0] for p in persons]),
+                           np.stack([p[1] for p in persons]),
+                           np.array([p[2] for p in persons]))
+                for filename, persons in people.items()}
+
+    def _load_images(self, filenames):
+        return [cv2.imread(os.path.join(self.mpii.images_path, filename)) for filename in filenames]
+
+    def _to_mpii(self, coco_keypoints):
+        """Maps (n_people, 18, 3) COCO key-points to (n_people, 16, 3) MPII joints.
+
+        An MPII joint averages its sources that were found and is missing only if all of them are, e.g. head_top is
+        estimated from the one visible eye and ear of a profile view.
+        """
+
+        mpii_keypoints = np.full((coco_keypoints.shape[0], len(self.joint_map), 3), np.nan)
+        for i, joints in enumerate(self.joint_map):
+            sources = coco_keypoints[:, joints]
+            found = ~np.isnan(sources).any(axis=-1, keepdims=True)
+            n_found = found.sum(axis=1)
+            total = np.where(found, sources, 0).sum(axis=1)
+            mpii_keypoints[:, i] = np.where(n_found > 0, total / np.maximum(n_found, 1), np.nan)
+        return mpii_keypoints
+
+    def _score_batch(self, filenames, predictions):
+        return [self._match_image(self.ground_truth[f], self._to_mpii(p)) for f, p in zip(filenames, predictions)]
+
+    def _match_image(self, ground_truth, predicted):
+        """Matches predicted people to ground truth with the Hungarian algorithm on the number of PCKh hits."""
+
+        gt_joints, gt_annotated, head_sizes = ground_truth
+        n_gt, n_joints = gt_joints.shape[:2]
+        n_pred = predicted.shape[0]
+
+        # (n_pred, n_gt, n_joints) distances, NaN where the predicted joint is missing
+        distances = np.linalg.norm(predicted[:, np.newaxis, :, :2] - gt_joints[np.newaxis], axis=-1)
+        normalized = distances / head_sizes[np.newaxis, :, np.newaxis]
+        with np.errstate(invalid='ignore'):
+            hits = (normalized <= self.pckh_threshold) & gt_annotated[np.newaxis]
+        cost = -hits.sum(axis=-1) + 1e-3 * np.nan_to_num(normalized, nan=1.).mean(axis=-1)
+        pred_ind, gt_ind = linear_sum_assignment(cost) if n_pred and n_gt else (np.array([], int), np.array([], int))
+
+        pckh_hits = np.zeros((n_gt, n_joints), dtype=bool)
+        pckh_hits[gt_ind] = hits[pred_ind, gt_ind]
+
+        # OKS with the squared extent of the ground truth joints as object area
+        annotated_joints = np.where(gt_annotated[:, :, np.newaxis], gt_joints, np.nan)
+        extent = np.nan_to_num(np.nanmax(annotated_joints, axis=1) - np.nanmin(annotated_joints, axis=1))
+        areas = np.maximum(extent[:, 0] * extent[:, 1], 1.)
+        variances = (2 * self.mpii_sigmas) ** 2
+        similarity = np.exp(-distances ** 2 / (2 * areas[np.newaxis, :, np.newaxis] * variances))
+
+        joint_similarity = np.zeros((n_pred, n_joints))
+        person_oks = np.zeros(n_pred)
+        joint_similarity[pred_ind] = np.nan_to_num(similarity[pred_ind, gt_ind], nan=0.) * gt_annotated[gt_ind]
+        n_annotated = np.maximum(gt_annotated[gt_ind].sum(axis=-1), 1)
+        person_oks[pred_ind] = joint_similarity[pred_ind].sum(axis=-1) / n_annotated
+
+        joint_scores = predicted[:, :, 2]
+        person_scores = np.nan_to_num(joint_scores, nan=0.).sum(axis=-1)
+        return pckh_hits, joint_similarity, joint_scores, person_oks, person_scores, gt_annotated
+
+    def _summarize(self, matches):
+        matches = [m for batch in matches for m in batch]
+        pckh_hits = np.concatenate([m[0] for m in matches])
+        joint_similarity = np.concatenate([m[1] for m in matches])
+        joint_scores = np.concatenate([m[2] for m in matches])
+        person_oks = np.concatenate([m[3] for m in matches])
+        person_scores = np.concatenate([m[4] for m in matches])
+        annotated = np.concatenate([m[5] for m in matches])
+        n_gt = pckh_hits.shape[0]
+
+        pckh = pckh_hits.sum(axis=0) / np.maximum(annotated.sum(axis=0), 1)
+        joint_ap = np.zeros(pckh_hits.shape[1])
+        for j in range(pckh_hits.shape[1]):
+            detected = ~np.isnan(joint_scores[:, j])
+            joint_ap[j] = np.mean([self._average_precision(joint_scores[detected, j],
+                                                           joint_similarity[detected, j] >= t,
+                                                           annotated[:, j].sum())
+                                   for t in self.oks_thresholds])
+        oks_ap = np.mean([self._average_precision(person_scores, person_oks >= t, n_gt) for t in self.oks_thresholds])
+
+        results = {'pckh': dict(zip(self.mpii_joint_names, pckh.tolist())),
+                   'pckh_mean': float(pckh.mean()),
+                   'joint_oks_ap': dict(zip(self.mpii_joint_names, joint_ap.tolist())),
+                   'oks_ap': float(oks_ap)}
+        print('PCKh@{}: {:.4f}, OKS AP: {:.4f}'.format(self.pckh_threshold, results['pckh_mean'], results['oks_ap']))
+        return results
+
+    @staticmethod
+    def _average_precision(scores, is_tp, n_positives):
+        """COCO style 101 point interpolated average precision."""
+
+        if n_positives == 0 or len(scores) == 0:
+            return 0.
+        order = np.argsort(-scores, kind='mergesort')
+        tp = np.cumsum(is_tp[order])
+        fp = np.cumsum(~is_tp[order])
+        recall = tp / n_positives
+        precision = tp / (tp + fp)
+        precision = np.maximum.accumulate(precision[::-1])[::-1]
+
+        recall_levels = np.linspace(0, 1, 101)
+        indices = np.searchsorted(recall, recall_levels, side='left')
+        interpolated = np.zeros(len(recall_levels))
+        valid = indices < len(precision)
+        interpolated[valid] = precision[indices[valid]]
+        return float(interpolated.mean())
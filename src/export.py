@@ -0,0 +1,162 @@
+from time import time
+
+import numpy as np
+
+import tensorflow as tf
+
+from models import FastOpenPose
+
+
+class TFLiteExporter:
+
+    """Post-training quantization and TFLite export of OpenPose graphs.
+
+    Works with the graph of FastOpenPoseModel as well as with OpenPoseModelV2. Use like this:
+        model = FastOpenPoseModel(weights_path, config_path, (184, 184), True).load_model()
+        exporter = TFLiteExporter(model)
+        train_ds, test_ds = MPII().generate_dataset(input_shape=(184, 184))
+        exporter.export('openpose_int8.tflite', 'int8', exporter.representative_dataset(train_ds))
+    """
+
+    quantization_modes = ('none', 'dynamic', 'float16', 'int8')
+
+    def __init__(self, model, input_shape=None, output_keys=('paf', 'heatmap')):
+        """
+        :param model: tf.keras.Model with two outputs, PAFs and heatmaps or peaks
+        :param input_shape: (height, width), defaults to the model's input shape
+        :param output_keys: signature names of the model outputs, in the order of the Keras outputs
+        """
+
+        self.model = model
+        self.output_keys = output_keys
+        if input_shape is None:
+            self.input_h, self.input_w = model.input_shape[1:3]
+        else:
+            self.input_h, self.input_w = input_shape
+
+    def export(self, output_path, mode='dynamic', representative_dataset=None):
+        """Converts the model and writes the flatbuffer to output_path.
+
+        :param mode: 'none' (float32), 'dynamic' (int8 weights), 'float16' (float16 weights) or
+            'int8' (int8 weights and activations, requires representative_dataset)
+        :param representative_dataset: generator function yielding [input_batch], see representative_dataset
+        """
+
+        if mode not in self.quantization_modes:
+            raise ValueError('mode must be one of {}, got {}'.format(self.quantization_modes, mode))
+        if mode == 'int8' and representative_dataset is None:
+            raise ValueError('int8 quantization needs a representative dataset for calibration.')
+
+        converter = tf.lite.TFLiteConverter.from_concrete_functions([self._get_concrete_function()], self.model)
+
+        # bicubic resizing has no TFLite builtin kernel, so fall back to select TF ops for it
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+        if mode != 'none':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if mode == 'float16':
+            converter.target_spec.supported_types = [tf.float16]
+        elif mode == 'int8':
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8,
+                                                   tf.lite.OpsSet.TFLITE_BUILTINS,
+                                                   tf.lite.OpsSet.SELECT_TF_OPS]
+
+        t = time()
+        tflite_model = converter.convert()
+        with open(output_path, 'wb') as f:
+            f.write(tflite_model)
+        print('Exported {} model ({:.1f} MB) to {} in {:.1f} s'.format(mode,
+                                                                      len(tflite_model) / 2 ** 20,
+                                                                      output_path,
+                                                                      time() - t))
+        return output_path
+
+    def representative_dataset(self, dataset, n_samples=100):
+        """Returns a calibration generator drawing n_samples images from a dataset made by MPII.create_dataset.
+
+        MPII images are RGB in [0, 1], while FastOpenPose feeds the graphs cv2 frames, BGR in (0, 255); images are
+        calibrated in the channel order and range of inference.
+        """
+
+        def gen():
+            for img, _ in dataset.unbatch().take(n_samples):
+                img = tf.image.resize_with_pad(img[:, :, ::-1], self.input_h, self.input_w) * 255
+                yield [tf.expand_dims(img, axis=0)]
+
+        return gen
+
+    def _get_concrete_function(self):
+        model = self.model
+        output_keys = self.output_keys
+
+        @tf.function(input_signature=[tf.TensorSpec([None, self.input_h, self.input_w, 3], tf.float32)])
+        def serve(x):
+            outputs = model(x)
+            return {k: v for k, v in zip(output_keys, outputs)}
+
+        return serve.get_concrete_function()
+
+
+def measure_latency(func, inputs, warmup=2):
+    """Calls func on every input and returns latency statistics in milliseconds."""
+
+    for x in inputs[:warmup]:
+        func(x)
+
+    times = list()
+    for x in inputs:
+        t = time()
+        func(x)
+        times.append((time() - t) * 1000)
+    times = np.array(times)
+    return {'mean_ms': float(times.mean()),
+            'p50_ms': float(np.percentile(times, 50)),
+            'p95_ms': float(np.percentile(times, 95))}
+
+
+def report_tradeoff(weights_path, config_path, tflite_paths, images, input_shape=(184, 184), num_threads=None):
+    """Compares accuracy and latency of exported TFLite graphs against the Keras FastOpenPose model.
+
+    :param tflite_paths: dict - name -> path of an exported graph, e.g. {'int8': 'openpose_int8.tflite'}
+    :param images: list of BGR images
+    :return: list of dicts, one per backend, with latency statistics, mean absolute PAF error and mean
+        key-point displacement (pixels at input resolution) relative to the Keras model
+    """
+
+    backends = {'keras': FastOpenPose(weights_path, config_path, input_shape)}
+    for name, path in tflite_paths.items():
+        backends[name] = FastOpenPose(weights_path, config_path, input_shape, tflite_path=path, num_threads=num_threads)
+
+    inputs = [tf.image.resize_with_pad(img, input_shape[0], input_shape[1]).numpy()[np.newaxis] for img in images]
+
+    reference = [backends['keras'].model.predict(x) for x in inputs]
+    reference_kps = [_first_person_kps(backends['keras'], x[0]) for x in inputs]
+
+    report = list()
+    for name, backend in backends.items():
+        latency = measure_latency(backend.model.predict, inputs)
+        outputs = [backend.model.predict(x) for x in inputs]
+        paf_error = np.mean([np.abs(o[0] - r[0]).mean() for o, r in zip(outputs, reference)])
+
+        displacements = list()
+        for x, ref_kps in zip(inputs, reference_kps):
+            kps = _first_person_kps(backend, x[0])
+            if kps is None or ref_kps is None:
+                continue
+            for kp, ref_kp in zip(kps, ref_kps):
+                if kp is not None and ref_kp is not None:
+                    displacements.append(np.linalg.norm(np.subtract(kp, ref_kp)))
+        kp_error = float(np.mean(displacements)) if displacements else float('nan')
+
+        row = dict(backend=name, paf_mae=float(paf_error), kp_displacement_px=kp_error, **latency)
+        report.append(row)
+        print('{backend:>10}: {mean_ms:8.1f} ms (p95 {p95_ms:8.1f} ms), '
+              'PAF MAE {paf_mae:.5f}, kp displacement {kp_displacement_px:.2f} px'.format(**row))
+    return report
+
+
+def _first_person_kps(fast_openpose, img):
+    peaks, subset, candidate = fast_openpose._inference(img)
+    if not subset.any():
+        return None
+    return fast_openpose._extract_keypoints(subset[0], candidate)
@@ -0,0 +1,350 @@
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+from queue import Empty
+from time import time
+import argparse
+import multiprocessing
+import os
+import sys
+import traceback
+
+import cv2
+
+
+class Extractor:
+
+    """Extracts the key-points of large collections of images and videos on the CPUs of one machine.
+
+    Inputs are scanned recursively and split round robin into n_workers shards, each processed by its own process
+    with threads_per_worker TensorFlow threads, so all cores are busy without oversubscription. A worker decodes the
+    next batch of frames while FastOpenPose runs the current one, and appends the key-points to its pose log
+    output_dir/shard-NNN.poselog (see pose_log.PoseLogWriter). Once the records of an input are written, the input
+    is listed in shard-NNN.done with its first record and number of frames; inputs listed there are skipped on the
+    next run, so an interrupted extraction resumes where it stopped. Records of an input that was not finished are
+    dropped when the worker of its shard reopens the log, the input is extracted again from its first frame. Inputs
+    that cannot be read are listed in shard-NNN.failed and skipped as well, unless run is asked to retry them. Use
+    like this:
+        extractor = Extractor(weights_path, config_path, 'poses', n_workers=8, threads_per_worker=4)
+        extractor.run(['images', 'videos'])
+    or from the command line:
+        python extract.py images videos --output poses --weights weights.h5 --config config --workers 8
+    """
+
+    image_extensions = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+    video_extensions = ('.mp4', '.avi', '.mov', '.mkv', '.webm', '.mpg', '.mpeg')
+
+    def __init__(self,
+                 weights_path,
+                 config_path,
+                 output_dir,
+                 n_workers=None,
+                 threads_per_worker=2,
+                 batch_size=None,
+                 input_shape=(184, 184),
+                 frame_step=1,
+                 max_peaks=None,
+                 tflite_path=None,
+                 dtype='float16',
+                 log_every=10.):
+        """
+        :param weights_path: str - model weights, required unless tflite_path is given
+        :param n_workers: int - worker processes, None fills the cores with threads_per_worker threads each
+        :param threads_per_worker: int - TensorFlow, or TFLite, threads of every worker
+        :param batch_size: int - frames per model call, None takes batch_size of the config
+        :param frame_step: int - only every frame_step-th frame of a video is extracted
+        :param dtype: str - storage type of the key-points, one of pose_log.DTYPES
+        :param log_every: float - seconds between progress reports
+        """
+
+        if n_workers is None:
+            n_workers = max(1, (os.cpu_count() or 1) // threads_per_worker)
+        if weights_path is None and tflite_path is None:
+            raise ValueError('weights_path or tflite_path is required, random weights extract nothing useful.')
+        if frame_step < 1:
+            raise ValueError('frame_step must be at least 1, got {}'.format(frame_step))
+        self.weights_path = weights_path
+        self.config_path = config_path
+        self.output_dir = output_dir
+        self.n_workers = n_workers
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = batch_size
+        self.input_shape = tuple(input_shape)
+        self.frame_step = frame_step
+        self.max_peaks = max_peaks
+        self.tflite_path = tflite_path
+        self.dtype = dtype
+        self.log_every = log_every
+
+    @classmethod
+    def scan(cls, inputs):
+        """Returns the sorted absolute paths of the images and videos in inputs, searching directories recursively."""
+
+        extensions = cls.image_extensions + cls.video_extensions
+        paths = set()
+        for path in inputs:
+            if os.path.isdir(path):
+                for root, _, filenames in os.walk(path):
+                    paths.update(os.path.abspath(os.path.join(root, filename)) for filename in filenames
+                                 if filename.lower().endswith(extensions))
+            elif os.path.isfile(path):
+                paths.add(os.path.abspath(path))
+            else:
+                print('Skipping {}, no such file or directory.'.format(path))
+        return sorted(paths)
+
+    def done(self):
+        """Maps the inputs extracted by earlier runs to their shard, first record and number of frames."""
+
+        done = dict()
+        for done_path in sorted(glob(os.path.join(self.output_dir, 'shard-*.done'))):
+            shard = int(os.path.basename(done_path)[len('shard-'):-len('.done')])
+            for path, first, n_frames in _read_done(done_path):
+                done[path] = (shard, first, n_frames)
+        return done
+
+    def failed(self):
+        """Returns the set of inputs earlier runs could not read."""
+
+        failed = set()
+        for failed_path in glob(os.path.join(self.output_dir, 'shard-*.failed')):
+            with open(failed_path) as f:
+                failed.update(line.rstrip('\n') for line in f)
+        return failed
+
+    def run(self, inputs, retry_failed=False):
+        """Extracts all inputs not done yet and returns the number of frames extracted.
+
+        :param retry_failed: bool - also extract the inputs earlier runs could not read, e.g. after they were fixed
+        """
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        paths = self.scan(inputs)
+        done = self.done()
+        failed = set() if retry_failed else self.failed()
+        todo = [path for path in paths if path not in done and path not in failed]
+        n_done = sum(path in done for path in paths)
+        print('{} inputs, {} done, {} unreadable, {} to extract with {} workers.'.format(
+            len(paths), n_done, len(paths) - n_done - len(todo), len(todo), self.n_workers))
+        if not todo:
+            return 0
+
+        context = multiprocessing.get_context('spawn')  # TensorFlow does not survive fork
+        progress = context.Queue()
+        workers = list()
+        for shard in range(min(self.n_workers, len(todo))):
+            worker = context.Process(target=_extract_shard,
+                                     args=(shard, todo[shard::self.n_workers], self._worker_params(), progress),
+                                     daemon=True)
+            worker.start()
+            workers.append(worker)
+        return self._report(progress, workers, len(todo))
+
+    def _worker_params(self):
+        return {'weights_path': self.weights_path,
+                'config_path': self.config_path,
+                'output_dir': self.output_dir,
+                'threads': self.threads_per_worker,
+                'batch_size': self.batch_size,
+                'input_shape': self.input_shape,
+                'frame_step': self.frame_step,
+                'max_peaks': self.max_peaks,
+                'tflite_path': self.tflite_path,
+                'dtype': self.dtype}
+
+    def _report(self, progress, workers, n_inputs):
+        """Collects worker progress and prints images per second and the remaining time until all workers ended."""
+
+        start = last_log = time()
+        n_frames = n_done = n_failed = 0
+        running = len(workers)
+        ended = set()
+        while running:
+            try:
+                message = progress.get(timeout=1.)
+            except Empty:
+                # a worker killed e.g. by the OOM killer sends nothing
+                message = ('none', )
+                for shard, worker in enumerate(workers):
+                    if shard not in ended and not worker.is_alive() and progress.empty():
+                        message = ('error', shard, 'exit code {}'.format(worker.exitcode))
+                        break
+            kind = message[0]
+            if kind in ('error', 'end'):
+                ended.add(message[1])
+            if kind == 'batch':
+                n_frames += message[1]
+                n_done += message[2]
+            elif kind == 'failed':
+                n_failed += 1
+                n_done += 1
+                print('Could not read {}.'.format(message[1]))
+            elif kind == 'error':
+                running -= 1
+                print('Worker {} failed:\n{}'.format(message[1], message[2]))
+            elif kind == 'end':
+                running -= 1
+
+            now = time()
+            if now - last_log >= self.log_every or not running:
+                last_log = now
+                elapsed = now - start
+                eta = elapsed / n_done * (n_inputs - n_done) if n_done else float('nan')
+                print('{}/{} inputs, {} frames, {:.1f} images/sec, ETA {}'.format(
+                    n_done, n_inputs, n_frames, n_frames / max(elapsed, 1e-9), self._format_time(eta)))
+        if n_failed:
+            print('{} inputs could not be read.'.format(n_failed))
+        return n_frames
+
+    @staticmethod
+    def _format_time(seconds):
+        if seconds != seconds:  # NaN
+            return '?'
+        minutes, seconds = divmod(int(seconds), 60)
+        hours, minutes = divmod(minutes, 60)
+        return '{}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def _extract_shard(shard, paths, params, progress):
+    """Worker process of Extractor: extracts paths into shard's pose log and checkpoints them as done."""
+
+    try:
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(params['threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(1)
+        cv2.setNumThreads(1)
+
+        from models import FastOpenPose
+        from pose_log import PoseLogWriter
+
+        pose = FastOpenPose(params['weights_path'],
+                            params['config_path'],
+                            params['input_shape'],
+                            tflite_path=params['tflite_path'],
+                            num_threads=params['threads'],
+                            max_peaks=params['max_peaks'])
+        batch_size = params['batch_size'] or pose.settings.batch_size
+        output = os.path.join(params['output_dir'], 'shard-{:03d}'.format(shard))
+        # records after the last checkpoint belong to an input that was not finished, it is extracted again
+        n_checkpointed = 0
+        if os.path.exists(output + '.done'):
+            n_checkpointed = max((first + n_frames for _, first, n_frames in _read_done(output + '.done')), default=0)
+        with PoseLogWriter(output + '.poselog', dtype=params['dtype'], append=True, n_records=n_checkpointed) as log, \
+                open(output + '.done', 'a') as done, \
+                open(output + '.failed', 'a') as failed, \
+                ThreadPoolExecutor(1) as decoder:
+
+            def report_failed(path):
+                print(path, file=failed)
+                failed.flush()
+                progress.put(('failed', path))
+
+            frames = _read_frames(paths, params['frame_step'], report_failed)
+            next_batch = decoder.submit(_take, frames, batch_size)
+            n_records = log.n_records
+            first_records = dict()
+            while True:
+                batch = next_batch.result()
+                if not batch:
+                    break
+                next_batch = decoder.submit(_take, frames, batch_size)
+
+                keypoints = pose.predict_batch([img for _, _, img, _ in batch])
+                finished = list()
+                for (path, timestamp, _, is_last), img_keypoints in zip(batch, keypoints):
+                    first_records.setdefault(path, n_records)
+                    log.write(n_records, img_keypoints, timestamp)
+                    n_records += 1
+                    if is_last:
+                        finished.append((path, n_records))
+                log.flush()  # records before the checkpoint
+                for path, end in finished:
+                    first = first_records.pop(path)
+                    print('{}\t{}\t{}'.format(path, first, end - first), file=done)
+                done.flush()
+                progress.put(('batch', len(batch), len(finished)))
+        progress.put(('end', shard))
+    except Exception:
+        progress.put(('error', shard, traceback.format_exc()))
+
+
+def _read_done(done_path):
+    """Yields (path, first record, number of frames) of the inputs listed in done_path."""
+
+    with open(done_path) as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) == 3:  # the last line of an interrupted run may be partial
+                yield fields[0], int(fields[1]), int(fields[2])
+
+
+def _read_frames(paths, frame_step, on_failed):
+    """Yields (path, timestamp, image, is_last) of every image and of every frame_step-th frame of every video.
+
+    Calls on_failed with the path of every input that yields no frame.
+    """
+
+    for path in paths:
+        if path.lower().endswith(Extractor.video_extensions):
+            capture = cv2.VideoCapture(path)
+            previous = None
+            frame_number = 0
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                if frame_number % frame_step == 0:
+                    if previous is not None:
+                        yield previous + (False, )
+                    previous = (path, capture.get(cv2.CAP_PROP_POS_MSEC) / 1000, frame)
+                frame_number += 1
+            capture.release()
+            if previous is None:
+                on_failed(path)
+            else:
+                yield previous + (True, )
+        else:
+            img = cv2.imread(path)
+            if img is None:
+                on_failed(path)
+            else:
+                yield path, 0., img, True
+
+
+def _take(frames, n):
+    batch = list()
+    for item in frames:
+        batch.append(item)
+        if len(batch) == n:
+            break
+    return batch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Extracts key-points of images and videos into pose logs.')
+    parser.add_argument('inputs', nargs='+', help='image and video files or directories, searched recursively')
+    parser.add_argument('--output', required=True, help='directory of the pose logs and done lists')
+    parser.add_argument('--config', required=True, help='OpenPose config file')
+    parser.add_argument('--weights', default=None, help='model weights, required unless --tflite is given')
+    parser.add_argument('--tflite', default=None, help='graph exported by export.TFLiteExporter, used if given')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes, by default fills all cores')
+    parser.add_argument('--threads', type=int, default=2, help='model threads per worker')
+    parser.add_argument('--batch-size', type=int, default=None)
+    parser.add_argument('--input-shape', type=int, nargs=2, default=[184, 184])
+    parser.add_argument('--frame-step', type=int, default=1, help='extract every n-th video frame')
+    parser.add_argument('--max-peaks', type=int, default=None, help='peaks per part returned by the model')
+    parser.add_argument('--dtype', default='float16', choices=('float16', 'float32'))
+    parser.add_argument('--log-every', type=float, default=10., help='seconds between progress reports')
+    parser.add_argument('--retry-failed', action='store_true', help='also extract inputs earlier runs could not read')
+    args = parser.parse_args(argv)
+    if args.weights is None and args.tflite is None:
+        parser.error('--weights is required unless --tflite is given')
+
+    extractor = Extractor(args.weights, args.config, args.output, args.workers, args.threads, args.batch_size,
+                          tuple(args.input_shape), args.frame_step, args.max_peaks, args.tflite, args.dtype,
+                          args.log_every)
+    extractor.run(args.inputs, args.retry_failed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
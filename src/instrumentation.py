@@ -0,0 +1,186 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+import json
+
+import numpy as np
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class _Span:
+
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.instrumentation.record(self.name, perf_counter() - self.start)
+        return False
+
+
+class _RingBuffer:
+
+    def __init__(self, size):
+        self.values = np.zeros(size)
+        self.n_total = 0
+        self.sum = 0.
+
+    def add(self, value):
+        self.values[self.n_total % len(self.values)] = value
+        self.n_total += 1
+        self.sum += value
+
+    def window(self):
+        return self.values[:min(self.n_total, len(self.values))]
+
+
+class Instrumentation:
+
+    """Per stage latency histograms and per frame counters of the pose pipelines.
+
+    Latencies and counter values are kept in ring buffers of the last window observations, percentiles are computed
+    over those. When disabled, span returns a shared no-op context manager and count returns immediately. Use like
+    this:
+        stats.enable()
+        with stats.span('model_forward'):
+            ...
+        stats.count('people', len(subset))
+        print(stats.summary())
+        stats.serve(9100)  # Prometheus text format at http://localhost:9100/metrics
+    """
+
+    _null_span = _NullSpan()
+
+    def __init__(self, enabled=False, window=1024):
+        self.enabled = enabled
+        self.window = window
+        self.latencies = dict()
+        self.counters = dict()
+        self.lock = Lock()
+        self.server = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.latencies = dict()
+            self.counters = dict()
+
+    def span(self, name):
+        """Context manager recording the wall time of its block under name."""
+
+        if not self.enabled:
+            return self._null_span
+        return _Span(self, name)
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.latencies:
+                self.latencies[name] = _RingBuffer(self.window)
+            self.latencies[name].add(seconds)
+
+    def count(self, name, value):
+        """Records a per frame quantity, e.g. the number of people or peaks."""
+
+        if not self.enabled:
+            return
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = _RingBuffer(self.window)
+            self.counters[name].add(value)
+
+    def summary(self):
+        """Returns {'latency_ms': {stage: stats}, 'counters': {name: stats}} with count, mean, p50, p95 and p99."""
+
+        with self.lock:
+            return {'latency_ms': {name: self._describe(buffer, 1000) for name, buffer in self.latencies.items()},
+                    'counters': {name: self._describe(buffer, 1) for name, buffer in self.counters.items()}}
+
+    def to_json(self, path=None):
+        dump = json.dumps(self.summary(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(dump)
+        return dump
+
+    def to_prometheus(self):
+        """Returns the summary in Prometheus text exposition format."""
+
+        summary = self.summary()
+        lines = ['# TYPE pose_stage_latency_seconds summary']
+        for name, s in summary['latency_ms'].items():
+            for q in ('p50', 'p95', 'p99'):
+                lines.append('pose_stage_latency_seconds{{stage="{}",quantile="0.{}"}} {}'.format(
+                    name, q[1:], s[q] / 1000))
+            lines.append('pose_stage_latency_seconds_sum{{stage="{}"}} {}'.format(name, s['sum'] / 1000))
+            lines.append('pose_stage_latency_seconds_count{{stage="{}"}} {}'.format(name, s['count']))
+        lines.append('# TYPE pose_frame_count summary')
+        for name, s in summary['counters'].items():
+            for q in ('p50', 'p95', 'p99'):
+                lines.append('pose_frame_count{{name="{}",quantile="0.{}"}} {}'.format(name, q[1:], s[q]))
+            lines.append('pose_frame_count_sum{{name="{}"}} {}'.format(name, s['sum']))
+            lines.append('pose_frame_count_count{{name="{}"}} {}'.format(name, s['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port=9100, host='127.0.0.1'):
+        """Serves to_prometheus at /metrics and the JSON summary at /metrics.json on a daemon thread."""
+
+        instrumentation = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, content_type = instrumentation.to_prometheus(), 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body, content_type = instrumentation.to_json(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer((host, port), Handler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+    @staticmethod
+    def _describe(buffer, scale):
+        values = buffer.window() * scale
+        if len(values) == 0:
+            return {'count': 0, 'sum': 0., 'mean': 0., 'p50': 0., 'p95': 0., 'p99': 0.}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {'count': buffer.n_total,
+                'sum': buffer.sum * scale,
+                'mean': float(values.mean()),
+                'p50': float(p50),
+                'p95': float(p95),
+                'p99': float(p99)}
+
+
+stats = Instrumentation()
@@ -1,5 +1,4 @@
-from configobj import ConfigObj
-from time import time
+from threading import local
 
 import numpy as np
 
@@ -7,9 +6,22 @@ import tensorflow as tf
 import tensorflow_probability as tfb
 from tensorflow import keras as tfk
 import cv2
+
+from instrumentation import stats
+from settings import Settings
+
 tfkl = tfk.layers
 tfkb = tfk.backend
 
+subpixel_methods = ('quadratic', 'soft_argmax')
+
+# dtype policy of the post-processing: maps, coordinates and scores in float32, peak ids in int32
+float_dtype = np.float32
+id_dtype = np.int32
+
+# PoseRenderer of every thread, see PoseRenderer.shared
+_renderers = local()
+
 
 class CPM:
     def __init__(self, input_shape=(None, None, 3), dropout_rate=0.1, n_parts=16):
@@ -129,7 +141,107 @@ class CPM:
 
 
 class StackedHourglassNetwork:
-    pass
+
+    stride = 4
+
+    def __init__(self, input_shape=(256, 256, 3), n_stacks=2, n_filters=128, depth=4, n_parts=16):
+        """Stacked hourglass model definition proposed in arXiv:1603.06937
+
+        :param input_shape: (height, width, n_channels), height and width must be multiples of 4 * 2 ** depth
+        :param n_stacks: int - number of hourglass modules, each one followed by a heatmap output
+        :param n_filters: int - number of filters of the residual blocks, 256 in the paper
+        :param depth: int - number of times every hourglass halves the resolution
+        :param n_parts: int - number of heatmap channels, 16 for MPII
+
+        Note: Input image must be RGB(0, 255)
+        Note: Heatmaps have 1 / stride of the input resolution. paf_stages and cm_stages describe the outputs like
+              OpenPoseModelV2 does, so train.Trainer supervises every stack as a confidence map stage.
+        """
+
+        multiple = self.stride * 2 ** depth
+        if any(size is not None and size % multiple for size in input_shape[:2]):
+            raise ValueError('input_shape must be a multiple of {} for depth {}, got {}'.format(multiple, depth,
+                                                                                              input_shape))
+        self.input_shape = input_shape
+        self.n_stacks = n_stacks
+        self.n_filters = n_filters
+        self.depth = depth
+        self.n_parts = n_parts
+        self.paf_stages = 0
+        self.cm_stages = n_stacks
+
+    def create_model(self, intermediate_outputs=False):
+        """Returns the model with the heatmaps of the last stack as output.
+
+        If intermediate_outputs is True, the heatmaps of all n_stacks stacks are returned for intermediate
+        supervision.
+        """
+
+        input_tensor = tfkl.Input(self.input_shape)  # Input must be RGB and (0, 255
+        x = tfkl.Lambda(lambda x: x / 256 - 0.5)(input_tensor)  # [-0.5, 0.5]
+
+        # 1 / 4 of the input resolution
+        x = self._conv_bn_relu(x, 64, 7, 'stem_conv', strides=2)
+        x = self._residual(x, self.n_filters // 2, 'stem_res1')
+        x = tfkl.MaxPooling2D(2, name='stem_pool')(x)
+        x = self._residual(x, self.n_filters // 2, 'stem_res2')
+        x = self._residual(x, self.n_filters, 'stem_res3')
+
+        outputs = list()
+        for stack in range(self.n_stacks):
+            prefix = 'stack%d_' % stack
+            y = self._hourglass(x, self.depth, prefix + 'hg%d' % self.depth)
+            y = self._residual(y, self.n_filters, prefix + 'res')
+            y = self._conv_bn_relu(y, self.n_filters, 1, prefix + 'lin')
+            heatmaps = tfkl.Conv2D(self.n_parts, 1, name=prefix + 'heatmaps')(y)
+            outputs.append(heatmaps)
+
+            # the next stack refines features and heatmaps of this one
+            if stack < self.n_stacks - 1:
+                features = tfkl.Conv2D(self.n_filters, 1, name=prefix + 'features_remap')(y)
+                remapped = tfkl.Conv2D(self.n_filters, 1, name=prefix + 'heatmaps_remap')(heatmaps)
+                x = tfkl.Add()([x, features, remapped])
+
+        if intermediate_outputs:
+            return tfk.Model(input_tensor, outputs)
+        return tfk.Model(input_tensor, outputs[-1])
+
+    def _hourglass(self, x, depth, name):
+        up = self._residual(x, self.n_filters, name + '_up')
+
+        low = tfkl.MaxPooling2D(2, name=name + '_pool')(x)
+        low = self._residual(low, self.n_filters, name + '_low1')
+        if depth > 1:
+            low = self._hourglass(low, depth - 1, name[:-1] + str(depth - 1))
+        else:
+            low = self._residual(low, self.n_filters, name + '_low2')
+        low = self._residual(low, self.n_filters, name + '_low3')
+        low = tfkl.UpSampling2D(2, name=name + '_upsample')(low)
+        return tfkl.Add()([up, low])
+
+    def _residual(self, x, nf, name):
+        """Bottleneck residual block with pre-activation, a 1x1 convolution on the shortcut if channels change."""
+
+        y = self._bn_relu(x, name + '_bn1')
+        y = tfkl.Conv2D(nf // 2, 1, name=name + '_conv1')(y)
+        y = self._bn_relu(y, name + '_bn2')
+        y = tfkl.Conv2D(nf // 2, 3, padding='same', name=name + '_conv2')(y)
+        y = self._bn_relu(y, name + '_bn3')
+        y = tfkl.Conv2D(nf, 1, name=name + '_conv3')(y)
+
+        shortcut = x
+        if tfkb.int_shape(x)[-1] != nf:
+            shortcut = tfkl.Conv2D(nf, 1, name=name + '_shortcut')(x)
+        return tfkl.Add()([shortcut, y])
+
+    def _conv_bn_relu(self, x, nf, ks, name, strides=1):
+        x = tfkl.Conv2D(nf, ks, strides=strides, padding='same', name=name)(x)
+        return self._bn_relu(x, name + '_bn')
+
+    @staticmethod
+    def _bn_relu(x, name):
+        x = tfkl.BatchNormalization(name=name)(x)
+        return tfkl.Activation('relu')(x)
 
 
 class OpenPose:
@@ -145,40 +257,40 @@ class OpenPose:
               [0, 255, 0], [0, 255, 85], [0, 255, 170], [0, 255, 255], [0, 170, 255], [0, 85, 255],
               [0, 0, 255], [85, 0, 255], [170, 0, 255], [255, 0, 255], [255, 0, 170], [255, 0, 85]]
 
-    def __init__(self, weights_path, config_path, n_scales=1):
+    def __init__(self, weights_path, config_path, n_scales=1, subpixel=None, postprocess_stride=1, max_peaks=None,
+                 dtype=None, cache=None):
+        """
+        :param subpixel: str - optional sub-pixel peak refinement, one of subpixel_methods
+        :param postprocess_stride: int - peaks and PAF line integrals are computed on maps of 1 / postprocess_stride
+            of the image size and coordinates are scaled back at the end. 1 upsamples the outputs to full image
+            resolution, the model stride (8) skips upsampling altogether; best combined with subpixel
+        :param max_peaks: int - keep at most this many peaks per part, 0 keeps all, None takes max_peaks of the
+            [performance] config section and keeps all if it is not set
+        :param dtype: dtype of the maps used by post-processing, None takes precision of the config
+        :param cache: cache.ResultCache - optional, results of images seen before with the same settings are reused
+        """
+
         self.weights_path = weights_path
         self.config_path = config_path
-        self.params, self.model_params = self._read_config()
+        self.settings = Settings.load(config_path)
         self.n_scales = n_scales
+        self.subpixel = subpixel
+        self.postprocess_stride = postprocess_stride
+        if max_peaks is None:
+            max_peaks = self.settings.max_peaks
+        self.max_peaks = max_peaks or None
+        self.dtype = self.settings.dtype if dtype is None else np.dtype(dtype)
+        self.legacy_peaks = 'peaks' in self.settings.legacy_stages
+        self.legacy_connections = 'connections' in self.settings.legacy_stages
+        if self.legacy_peaks and (subpixel is not None or self.max_peaks is not None):
+            raise ValueError('The legacy peaks stage supports neither subpixel nor max_peaks.')
         open_pose_obj = OpenPoseModel()
         self.model = open_pose_obj.create_model()
         self._load_model()
+        self.cache = cache
         self.fe = FeatureExtractor()
         self.n_joints = 18
 
-    def _read_config(self):
-        config = ConfigObj(self.config_path)
-        param = config['param']
-        model_id = param['modelID']
-        model = config['models'][model_id]
-        model['boxsize'] = int(model['boxsize'])
-        model['stride'] = int(model['stride'])
-        model['padValue'] = int(model['padValue'])
-        param['octave'] = int(param['octave'])
-        param['use_gpu'] = int(param['use_gpu'])
-        param['starting_range'] = float(param['starting_range'])
-        param['ending_range'] = float(param['ending_range'])
-        param['scale_search'] = list(map(float, param['scale_search']))
-        param['thre1'] = float(param['thre1'])
-        param['thre2'] = float(param['thre2'])
-        param['thre3'] = float(param['thre3'])
-        param['mid_num'] = int(param['mid_num'])
-        param['min_num'] = int(param['min_num'])
-        param['crop_ratio'] = float(param['crop_ratio'])
-        param['bbox_ratio'] = float(param['bbox_ratio'])
-        param['GPUdeviceNumber'] = int(param['GPUdeviceNumber'])
-        return param, model
-
     def draw_pose(self, img, inference_h, inference_w, n_scales=None):
         if n_scales is not None:
             org_n_scales = self.n_scales
@@ -215,58 +327,97 @@ class OpenPose:
     def _extract_keypoints(person_subset, candidate_arr):
         kps = list()
         for i in range(18):
-            kp_ind = person_subset[i].astype(np.int)
+            kp_ind = person_subset[i].astype(int)
             if kp_ind == -1:
                 kps.append(None)
             else:
-                kps.append(candidate_arr[kp_ind, 0: 2].astype(np.int))
+                kps.append(candidate_arr[kp_ind, 0: 2].astype(int))
         return kps
 
     def _complete_inference(self, img, n_scales):
         if n_scales is not None:
             org_n_scales = self.n_scales
             self.n_scales = n_scales
-        heatmap_avg, paf_avg = self._get_hm_paf_av(img)
-        all_peaks = self._get_peaks(heatmap_avg, self.params['thre1'])
-        connection_all, special_k = self._get_connections(paf_avg, all_peaks, self.params['thre2'], img.shape)
-        subset, candidate = self._get_subset(all_peaks, special_k, connection_all)
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(img, self._cache_tag())
+            value = self.cache.get(key)
+        if key is None or value is None:
+            all_peaks, subset, candidate = self.predict(img)
+            if key is not None:
+                self.cache.put(key, self._pack_result(all_peaks, subset, candidate))
+        else:
+            all_peaks, subset, candidate = self._unpack_result(value)
         if n_scales is not None:
             self.n_scales = org_n_scales
         return all_peaks, subset, candidate
 
+    def _cache_tag(self):
+        """Everything besides the image the result of predict depends on, the weights by path, size and mtime."""
+
+        settings = self.settings
+        return ('OpenPose', self.cache.file_signature(self.weights_path), self.n_scales, self.subpixel,
+                self.postprocess_stride, self.max_peaks, self.dtype.str, settings.scale_search, settings.box_size,
+                settings.stride, settings.pad_value, settings.thre1, settings.thre2, settings.mid_num,
+                settings.legacy_stages)
+
+    @staticmethod
+    def _pack_result(all_peaks, subset, candidate):
+        peaks = np.array([peak for part_peaks in all_peaks for peak in part_peaks], dtype=np.float64).reshape(-1, 4)
+        return {'peaks': peaks,
+                'counts': np.array([len(part_peaks) for part_peaks in all_peaks]),
+                'subset': subset,
+                'candidate': candidate}
+
+    @staticmethod
+    def _unpack_result(value):
+        """Inverse of _pack_result, coordinates of the peak tuples come back as floats."""
+
+        rows = [(x, y, score, int(i)) for x, y, score, i in value['peaks'].tolist()]
+        ends = np.cumsum(value['counts']).tolist()
+        all_peaks = [rows[start: end] for start, end in zip([0] + ends[:-1], ends)]
+        return all_peaks, value['subset'].copy(), value['candidate'].copy()
+
     def predict(self, img):
         """Returns keypoints, subset and candidate.
 
         img should be of type BGR.
         """
 
-        t = time()
+        settings = self.settings
         heatmap_avg, paf_avg = self._get_hm_paf_av(img)
-        print('s1: ', time() - t)
-        t1 = time()
-        all_peaks = self._get_peaks(heatmap_avg, self.params['thre1'])
-        print('s2: ', time() - t1)
-        t1 = time()
-        connection_all, special_k = self._get_connections(paf_avg, all_peaks, self.params['thre2'], img.shape)
-        print('s3: ', time() - t1)
-        t1 = time()
-        subset, candidate = self._get_subset(all_peaks, special_k, connection_all)
-        print('s4: ', time() - t1)
-        print('Execution time: ', time() - t)
+        with stats.span('peaks'):
+            if self.legacy_peaks:
+                all_peaks = self._get_peaks_legacy(heatmap_avg, settings.thre1)
+            else:
+                all_peaks = self._get_peaks(heatmap_avg, settings.thre1, self.subpixel, self.max_peaks)
+        with stats.span('connections'):
+            if self.legacy_connections:
+                connection_all, special_k = self._get_connections_legacy(paf_avg, all_peaks, settings.thre2,
+                                                                         heatmap_avg.shape, settings.mid_num)
+            else:
+                connection_all, special_k = self._get_connections(paf_avg, all_peaks, settings.thre2,
+                                                                  heatmap_avg.shape[0], settings.mid_num)
+        if heatmap_avg.shape[:2] != img.shape[:2]:
+            all_peaks = self._scale_peaks(all_peaks,
+                                          img.shape[1] / heatmap_avg.shape[1],
+                                          img.shape[0] / heatmap_avg.shape[0])
+        with stats.span('subset'):
+            subset, candidate = self._get_subset(all_peaks, special_k, connection_all)
+        count_frame(all_peaks, connection_all, subset)
         return all_peaks, subset, candidate
 
     def compare_draw(self, img, target_kps, inference_h, inference_w, n_scales=1, th=5):
         correct_color = OpenPose.colors[9]
         wrong_color = [255, 255, 0]
-        target_features = self.fe.generate_features(target_kps)
+        target_features = self._target_features(target_kps)
 
         org_h, org_w, _ = img.shape
         max_radius = org_h // 5
 
-        resized = tf.image.resize_with_pad(img, inference_h, inference_w).numpy()
-        t = time()
+        with stats.span('resize'):
+            resized = tf.image.resize_with_pad(img, inference_h, inference_w).numpy()
         peaks, subset, candidate = self._complete_inference(resized, n_scales)
-        print('complete inference: ', time() - t)
 
         if not subset.any():
             return img
@@ -274,75 +425,61 @@ class OpenPose:
             transformed_candidate = self.inverse_transform_kps(org_h, org_w, inference_h, inference_w, candidate)
 
         person = subset[0]
-        t = time()
-        kps = self._extract_keypoints(person, transformed_candidate)
-        features = self.fe.generate_features(kps)
-        print('kp extraction and feature generation: ', time() - t)
-
-        for kp in kps:
-            if kp is not None:
-                cv2.circle(img, (int(kp[0]), int(kp[1])), 4, correct_color, thickness=-1)
+        with stats.span('features'):
+            kps = self._extract_keypoints(person, transformed_candidate)
+            features = self.fe.generate_features(kps)
 
-        t = time()
-        for i in range(len(features)):
-            f = features[i]
-            ft = target_features[i]
-            if (f is not None) and (ft is not None):
-                f_diff = np.abs(f - ft)
-                if f_diff >= th:
-                    radius = int(max_radius * f_diff / 360)
-                    failure_overlay = img.copy()
-                    kp = kps[self.fe.points_comb[i][1]]
-                    cv2.circle(failure_overlay, (int(kp[0]), int(kp[1])), radius, wrong_color, thickness=-1)
-                    img = cv2.addWeighted(img, 0.4, failure_overlay, 0.6, 0)
-        print('difference drawing: ', time() - t)
-        stick_width = 4
-
-        for i in range(17):
-            index = person[np.array(OpenPose.limb_seq[i]) - 1]
-            if -1 in index:
-                continue
-            cur_canvas = img.copy()
-            y = transformed_candidate[index.astype(int), 0]
-            x = transformed_candidate[index.astype(int), 1]
-            kps.append([])
-            m_x = np.mean(x)
-            m_y = np.mean(y)
-            length = np.sqrt(np.power(x[0] - x[1], 2) + np.power(y[0] - y[1], 2))
-            angle = np.degrees(np.arctan2(x[0] - x[1], y[0] - y[1]))
-            polygon = cv2.ellipse2Poly((int(m_y), int(m_x)),
-                                       (int(length / 2), stick_width),
-                                       int(angle),
-                                       0,
-                                       360, 1)
-            cv2.fillConvexPoly(cur_canvas, polygon, OpenPose.colors[i])
-            img = cv2.addWeighted(img, 0.4, cur_canvas, 0.6, 0)
+        with stats.span('drawing'):
+            for kp in kps:
+                if kp is not None:
+                    cv2.circle(img, (int(kp[0]), int(kp[1])), 4, correct_color, thickness=-1)
+
+            renderer = PoseRenderer.shared()
+            img = renderer.prepare_output(img)
+            for i in range(len(features)):
+                f = features[i]
+                ft = target_features[i]
+                if (f is not None) and (ft is not None):
+                    f_diff = np.abs(f - ft)
+                    if f_diff >= th:
+                        radius = int(max_radius * f_diff / 360)
+                        kp = kps[self.fe.points_comb[i][1]]
+                        renderer.add_circle((kp[0], kp[1]), radius, wrong_color)
+            img = renderer.blend(img)
+
+            renderer.add_limbs(person[np.newaxis], transformed_candidate)
+            img = renderer.blend(img)
         return img
 
+    def _target_features(self, target_kps):
+        if self.cache is None:
+            return self.fe.generate_features(target_kps)
+        return self.cache.features(self.fe, target_kps)
+
     @staticmethod
     def inverse_transform_kps(org_h, org_w, h, w, candidate):
-        kps = candidate[:, 0: 2].astype(np.int)
         scale_factor = np.max([org_h, org_w]) / h
-        transformed_candidate = np.zeros((candidate.shape[0], 3))
+        transformed_candidate = np.empty((candidate.shape[0], 3), dtype=float_dtype)
         if org_h > org_w:
             resized_w = org_w / scale_factor
             border = (w - resized_w) / 2
-            for i, kp in enumerate(kps):
-                transformed_candidate[i, 0] = scale_factor * (kp[0] - border)
-                transformed_candidate[i, 1] = scale_factor * kp[1]
-                transformed_candidate[i, 2] = candidate[i, 2]
+            transformed_candidate[:, 0] = scale_factor * (candidate[:, 0] - border)
+            transformed_candidate[:, 1] = scale_factor * candidate[:, 1]
         else:
             resized_h = org_h / scale_factor
             border = (h - resized_h) / 2
-            for i, kp in enumerate(kps):
-                transformed_candidate[i, 0] = scale_factor * kp[0]
-                transformed_candidate[i, 1] = scale_factor * (kp[1] - border)
-                transformed_candidate[i, 2] = candidate[i, 2]
+            transformed_candidate[:, 0] = scale_factor * candidate[:, 0]
+            transformed_candidate[:, 1] = scale_factor * (candidate[:, 1] - border)
+        transformed_candidate[:, 2] = candidate[:, 2]
         return transformed_candidate
 
     @staticmethod
-    def draw_inverse_transformed_parts(img, peaks, subset, transformed_candidate):
-        valid_indices = subset.flatten().astype(np.int).tolist()[: 18]
+    def draw_inverse_transformed_parts(img, peaks, subset, transformed_candidate, out=None):
+        """Draws key-points and limbs of all people into out, by default into img itself."""
+
+        renderer = PoseRenderer.shared()
+        img = renderer.prepare_output(img, out)
+        valid_indices = subset.flatten().astype(int).tolist()[: 18]
         for i in range(18):
             for j in range(len(peaks[i])):
                 ind = peaks[i][j][-1]
@@ -350,71 +487,74 @@ class OpenPose:
                     c = transformed_candidate[ind]
                     cv2.circle(img, (int(c[0]), int(c[1])), 4, OpenPose.colors[i], thickness=-1)
 
-        stick_width = 4
-
-        for i in range(17):
-            for n in range(len(subset)):
-                index = subset[n][np.array(OpenPose.limb_seq[i]) - 1]
-                if -1 in index:
-                    continue
-                cur_canvas = img.copy()
-                y = transformed_candidate[index.astype(int), 0]
-                x = transformed_candidate[index.astype(int), 1]
-                m_x = np.mean(x)
-                m_y = np.mean(y)
-                length = np.sqrt(np.power(x[0] - x[1], 2) + np.power(y[0] - y[1], 2))
-                angle = np.degrees(np.arctan2(x[0] - x[1], y[0] - y[1]))
-                polygon = cv2.ellipse2Poly((int(m_y), int(m_x)),
-                                           (int(length / 2), stick_width),
-                                           int(angle),
-                                           0,
-                                           360,
-                                           1)
-                cv2.fillConvexPoly(cur_canvas, polygon, OpenPose.colors[i])
-                img = cv2.addWeighted(img, 0.4, cur_canvas, 0.6, 0)
-        return img
+        renderer.add_limbs(subset, transformed_candidate)
+        return renderer.blend(img)
 
     @staticmethod
-    def draw_parts(canvas, peaks, subset, candidate):
-        valid_indices = subset.flatten().astype(np.int).tolist()
+    def draw_parts(canvas, peaks, subset, candidate, out=None):
+        """Draws key-points and limbs of all people into out, by default into canvas itself."""
+
+        renderer = PoseRenderer.shared()
+        canvas = renderer.prepare_output(canvas, out)
+        valid_indices = subset[:, :18].flatten().tolist()
         for i in range(18):
             for j in range(len(peaks[i])):
                 peak = peaks[i][j]
                 if int(peak[-1]) not in valid_indices:
                     continue
-                cv2.circle(canvas, peak[0:2], 4, OpenPose.colors[i], thickness=-1)
+                cv2.circle(canvas, (int(peak[0]), int(peak[1])), 4, OpenPose.colors[i], thickness=-1)
 
-        stick_width = 4
+        renderer.add_limbs(subset, candidate)
+        return renderer.blend(canvas)
 
-        for i in range(17):
-            for n in range(len(subset)):
-                index = subset[n][np.array(OpenPose.limb_seq[i]) - 1]
-                if -1 in index:
-                    continue
-                cur_canvas = canvas.copy()
-                y = candidate[index.astype(int), 0]
-                x = candidate[index.astype(int), 1]
-                m_x = np.mean(x)
-                m_y = np.mean(y)
-                length = np.sqrt(np.power(x[0] - x[1], 2) + np.power(y[0] - y[1], 2))
-                angle = np.degrees(np.arctan2(x[0] - x[1], y[0] - y[1]))
-                polygon = cv2.ellipse2Poly((int(m_y), int(m_x)),
-                                           (int(length / 2), stick_width),
-                                           int(angle),
-                                           0,
-                                           360,
-                                           1)
-                cv2.fillConvexPoly(cur_canvas, polygon, OpenPose.colors[i])
-                canvas = cv2.addWeighted(canvas, 0.4, cur_canvas, 0.6, 0)
-        return canvas
+    @staticmethod
+    def _get_peaks(heatmap_avg, thre1, subpixel=None, max_peaks=None):
+        """Finds the local maxima above thre1 of all 18 parts at once.
+
+        One boolean threshold mask of the 18 part maps is allocated; only the pixels above thre1 are then compared
+        with their four neighbours, by index, so no shifted float copies of the maps and no per-neighbour comparison
+        masks are needed. Works in the dtype of heatmap_avg.
+
+        :param max_peaks: int - keep at most this many peaks per part, the highest scoring ones
+        :return: list with a list of (x, y, score, id) tuples per part, ids enumerate the peaks of all parts
+        """
+
+        hm = heatmap_avg[:, :, :18]
+        h, w = hm.shape[:2]
+        # part major order, raster order within a part
+        parts, ys, xs = np.nonzero(hm.transpose(2, 0, 1) > thre1)
+        scores = hm[ys, xs, parts]
+
+        # clipping compares border pixels with themselves, as outside the map counts as 0 < thre1
+        is_peak = np.ones(len(scores), dtype=bool)
+        for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            is_peak &= scores >= hm[np.clip(ys + dy, 0, h - 1), np.clip(xs + dx, 0, w - 1), parts]
+        parts, ys, xs, scores = parts[is_peak], ys[is_peak], xs[is_peak], scores[is_peak]
+
+        if max_peaks is not None:
+            order = np.lexsort((-scores, parts))
+            starts = np.searchsorted(parts, np.arange(18))
+            keep = np.sort(order[np.arange(len(order)) - starts[parts[order]] < max_peaks])
+            parts, ys, xs, scores = parts[keep], ys[keep], xs[keep], scores[keep]
+
+        if subpixel is None:
+            coords = xs, ys
+        else:
+            dx, dy = subpixel_offsets(heatmap_avg, xs, ys, parts, subpixel)
+            coords = xs + dx, ys + dy
+
+        rows = list(zip(coords[0].tolist(), coords[1].tolist(), scores.tolist(), range(len(scores))))
+        ends = np.cumsum(np.bincount(parts, minlength=18)).tolist()
+        return [rows[start: end] for start, end in zip([0] + ends[:-1], ends)]
 
     @staticmethod
-    def _get_peaks(heatmap_avg, thre1):
+    def _get_peaks_legacy(heatmap_avg, thre1):
+        """The original peak search over shifted copies of every part's map, see _get_peaks."""
+
         all_peaks = []
         peak_counter = 0
         for part in range(18):
             map_ori = heatmap_avg[:, :, part]
-            # _map = gaussian_filter(map_ori, sigma=3)
             _map = map_ori
             map_left = np.zeros(_map.shape)
             map_left[1:, :] = _map[:-1, :]
@@ -441,10 +581,79 @@ class OpenPose:
         return all_peaks
 
     @staticmethod
-    def _get_connections(paf_avg, all_peaks, thre2, img_shape):
+    def _get_connections(paf_avg, all_peaks, thre2, map_h, mid_num=10):
+        """Scores all candidate pairs of a limb at once, with the same result as _get_connections_legacy.
+
+        The mid_num sample points of all pairs are looked up with one fancy index. Sample points follow np.linspace
+        and the line integral is summed point by point, so scores and the order of equally scored limbs are exactly
+        those of the loop over all pairs.
+
+        :param all_peaks: list with the (x, y, score, id) peaks of every part, as lists of tuples or arrays
+        :param map_h: int - height of paf_avg, limbs longer than half of it are penalized
+        :return: connection_all with the connections of every limb, see _connection_arrays, and special_k, the limbs
+            lacking peaks of one of their parts
+        """
+
+        connection_all = []
+        special_k = []
+        steps = np.arange(mid_num, dtype=np.float64)
+
+        for k in range(len(OpenPose.map_idx)):
+            channel_x, channel_y = [x - 19 for x in OpenPose.map_idx[k]]
+            cand_a = np.asarray(all_peaks[OpenPose.limb_seq[k][0] - 1], dtype=np.float64).reshape(-1, 4)
+            cand_b = np.asarray(all_peaks[OpenPose.limb_seq[k][1] - 1], dtype=np.float64).reshape(-1, 4)
+            n_a = len(cand_a)
+            n_b = len(cand_b)
+            if n_a == 0 or n_b == 0:
+                special_k.append(k)
+                connection_all.append(OpenPose._connection_arrays([]))
+                continue
+
+            # all pairs in the order of the loop, a major
+            start = np.repeat(cand_a[:, :2], n_b, axis=0)
+            end = np.tile(cand_b[:, :2], (n_a, 1))
+            vec = end - start
+            norm = np.sqrt(vec[:, 0] * vec[:, 0] + vec[:, 1] * vec[:, 1])
+            # failure case when 2 body parts overlaps
+            pairs = np.flatnonzero(norm != 0)
+            start, end, vec, norm = start[pairs], end[pairs], vec[pairs], norm[pairs]
+
+            points = start[:, :, np.newaxis] + steps * (vec / (mid_num - 1))[:, :, np.newaxis]
+            points[:, :, -1] = end
+            xs = np.rint(points[:, 0]).astype(np.intp)
+            ys = np.rint(points[:, 1]).astype(np.intp)
+
+            unit = (vec / norm[:, np.newaxis]).astype(paf_avg.dtype)
+            score_mid_pts = paf_avg[ys, xs, channel_x] * unit[:, :1] + paf_avg[ys, xs, channel_y] * unit[:, 1:]
+            score_sum = score_mid_pts[:, 0].astype(np.float64)
+            for m in range(1, mid_num):
+                score_sum += score_mid_pts[:, m]
+            score_with_dist_prior = score_sum / mid_num + np.minimum(0.5 * map_h / norm - 1, 0)
+            criterion1 = np.count_nonzero(score_mid_pts > thre2, axis=1) > 0.8 * mid_num
+            criterion2 = score_with_dist_prior > 0
+            accepted = np.flatnonzero(criterion1 & criterion2)
+            accepted = accepted[np.argsort(-score_with_dist_prior[accepted], kind='stable')]
+
+            connection = list()
+            used_a, used_b = set(), set()
+            for pair, s in zip(pairs[accepted].tolist(), score_with_dist_prior[accepted].tolist()):
+                i, j = divmod(pair, n_b)
+                if i not in used_a and j not in used_b:
+                    connection.append([cand_a[i, 3], cand_b[j, 3], s, i, j])
+                    used_a.add(i)
+                    used_b.add(j)
+                    if len(connection) >= min(n_a, n_b):
+                        break
+
+            connection_all.append(OpenPose._connection_arrays(connection))
+        return connection_all, special_k
+
+    @staticmethod
+    def _get_connections_legacy(paf_avg, all_peaks, thre2, img_shape, mid_num=10):
+        """The original loop over all pairs of peaks of every limb, see _get_connections."""
+
         connection_all = []
         special_k = []
-        mid_num = 10
 
         for k in range(len(OpenPose.map_idx)):
             score_mid = paf_avg[:, :, [x - 19 for x in OpenPose.map_idx[k]]]
@@ -484,35 +693,115 @@ class OpenPose:
                                                          score_with_dist_prior + cand_a[i][2] + cand_b[j][2]])
 
                 connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if i not in connection[:, 3] and j not in connection[:, 4]:
-                        connection = np.vstack([connection, [cand_a[i][3], cand_b[j][3], s, i, j]])
+                connection = list()
+                used_a, used_b = set(), set()
+                for i, j, s, _ in connection_candidate:
+                    if i not in used_a and j not in used_b:
+                        connection.append([cand_a[i][3], cand_b[j][3], s, i, j])
+                        used_a.add(i)
+                        used_b.add(j)
                         if len(connection) >= min(n_a, n_b):
                             break
 
-                connection_all.append(connection)
+                connection_all.append(OpenPose._connection_arrays(connection))
             else:
                 special_k.append(k)
-                connection_all.append([])
+                connection_all.append(OpenPose._connection_arrays([]))
         return connection_all, special_k
 
+    @staticmethod
+    def _connection_arrays(connection):
+        """Returns the connections of a limb as an int32 table of rows (peak id a, peak id b, index a, index b), the
+        indices into the peaks of the limb's parts, and the float32 limb scores.
+
+        :param connection: list of [id a, id b, score, index a, index b] lists
+        """
+
+        connection = np.array(connection, dtype=np.float64).reshape(-1, 5)
+        return connection[:, [0, 1, 3, 4]].astype(id_dtype), connection[:, 2].astype(float_dtype)
+
     @staticmethod
     def _get_subset(all_peaks, special_k, connection_all):
+        candidate = np.array([peak for part_peaks in all_peaks for peak in part_peaks], dtype=float_dtype)
+        subset, _ = OpenPose._group_people(candidate.reshape(-1, 4), special_k, connection_all)
+        return subset, candidate
+
+    @staticmethod
+    def _group_people(candidate, special_k, connection_all):
+        """Assembles people from the connections of all limbs.
+
+        Peak ids are kept in an int32 table, scores in float32. Returns the int32 subset of shape (n_people, 19) with
+        the 18 peak ids, -1 for missing parts, and the number of parts, and the float32 total score of every person.
+        """
+
+        ids = np.full((0, 18), -1, dtype=id_dtype)
+        scores = np.zeros(0, dtype=float_dtype)
+        counts = np.zeros(0, dtype=id_dtype)
+        peak_scores = candidate[:, 2]
+
+        for k in range(len(OpenPose.map_idx)):
+            if k in special_k:
+                continue
+            limb_ids, limb_scores = connection_all[k]
+            part_as, part_bs = limb_ids[:, 0], limb_ids[:, 1]
+            index_a, index_b = np.array(OpenPose.limb_seq[k]) - 1
+
+            for i in range(len(limb_ids)):
+                found = np.nonzero((ids[:, index_a] == part_as[i]) | (ids[:, index_b] == part_bs[i]))[0]
+
+                if len(found) == 1:
+                    j = found[0]
+                    if ids[j, index_b] != part_bs[i]:
+                        ids[j, index_b] = part_bs[i]
+                        counts[j] += 1
+                        scores[j] += peak_scores[part_bs[i]] + limb_scores[i]
+                elif len(found) == 2:  # if found 2 and disjoint, merge them
+                    j1, j2 = found
+                    if not np.any((ids[j1] >= 0) & (ids[j2] >= 0)):  # merge
+                        ids[j1] += ids[j2] + 1
+                        counts[j1] += counts[j2]
+                        scores[j1] += scores[j2] + limb_scores[i]
+                        ids, scores, counts = np.delete(ids, j2, 0), np.delete(scores, j2), np.delete(counts, j2)
+                    else:  # as like found == 1
+                        ids[j1, index_b] = part_bs[i]
+                        counts[j1] += 1
+                        scores[j1] += peak_scores[part_bs[i]] + limb_scores[i]
+
+                # if find no partA in the subset, create a new subset
+                elif len(found) == 0 and k < 17:
+                    row = np.full((1, 18), -1, dtype=id_dtype)
+                    row[0, index_a] = part_as[i]
+                    row[0, index_b] = part_bs[i]
+                    ids = np.concatenate([ids, row])
+                    scores = np.append(scores, peak_scores[[part_as[i], part_bs[i]]].sum() + limb_scores[i])
+                    counts = np.append(counts, id_dtype(2))
+
+        # delete people with few parts or a low average score
+        keep = (counts >= 4) & (scores / np.maximum(counts, 1) >= 0.4)
+        return np.concatenate([ids[keep], counts[keep, np.newaxis]], axis=1), scores[keep]
+
+    @staticmethod
+    def _group_people_legacy(candidate, special_k, connection_all):
+        """The original grouping on float64 rows of the subset, see _group_people.
+
+        Returns the subset of shape (n_people, 20) with the 18 peak ids, -1 for missing parts, the total score and
+        the number of parts.
+        """
+
         subset = -1 * np.ones((0, 20))
-        candidate = np.array([item for sublist in all_peaks for item in sublist])
 
         for k in range(len(OpenPose.map_idx)):
             if k not in special_k:
-                part_as = connection_all[k][:, 0]
-                part_bs = connection_all[k][:, 1]
+                limb_ids, limb_scores = connection_all[k]
+                part_as = limb_ids[:, 0].astype(np.float64)
+                part_bs = limb_ids[:, 1].astype(np.float64)
+                limb_scores = limb_scores.astype(np.float64)
                 index_a, index_b = np.array(OpenPose.limb_seq[k]) - 1
 
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
+                for i in range(len(limb_ids)):
                     found = 0
                     subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
+                    for j in range(len(subset)):
                         if subset[j][index_a] == part_as[i] or subset[j][index_b] == part_bs[i]:
                             subset_idx[found] = j
                             found += 1
@@ -522,19 +811,19 @@ class OpenPose:
                         if subset[j][index_b] != part_bs[i]:
                             subset[j][index_b] = part_bs[i]
                             subset[j][-1] += 1
-                            subset[j][-2] += candidate[part_bs[i].astype(int), 2] + connection_all[k][i][2]
+                            subset[j][-2] += candidate[int(part_bs[i]), 2] + limb_scores[i]
                     elif found == 2:  # if found 2 and disjoint, merge them
                         j1, j2 = subset_idx
                         membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
                         if len(np.nonzero(membership == 2)[0]) == 0:  # merge
                             subset[j1][:-2] += (subset[j2][:-2] + 1)
                             subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
+                            subset[j1][-2] += limb_scores[i]
                             subset = np.delete(subset, j2, 0)
                         else:  # as like found == 1
                             subset[j1][index_b] = part_bs[i]
                             subset[j1][-1] += 1
-                            subset[j1][-2] += candidate[part_bs[i].astype(int), 2] + connection_all[k][i][2]
+                            subset[j1][-2] += candidate[int(part_bs[i]), 2] + limb_scores[i]
 
                     # if find no partA in the subset, create a new subset
                     elif not found and k < 17:
@@ -542,7 +831,7 @@ class OpenPose:
                         row[index_a] = part_as[i]
                         row[index_b] = part_bs[i]
                         row[-1] = 2
-                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
+                        row[-2] = sum(candidate[limb_ids[i, :2], 2]) + limb_scores[i]
                         subset = np.vstack([subset, row])
 
         # delete some rows of subset which has few parts occur
@@ -550,12 +839,12 @@ class OpenPose:
         for i in range(len(subset)):
             if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
                 delete_idx.append(i)
-        subset = np.delete(subset, delete_idx, axis=0)
-        return subset, candidate
+        return np.delete(subset, delete_idx, axis=0)
 
     def _get_hm_paf_av(self, img):
         """Returns heatmaps and pafs, (ims_size, 19) and (img_size, 38)"""
-        multiplier = [i * self.model_params['boxsize'] / img.shape[0] for i in self.params['scale_search']]
+        settings = self.settings
+        multiplier = [i * settings.box_size / img.shape[0] for i in settings.scale_search]
 
         if self.n_scales == 1:
             scale = multiplier[0]
@@ -563,19 +852,22 @@ class OpenPose:
 
             # extract outputs, resize, and remove padding
             heatmap = self._get_heatmap(output_blobs,
-                                        self.model_params['stride'],
+                                        settings.stride,
                                         padded_resized_img.shape,
                                         img.shape,
-                                        pad)
+                                        pad,
+                                        self.postprocess_stride)
             paf = self._get_paf(output_blobs,
-                                self.model_params['stride'],
+                                settings.stride,
                                 padded_resized_img.shape,
                                 img.shape,
-                                pad)
-            return heatmap, paf
+                                pad,
+                                self.postprocess_stride)
+            return heatmap.astype(self.dtype, copy=False), paf.astype(self.dtype, copy=False)
 
-        heatmap_avg = np.zeros((img.shape[0], img.shape[1], 19))
-        paf_avg = np.zeros((img.shape[0], img.shape[1], 38))
+        map_h, map_w = self._get_map_shape(img.shape, self.postprocess_stride)
+        heatmap_avg = np.zeros((map_h, map_w, 19), dtype=self.dtype)
+        paf_avg = np.zeros((map_h, map_w, 38), dtype=self.dtype)
 
         for m in range(len(multiplier)):
             if m >= self.n_scales:
@@ -586,60 +878,74 @@ class OpenPose:
 
             # extract outputs, resize, and remove padding
             heatmap = self._get_heatmap(output_blobs,
-                                        self.model_params['stride'],
+                                        settings.stride,
                                         padded_resized_img.shape,
                                         img.shape,
-                                        pad)
+                                        pad,
+                                        self.postprocess_stride)
             paf = self._get_paf(output_blobs,
-                                self.model_params['stride'],
+                                settings.stride,
                                 padded_resized_img.shape,
                                 img.shape,
-                                pad)
-            heatmap_avg = heatmap_avg + heatmap / self.n_scales
-            paf_avg = paf_avg + paf / self.n_scales
+                                pad,
+                                self.postprocess_stride)
+            heatmap_avg += heatmap / self.n_scales
+            paf_avg += paf / self.n_scales
         return heatmap_avg, paf_avg
 
     def _infere(self, img, scale):
-        stride = self.model_params['stride']
-        pad_value = self.model_params['padValue']
-        resized_img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
-        padded_resized_img, pad = self._pad_right_down_corner(resized_img, stride, pad_value)
+        stride = self.settings.stride
+        pad_value = self.settings.pad_value
+        with stats.span('resize'):
+            resized_img = cv2.resize(img, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+            padded_resized_img, pad = self._pad_right_down_corner(resized_img, stride, pad_value)
 
         input_img = padded_resized_img[np.newaxis, :, :, :]
-        t = time()
-        output_blobs = self.model.predict(input_img)
-        print('inference: ', time() - t)
+        with stats.span('model_forward'):
+            output_blobs = self.model.predict(input_img)
         return output_blobs, padded_resized_img, pad
 
     @staticmethod
-    def _get_heatmap(output_blobs, stride, padded_resized_shape, img_shape, pad):
-        heatmap = np.squeeze(output_blobs[1])
-        heatmap = cv2.resize(heatmap,
-                             (0, 0),
-                             fx=stride,
-                             fy=stride,
-                             interpolation=cv2.INTER_CUBIC)
-        heatmap = heatmap[:padded_resized_shape[0] - pad[2],
-                          :padded_resized_shape[1] - pad[3],
-                          :]
-        heatmap = cv2.resize(heatmap,
-                             (img_shape[1], img_shape[0]),
-                             interpolation=cv2.INTER_CUBIC)
-        return heatmap
+    def _get_heatmap(output_blobs, stride, padded_resized_shape, img_shape, pad, postprocess_stride=1):
+        return OpenPose._resize_output(output_blobs[1], stride, padded_resized_shape, img_shape, pad,
+                                       postprocess_stride)
+
+    @staticmethod
+    def _get_paf(output_blobs, stride, padded_resized_shape, img_shape, pad, postprocess_stride=1):
+        return OpenPose._resize_output(output_blobs[0], stride, padded_resized_shape, img_shape, pad,
+                                       postprocess_stride)
+
+    @staticmethod
+    def _resize_output(output, stride, padded_resized_shape, img_shape, pad, postprocess_stride):
+        """Resizes a network output to 1 / postprocess_stride of the image size and removes the padding."""
+
+        with stats.span('resize'):
+            output = np.squeeze(output)
+            factor = stride / postprocess_stride
+            if factor != 1:
+                output = cv2.resize(output,
+                                    (0, 0),
+                                    fx=factor,
+                                    fy=factor,
+                                    interpolation=cv2.INTER_CUBIC)
+            output = output[:int(round((padded_resized_shape[0] - pad[2]) / postprocess_stride)),
+                            :int(round((padded_resized_shape[1] - pad[3]) / postprocess_stride)),
+                            :]
+            map_h, map_w = OpenPose._get_map_shape(img_shape, postprocess_stride)
+            output = cv2.resize(output, (map_w, map_h), interpolation=cv2.INTER_CUBIC)
+        return output
 
     @staticmethod
-    def _get_paf(output_blobs, stride, padded_resized_shape, img_shape, pad):
-        paf = np.squeeze(output_blobs[0])  # output 0 is PAFs
-        paf = cv2.resize(paf,
-                         (0, 0),
-                         fx=stride,
-                         fy=stride,
-                         interpolation=cv2.INTER_CUBIC)
-        paf = paf[:padded_resized_shape[0] - pad[2],
-                  :padded_resized_shape[1] - pad[3],
-                  :]
-        paf = cv2.resize(paf, (img_shape[1], img_shape[0]), interpolation=cv2.INTER_CUBIC)
-        return paf
+    def _get_map_shape(img_shape, postprocess_stride):
+        return (max(1, int(round(img_shape[0] / postprocess_stride))),
+                max(1, int(round(img_shape[1] / postprocess_stride))))
+
+    @staticmethod
+    def _scale_peaks(all_peaks, scale_x, scale_y):
+        """Maps peaks from map pixel to image pixel coordinates, pixel centers onto pixel centers."""
+
+        return [[((x + 0.5) * scale_x - 0.5, (y + 0.5) * scale_y - 0.5, score, i) for x, y, score, i in part_peaks]
+                for part_peaks in all_peaks]
 
     @staticmethod
     def _pad_right_down_corner(img, stride, pad_value):
@@ -790,7 +1096,9 @@ class OpenPoseModelV2:
                  paf_stages=5,
                  cm_stages=1,
                  np_paf=38,
-                 np_cm=19):
+                 np_cm=19,
+                 backbone_width=1.0,
+                 stage_width=128):
         """OpenPose model definition proposed in arXiv:1812.08008v2
 
         :param input_shape: (height, width, n_channels)
@@ -798,19 +1106,29 @@ class OpenPoseModelV2:
         :param cm_stages: int - number of blocks for key-point heat-maps, i.e. confidence maps
         :param np_paf: int - number of channels for part affinity fields
         :param np_cm: int - number of channels for confidence maps, i.e. number of joints plus 1 for background
+        :param backbone_width: float - multiplier for the number of filters of the VGG front, e.g. 0.5 for half width
+        :param stage_width: int - number of filters of the convolutions inside PAF and confidence map blocks
 
         Note: Input image must be RGB(0, 255)
+        Note: Layers are named like the BODY_25 Caffe model, stages are counted from 0, L2 are PAF blocks and L1
+              confidence map blocks.
         """
 
-        # TODO: Correct naming to be compatible with pre-trained model
-
         self.input_shape = input_shape
         self.paf_stages = paf_stages
         self.cm_stages = cm_stages
         self.np_paf = np_paf
         self.np_cm = np_cm
+        self.backbone_width = backbone_width
+        self.stage_width = stage_width
+
+    def create_model(self, intermediate_outputs=False):
+        """Returns the model with outputs [paf, cm].
+
+        If intermediate_outputs is True, outputs of all stages are returned for intermediate supervision, i.e.
+        paf_stages PAF outputs followed by cm_stages confidence map outputs.
+        """
 
-    def create_model(self):
         input_tensor = tfkl.Input(self.input_shape)  # Input must be RGB and (0, 255
         normalized_input = tfkl.Lambda(lambda x: x / 256 - 0.5)(input_tensor)  # [-0.5, 0.5]
 
@@ -818,97 +1136,107 @@ class OpenPoseModelV2:
         initial_features = self._vgg_block(normalized_input)
 
         # PAF blocks
-        paf_out = self._paf_block(initial_features, self.np_paf, 1)
+        paf_out = self._paf_block(initial_features, 0)
+        paf_outputs = [paf_out]
 
-        for paf_stage in range(2, self.paf_stages + 1):
+        for paf_stage in range(1, self.paf_stages):
             concat = tfkl.Concatenate(axis=-1)([initial_features, paf_out])
-            paf_out = self._paf_block(concat, self.np_paf, paf_stage)
+            paf_out = self._paf_block(concat, paf_stage)
+            paf_outputs.append(paf_out)
 
         # Confidence maps blocks
         cm_input = tfkl.Concatenate(axis=-1)([initial_features, paf_out])
-        cm_out = self._cm_block(cm_input, self.np_cm, 1)
+        cm_out = self._cm_block(cm_input, 0)
+        cm_outputs = [cm_out]
 
-        for cm_stage in range(2, self.cm_stages + 1):
+        for cm_stage in range(1, self.cm_stages):
             concat = tfkl.Concatenate(axis=-1)([cm_input, cm_out])
-            cm_out = self._cm_block(concat, self.np_cm, cm_stage)
+            cm_out = self._cm_block(concat, cm_stage)
+            cm_outputs.append(cm_out)
 
-        model = tfk.Model(input_tensor, [paf_out, cm_out])
+        if intermediate_outputs:
+            model = tfk.Model(input_tensor, paf_outputs + cm_outputs)
+        else:
+            model = tfk.Model(input_tensor, [paf_out, cm_out])
         return model
 
     def _vgg_block(self, x):
         # Block 1
-        x = self._conv(x, 64, 3, "conv1_1")
+        x = self._conv(x, self._backbone_filters(64), 3, "conv1_1")
         x = self._relu(x)
-        x = self._conv(x, 64, 3, "conv1_2")
+        x = self._conv(x, self._backbone_filters(64), 3, "conv1_2")
         x = self._relu(x)
         x = self._pooling(x, 2, 2, "pool1_1")
 
         # Block 2
-        x = self._conv(x, 128, 3, "conv2_1")
+        x = self._conv(x, self._backbone_filters(128), 3, "conv2_1")
         x = self._relu(x)
-        x = self._conv(x, 128, 3, "conv2_2")
+        x = self._conv(x, self._backbone_filters(128), 3, "conv2_2")
         x = self._relu(x)
         x = self._pooling(x, 2, 2, "pool2_1")
 
         # Block 3
-        x = self._conv(x, 256, 3, "conv3_1")
+        x = self._conv(x, self._backbone_filters(256), 3, "conv3_1")
         x = self._relu(x)
-        x = self._conv(x, 256, 3, "conv3_2")
+        x = self._conv(x, self._backbone_filters(256), 3, "conv3_2")
         x = self._relu(x)
-        x = self._conv(x, 256, 3, "conv3_3")
+        x = self._conv(x, self._backbone_filters(256), 3, "conv3_3")
         x = self._relu(x)
-        x = self._conv(x, 256, 3, "conv3_4")
+        x = self._conv(x, self._backbone_filters(256), 3, "conv3_4")
         x = self._relu(x)
         x = self._pooling(x, 2, 2, "pool3_1")
 
         # Block 4
-        x = self._conv(x, 512, 3, "conv4_1")
+        x = self._conv(x, self._backbone_filters(512), 3, "conv4_1")
         x = self._relu(x)
-        x = self._conv(x, 512, 3, "conv4_2")
+        x = self._conv(x, self._backbone_filters(512), 3, "conv4_2")
         x = self._relu(x)
 
         # Additional non vgg layers
-        x = self._conv(x, 256, 3, "conv4_3_CPM")
+        x = self._conv(x, self._backbone_filters(256), 3, "conv4_3_CPM")
         x = self._relu(x)
-        x = self._conv(x, 128, 3, "conv4_4_CPM")
+        x = self._conv(x, self._backbone_filters(128), 3, "conv4_4_CPM")
         x = self._relu(x)
         return x
 
     def _paf_block(self, x, stage):
-        x = self._res_conv(x, "Mconv1_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv2_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv3_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv4_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv5_stage%d" % (stage))
-        x = self._conv(x, 128, 1, "Mconv6_stage%d" % (stage))
+        x = self._res_conv(x, "Mconv1_stage%d_L2" % (stage))
+        x = self._res_conv(x, "Mconv2_stage%d_L2" % (stage))
+        x = self._res_conv(x, "Mconv3_stage%d_L2" % (stage))
+        x = self._res_conv(x, "Mconv4_stage%d_L2" % (stage))
+        x = self._res_conv(x, "Mconv5_stage%d_L2" % (stage))
+        x = self._conv(x, self.stage_width, 1, "Mconv6_stage%d_L2" % (stage))
         x = self._relu(x)
-        x = self._conv(x, self.np_paf, 1, "Mconv7_stage%d" % (stage))
+        x = self._conv(x, self.np_paf, 1, "Mconv7_stage%d_L2" % (stage))
         return x
 
     def _cm_block(self, x, stage):
-        x = self._res_conv(x, "Mconv1_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv2_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv3_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv4_stage%d" % (stage))
-        x = self._res_conv(x, "Mconv5_stage%d" % (stage))
-        x = self._conv(x, 128, 1, "Mconv6_stage%d" % (stage))
+        x = self._res_conv(x, "Mconv1_stage%d_L1" % (stage))
+        x = self._res_conv(x, "Mconv2_stage%d_L1" % (stage))
+        x = self._res_conv(x, "Mconv3_stage%d_L1" % (stage))
+        x = self._res_conv(x, "Mconv4_stage%d_L1" % (stage))
+        x = self._res_conv(x, "Mconv5_stage%d_L1" % (stage))
+        x = self._conv(x, self.stage_width, 1, "Mconv6_stage%d_L1" % (stage))
         x = self._relu(x)
-        x = self._conv(x, self.np_cm, 1, "Mconv7_stage%d" % (stage))
+        x = self._conv(x, self.np_cm, 1, "Mconv7_stage%d_L1" % (stage))
         return x
 
     def _res_conv(self, x, name):
-        out1 = self._conv(x, 128, 3, name + str(1))
+        out1 = self._conv(x, self.stage_width, 3, name + '_0')
         out1 = self._relu(out1)
 
-        out2 = self._conv(out1, 128, 3, name + str(2))
+        out2 = self._conv(out1, self.stage_width, 3, name + '_1')
         out2 = self._relu(out2)
 
-        out3 = self._conv(out2, 128, 3, name + str(3))
+        out3 = self._conv(out2, self.stage_width, 3, name + '_2')
         out3 = self._relu(out3)
 
         out = tfkl.Concatenate(axis=-1)([out1, out2, out3])
         return out
 
+    def _backbone_filters(self, nf):
+        return max(8, int(round(nf * self.backbone_width)))
+
     @staticmethod
     def _conv(x, nf, ks, name):
         out = tfkl.Conv2D(nf, (ks, ks), padding='same', name=name)(x)
@@ -941,12 +1269,49 @@ class FastOpenPose:
                  weights_path,
                  config_path,
                  input_shape=(184, 184),
-                 gaussian_filtering=True):
+                 gaussian_filtering=True,
+                 tflite_path=None,
+                 num_threads=None,
+                 max_peaks=None,
+                 subpixel=None,
+                 openpose_raw=None,
+                 motion_gate=None,
+                 cache=None):
+        """Fast OpenPose inference.
+
+        :param max_peaks: int - the model returns at most this many peaks per part, as a (batch, 18, max_peaks, 3)
+            array of x, y and score, instead of the dense masked heatmap; 0 returns the dense heatmap, None takes
+            max_peaks of the [performance] config section, 32 if it is not set
+        :param subpixel: str - optional in-graph sub-pixel peak refinement, one of subpixel_methods, needs max_peaks
+        :param tflite_path: str - optional path to a graph exported by export.TFLiteExporter, if given the TFLite
+            interpreter is used instead of the Keras model
+        :param num_threads: int - number of threads for the TFLite interpreter, None takes num_threads of the config
+        :param openpose_raw: keras.Model - an OpenPoseModel with loaded weights to wrap instead of creating one, lets
+            graphs of several input shapes share one set of weights
+        :param motion_gate: motion.MotionGate - optional, _inference reuses the last result for static frames
+        :param cache: cache.ResultCache - optional, results and target features of images and poses seen before are
+            reused
+        """
+
+        settings = Settings.load(config_path)
+        if max_peaks is None:
+            max_peaks = 32 if settings.max_peaks is None else settings.max_peaks
+        if num_threads is None:
+            num_threads = settings.num_threads
+        self.settings = settings
         self.openpose_model = FastOpenPoseModel(weights_path,
                                                 config_path,
                                                 input_shape,
-                                                gaussian_filtering)
-        self.model = self.openpose_model.load_model()
+                                                gaussian_filtering,
+                                                max_peaks or None,
+                                                subpixel)
+        if tflite_path is None:
+            self.model = self.openpose_model.load_model(openpose_raw)
+        else:
+            self.model = TFLiteModel(tflite_path, num_threads)
+        self.motion_gate = motion_gate
+        self.cache = cache
+        self.tflite_path = tflite_path
         self.fe = FeatureExtractor()
         self.n_joints = 18
         self.n_limbs = 17
@@ -954,14 +1319,13 @@ class FastOpenPose:
     def compare_draw(self, img, target_kps, th=5):
         correct_color = OpenPose.colors[9]
         wrong_color = [0, 0, 255]
-        target_features = self.fe.generate_features(target_kps)
+        target_features = self._target_features(target_kps)
 
         org_h, org_w, _ = img.shape
 
-        resized = tf.image.resize_with_pad(img, self.openpose_model.input_h, self.openpose_model.input_w).numpy()
-        t = time()
+        with stats.span('resize'):
+            resized = tf.image.resize_with_pad(img, self.openpose_model.input_h, self.openpose_model.input_w).numpy()
         peaks, subset, candidate = self._inference(resized)
-        print('complete inference: ', time() - t)
 
         if not subset.any():
             return img
@@ -974,24 +1338,23 @@ class FastOpenPose:
         drawed = img.copy()
 
         for person in subset:
-            t = time()
-            kps = self._extract_keypoints(person, transformed_candidate)
-            print('KP extraction: ', time() - t)
-            t = time()
-            features = self.fe.generate_features(kps)
-            print('Feature generation: ', time() - t)
+            with stats.span('features'):
+                kps = self._extract_keypoints(person, transformed_candidate)
+                features = self.fe.generate_features(kps)
 
             # self._draw_kps(drawed, kps, correct_color)
 
-            t = time()
-            drawed = self._draw_errors(drawed, features, target_features, kps, th, wrong_color)
-            print('Error drawing: ', time() - t)
+            with stats.span('drawing'):
+                drawed = self._draw_errors(drawed, features, target_features, kps, th, wrong_color)
 
-            # t = time()
             # drawed = self._draw_connections(drawed, person, transformed_candidate)
-            # print('Connections drawing: ', time() - t)
         return drawed
 
+    def _target_features(self, target_kps):
+        if self.cache is None:
+            return self.fe.generate_features(target_kps)
+        return self.cache.features(self.fe, target_kps)
+
     @staticmethod
     def _draw_kps(img, kps, color):
         for kp in kps:
@@ -1000,10 +1363,11 @@ class FastOpenPose:
 
     def _draw_errors(self, img, features, target_features, kps, threshold, color):
         x_min, y_min, x_max, y_max = self._get_ul_lr(kps)
-        diag = np.sqrt(np.power(x_max - x_min, 2) + np.power(y_max - y_min, 2)).astype(np.int)
+        diag = np.sqrt(np.power(x_max - x_min, 2) + np.power(y_max - y_min, 2)).astype(int)
         max_radius = diag // 4
         errors = list()
-        failure_overlay = img.copy()
+        renderer = PoseRenderer.shared()
+        img = renderer.prepare_output(img)
         for i in range(len(features)):
             f = features[i]
             ft = target_features[i]
@@ -1021,51 +1385,20 @@ class FastOpenPose:
                     #             (255, 255, 255),
                     #             2)
 
-                    cv2.circle(failure_overlay, (int(kp[0]), int(kp[1])), radius, color, thickness=-1)
+                    renderer.add_circle((kp[0], kp[1]), radius, color)
 
         if len(errors) == 0:
-            cv2.putText(failure_overlay,
-                        "That's it :D",
-                        (x_min, max(y_min - diag // 10, 10)),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        1,
-                        (0, 255, 0),
-                        2)
+            renderer.add_text("That's it :D", (x_min, max(y_min - diag // 10, 10)), (0, 255, 0))
         else:
-            cv2.putText(failure_overlay,
-                        'Do it better!',
-                        (x_min, max(y_min - diag // 10, 10)),
-                        cv2.FONT_HERSHEY_SIMPLEX,
-                        1,
-                        (0, 0, 255),
-                        2)
-
-        drawed = cv2.addWeighted(img, 0.4, failure_overlay, 0.6, 0)
-        return drawed
+            renderer.add_text('Do it better!', (x_min, max(y_min - diag // 10, 10)), (0, 0, 255))
 
-    def _draw_connections(self, img, person, transformed_candidate):
+        return renderer.blend(img)
 
-        stick_width = 4
-
-        for i in range(self.n_limbs):
-            index = person[np.array(OpenPose.limb_seq[i]) - 1]
-            if -1 in index:
-                continue
-            cur_canvas = img.copy()
-            y = transformed_candidate[index.astype(int), 0]
-            x = transformed_candidate[index.astype(int), 1]
-            m_x = np.mean(x)
-            m_y = np.mean(y)
-            length = np.sqrt(np.power(x[0] - x[1], 2) + np.power(y[0] - y[1], 2))
-            angle = np.degrees(np.arctan2(x[0] - x[1], y[0] - y[1]))
-            polygon = cv2.ellipse2Poly((int(m_y), int(m_x)),
-                                       (int(length / 2), stick_width),
-                                       int(angle),
-                                       0,
-                                       360, 1)
-            cv2.fillConvexPoly(cur_canvas, polygon, OpenPose.colors[i])
-            img = cv2.addWeighted(img, 0.4, cur_canvas, 0.6, 0)
-        return img
+    def _draw_connections(self, img, person, transformed_candidate, out=None):
+        renderer = PoseRenderer.shared()
+        img = renderer.prepare_output(img, out)
+        renderer.add_limbs(person[np.newaxis], transformed_candidate, self.n_limbs)
+        return renderer.blend(img)
 
     @staticmethod
     def _get_ul_lr(kps):
@@ -1084,11 +1417,11 @@ class FastOpenPose:
     def _extract_keypoints(self, person_subset, candidate_arr):
         kps = list()
         for i in range(self.n_joints):
-            kp_ind = person_subset[i].astype(np.int)
+            kp_ind = person_subset[i].astype(int)
             if kp_ind == -1:
                 kps.append(None)
             else:
-                kps.append(candidate_arr[kp_ind, 0: 2].astype(np.int))
+                kps.append(candidate_arr[kp_ind, 0: 2].astype(int))
         return kps
 
     def draw_pose(self, img):
@@ -1109,96 +1442,176 @@ class FastOpenPose:
     def _inference(self, img):
         """Img must be of shape (self.box_size // 2, self.box_size // 2), i.e. (184, 184)."""
 
-        paf, masked_heatmap = self.model.predict(np.expand_dims(img, axis=0))
-        all_peaks = self._get_peaks(masked_heatmap)
-        connection_all, special_k = self._get_connections(paf[0], all_peaks)
-        subset, candidate = self._get_subset(all_peaks, special_k, connection_all)
+        if self.motion_gate is not None:
+            with stats.span('motion_gate'):
+                result = self.motion_gate.lookup(img)
+            if result is not None:
+                return result
+
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(img, self._cache_tag('result'))
+            value = self.cache.get(key)
+            if value is not None:
+                result = self._unpack_result(value)
+        if key is None or value is None:
+            with stats.span('model_forward'):
+                paf, peaks = self.model.predict(np.expand_dims(img, axis=0))
+            result = self._post_process(paf[0], peaks)
+            if key is not None:
+                self.cache.put(key, OpenPose._pack_result(*result))
+        if self.motion_gate is not None:
+            self.motion_gate.store(result)
+        return result
+
+    def _cache_tag(self, kind):
+        """Everything besides the image the result of kind depends on."""
+
+        model = self.openpose_model
+        return ('FastOpenPose', kind, self.cache.file_signature(model.weights_path),
+                self.cache.file_signature(self.tflite_path), model.input_h, model.input_w,
+                model.gaussian_filtering, model.max_peaks, model.subpixel, model.thre1, self.settings.thre2,
+                self.settings.mid_num, self.settings.legacy_stages)
+
+    @staticmethod
+    def _unpack_result(value):
+        peaks = value['peaks'].astype(float_dtype)
+        return np.split(peaks, np.cumsum(value['counts'])[:-1]), value['subset'].copy(), value['candidate'].copy()
+
+    def _post_process(self, paf, peaks):
+        with stats.span('peaks'):
+            all_peaks = self._get_peaks(peaks)
+        with stats.span('connections'):
+            connection_all, special_k = self._get_connections(paf, all_peaks)
+        with stats.span('subset'):
+            subset, candidate = self._get_subset(all_peaks, special_k, connection_all)
+        count_frame(all_peaks, connection_all, subset)
         return all_peaks, subset, candidate
 
+    def predict_batch(self, imgs):
+        """Runs the model over a batch of images of any size, batch_size of the config images at a time.
+
+        Returns a list with an array of shape (n_people, 18, 3) per image, holding x, y and score of every joint in
+        the image's coordinates, NaN for missing joints. With a cache only images not seen before reach the model.
+        """
+
+        if self.cache is None:
+            return self._predict_batch(imgs)
+
+        tag = self._cache_tag('keypoints')
+        keys = [self.cache.key(img, tag) for img in imgs]
+        values = [self.cache.get(key) for key in keys]
+        keypoints = [None if value is None else value['keypoints'].copy() for value in values]
+        todo = [i for i, value in enumerate(values) if value is None]
+        if todo:
+            for i, img_keypoints in zip(todo, self._predict_batch([imgs[i] for i in todo])):
+                self.cache.put(keys[i], {'keypoints': img_keypoints})
+                keypoints[i] = img_keypoints
+        return keypoints
+
+    def _predict_batch(self, imgs):
+        h, w = self.openpose_model.input_h, self.openpose_model.input_w
+        with stats.span('resize'):
+            batch = np.stack([tf.image.resize_with_pad(img, h, w).numpy() for img in imgs])
+        pafs, peaks = list(), list()
+        for start in range(0, len(batch), self.settings.batch_size):
+            with stats.span('model_forward'):
+                paf, peak = self.model.predict(batch[start: start + self.settings.batch_size])
+            pafs.extend(paf)
+            peaks.extend(peak)
+
+        keypoints = list()
+        for img, paf, img_peaks in zip(imgs, pafs, peaks):
+            all_peaks, subset, candidate = self._post_process(paf, img_peaks[np.newaxis])
+            if not subset.any():
+                keypoints.append(np.zeros((0, self.n_joints, 3), dtype=float_dtype))
+                continue
+            transformed_candidate = self.inverse_transform_kps(img.shape[0], img.shape[1], h, w, candidate)
+            keypoints.append(self.get_keypoints_array(subset, transformed_candidate, self.n_joints))
+        return keypoints
+
+    @staticmethod
+    def get_keypoints_array(subset, candidate, n_joints=18):
+        """Returns an array of shape (n_people, n_joints, 3) with x, y and score, NaN for missing joints."""
+
+        ids = subset[:, :n_joints].astype(int)
+        keypoints = candidate[ids, :3].astype(float_dtype)
+        keypoints[ids < 0] = np.nan
+        return keypoints
+
     @staticmethod
     def inverse_transform_kps(org_h, org_w, h, w, candidate):
-        kps = candidate[:, 0: 2].astype(np.int)
         scale_factor = np.max([org_h, org_w]) / h
-        transformed_candidate = np.zeros((candidate.shape[0], 3))
+        transformed_candidate = np.empty((candidate.shape[0], 3), dtype=float_dtype)
         if org_h > org_w:
             resized_w = org_w / scale_factor
             border = (w - resized_w) / 2
-            for i, kp in enumerate(kps):
-                transformed_candidate[i, 0] = scale_factor * (kp[0] - border)
-                transformed_candidate[i, 1] = scale_factor * kp[1]
-                transformed_candidate[i, 2] = candidate[i, 2]
+            transformed_candidate[:, 0] = scale_factor * (candidate[:, 0] - border)
+            transformed_candidate[:, 1] = scale_factor * candidate[:, 1]
         else:
             resized_h = org_h / scale_factor
             border = (h - resized_h) / 2
-            for i, kp in enumerate(kps):
-                transformed_candidate[i, 0] = scale_factor * kp[0]
-                transformed_candidate[i, 1] = scale_factor * (kp[1] - border)
-                transformed_candidate[i, 2] = candidate[i, 2]
+            transformed_candidate[:, 0] = scale_factor * candidate[:, 0]
+            transformed_candidate[:, 1] = scale_factor * (candidate[:, 1] - border)
+        transformed_candidate[:, 2] = candidate[:, 2]
         return transformed_candidate
 
     @staticmethod
-    def draw_inverse_transformed_parts(img, peaks, subset, transformed_candidate):
-        valid_indices = subset.flatten().astype(np.int).tolist()[: 18]
+    def draw_inverse_transformed_parts(img, peaks, subset, transformed_candidate, out=None):
+        """Draws key-points and limbs of all people into out, by default into img itself."""
+
+        renderer = PoseRenderer.shared()
+        img = renderer.prepare_output(img, out)
+        valid_indices = subset.flatten().astype(int).tolist()[: 18]
         for i in range(18):
-            for j in range(len(peaks[i])):
-                ind = peaks[i][j][-1]
+            for ind in peaks[i][:, 3].astype(int):
                 if ind in valid_indices:
                     c = transformed_candidate[ind]
                     cv2.circle(img, (int(c[0]), int(c[1])), 4, OpenPose.colors[i], thickness=-1)
 
-        stick_width = 4
-
-        for i in range(17):
-            for n in range(len(subset)):
-                index = subset[n][np.array(OpenPose.limb_seq[i]) - 1]
-                if -1 in index:
-                    continue
-                cur_canvas = img.copy()
-                y = transformed_candidate[index.astype(int), 0]
-                x = transformed_candidate[index.astype(int), 1]
-                m_x = np.mean(x)
-                m_y = np.mean(y)
-                length = np.sqrt(np.power(x[0] - x[1], 2) + np.power(y[0] - y[1], 2))
-                angle = np.degrees(np.arctan2(x[0] - x[1], y[0] - y[1]))
-                polygon = cv2.ellipse2Poly((int(m_y), int(m_x)),
-                                           (int(length / 2), stick_width),
-                                           int(angle),
-                                           0,
-                                           360,
-                                           1)
-                cv2.fillConvexPoly(cur_canvas, polygon, OpenPose.colors[i])
-                img = cv2.addWeighted(img, 0.4, cur_canvas, 0.6, 0)
-        return img
+        renderer.add_limbs(subset, transformed_candidate)
+        return renderer.blend(img)
 
     @staticmethod
-    def _get_peaks(masked_heatmap):
-        ys, xs, channels = np.nonzero(masked_heatmap[0])
+    def _get_peaks(peaks):
+        """Groups the peaks of one image by part.
 
-        all_peaks = list()
-        peak_counter = 0
-        for i in range(18):
-            indices = np.where(channels == i)[0]
-            n_peaks = len(indices)
-            peak_inds = range(peak_counter, peak_counter + n_peaks)
-            part_peaks = list()
-            for j, ind in enumerate(indices):
-                x = xs[ind]
-                y = ys[ind]
-                conf_score = masked_heatmap[0, y, x, i]
-                part_peaks.append((x, y, conf_score, peak_inds[j]))
-            all_peaks.append(part_peaks)
-            peak_counter = peak_counter + n_peaks
-        return all_peaks
+        :param peaks: second model output of one image, either the sparse (1, 18, max_peaks, 3) x, y and score with
+            zero scores as padding, or the dense (1, h, w, 19) masked heatmap
+        :return: list with an array of rows (x, y, score, id) per part, ids enumerate the peaks of all parts
+        """
+
+        if peaks.shape[-1] == 3:
+            valid = peaks[0, :, :, 2] > 0
+            rows = peaks[0][valid]
+            counts = valid.sum(axis=1)
+        else:
+            ys, xs, channels = np.nonzero(peaks[0, :, :, :18])
+            order = np.argsort(channels, kind='stable')
+            ys, xs, channels = ys[order], xs[order], channels[order]
+            rows = np.stack([xs, ys, peaks[0, ys, xs, channels]], axis=-1).astype(float_dtype)
+            counts = np.bincount(channels, minlength=18)
+
+        rows = np.concatenate([rows, np.arange(len(rows), dtype=rows.dtype)[:, np.newaxis]], axis=-1)
+        return np.split(rows, np.cumsum(counts)[:-1])
 
     def _get_connections(self, paf, all_peaks):
+        settings = self.settings
+        if 'connections' in settings.legacy_stages:
+            return self._get_connections_legacy(paf, all_peaks)
+        return OpenPose._get_connections(paf, all_peaks, settings.thre2, self.openpose_model.input_h,
+                                         settings.mid_num)
+
+    def _get_connections_legacy(self, paf, all_peaks):
         connection_all = []
         special_k = []
-        mid_num = 10
+        mid_num = self.settings.mid_num
 
         for k in range(len(OpenPose.map_idx)):
             score_mid = paf[:, :, [x - 19 for x in OpenPose.map_idx[k]]]
-            cand_a = all_peaks[OpenPose.limb_seq[k][0] - 1]
-            cand_b = all_peaks[OpenPose.limb_seq[k][1] - 1]
+            # limb scores are scalars, float64 keeps ties between equally good limbs independent of float_dtype
+            cand_a = all_peaks[OpenPose.limb_seq[k][0] - 1].astype(np.float64)
+            cand_b = all_peaks[OpenPose.limb_seq[k][1] - 1].astype(np.float64)
             n_a = len(cand_a)
             n_b = len(cand_b)
             if n_a != 0 and n_b != 0:
@@ -1233,73 +1646,26 @@ class FastOpenPose:
                                                          score_with_dist_prior + cand_a[i][2] + cand_b[j][2]])
 
                 connection_candidate = sorted(connection_candidate, key=lambda x: x[2], reverse=True)
-                connection = np.zeros((0, 5))
-                for c in range(len(connection_candidate)):
-                    i, j, s = connection_candidate[c][0:3]
-                    if i not in connection[:, 3] and j not in connection[:, 4]:
-                        connection = np.vstack([connection, [cand_a[i][3], cand_b[j][3], s, i, j]])
+                connection = list()
+                used_a, used_b = set(), set()
+                for i, j, s, _ in connection_candidate:
+                    if i not in used_a and j not in used_b:
+                        connection.append([cand_a[i][3], cand_b[j][3], s, i, j])
+                        used_a.add(i)
+                        used_b.add(j)
                         if len(connection) >= min(n_a, n_b):
                             break
 
-                connection_all.append(connection)
+                connection_all.append(OpenPose._connection_arrays(connection))
             else:
                 special_k.append(k)
-                connection_all.append([])
+                connection_all.append(OpenPose._connection_arrays([]))
         return connection_all, special_k
 
     @staticmethod
     def _get_subset(all_peaks, special_k, connection_all):
-        subset = -1 * np.ones((0, 20))
-        candidate = np.array([item for sublist in all_peaks for item in sublist])
-
-        for k in range(len(OpenPose.map_idx)):
-            if k not in special_k:
-                part_as = connection_all[k][:, 0]
-                part_bs = connection_all[k][:, 1]
-                index_a, index_b = np.array(OpenPose.limb_seq[k]) - 1
-
-                for i in range(len(connection_all[k])):  # = 1:size(temp,1)
-                    found = 0
-                    subset_idx = [-1, -1]
-                    for j in range(len(subset)):  # 1:size(subset,1):
-                        if subset[j][index_a] == part_as[i] or subset[j][index_b] == part_bs[i]:
-                            subset_idx[found] = j
-                            found += 1
-
-                    if found == 1:
-                        j = subset_idx[0]
-                        if subset[j][index_b] != part_bs[i]:
-                            subset[j][index_b] = part_bs[i]
-                            subset[j][-1] += 1
-                            subset[j][-2] += candidate[part_bs[i].astype(int), 2] + connection_all[k][i][2]
-                    elif found == 2:  # if found 2 and disjoint, merge them
-                        j1, j2 = subset_idx
-                        membership = ((subset[j1] >= 0).astype(int) + (subset[j2] >= 0).astype(int))[:-2]
-                        if len(np.nonzero(membership == 2)[0]) == 0:  # merge
-                            subset[j1][:-2] += (subset[j2][:-2] + 1)
-                            subset[j1][-2:] += subset[j2][-2:]
-                            subset[j1][-2] += connection_all[k][i][2]
-                            subset = np.delete(subset, j2, 0)
-                        else:  # as like found == 1
-                            subset[j1][index_b] = part_bs[i]
-                            subset[j1][-1] += 1
-                            subset[j1][-2] += candidate[part_bs[i].astype(int), 2] + connection_all[k][i][2]
-
-                    # if find no partA in the subset, create a new subset
-                    elif not found and k < 17:
-                        row = -1 * np.ones(20)
-                        row[index_a] = part_as[i]
-                        row[index_b] = part_bs[i]
-                        row[-1] = 2
-                        row[-2] = sum(candidate[connection_all[k][i, :2].astype(int), 2]) + connection_all[k][i][2]
-                        subset = np.vstack([subset, row])
-
-        # delete some rows of subset which has few parts occur
-        delete_idx = []
-        for i in range(len(subset)):
-            if subset[i][-1] < 4 or subset[i][-2] / subset[i][-1] < 0.4:
-                delete_idx.append(i)
-        subset = np.delete(subset, delete_idx, axis=0)
+        candidate = np.concatenate(all_peaks).astype(float_dtype, copy=False)
+        subset, _ = OpenPose._group_people(candidate, special_k, connection_all)
         return subset, candidate
 
 
@@ -1309,51 +1675,38 @@ class FastOpenPoseModel:
                  weights_path,
                  config_path,
                  input_shape,
-                 gaussian_filtering):
+                 gaussian_filtering,
+                 max_peaks=None,
+                 subpixel=None):
+        if subpixel is not None and max_peaks is None:
+            raise ValueError('Sub-pixel refinement needs the sparse peak output, set max_peaks.')
+        if subpixel is not None and subpixel not in subpixel_methods:
+            raise ValueError('subpixel must be one of {}, got {}'.format(subpixel_methods, subpixel))
         self.weights_path = weights_path
         self.config_path = config_path
-        self.params, self.model_params = self._read_config()
-        self.stride = self.model_params['stride']
-        self.pad_value = self.model_params['padValue']
-        self.box_size = self.model_params['boxsize']
+        self.settings = Settings.load(config_path)
+        self.stride = self.settings.stride
+        self.pad_value = self.settings.pad_value
+        self.box_size = self.settings.box_size
         self.input_h, self.input_w = input_shape
-        self.thre1 = self.params['thre1']
-        self.thre2 = self.params['thre2']
+        self.thre1 = self.settings.thre1
+        self.thre2 = self.settings.thre2
         self.model = None
         self.gaussian_filtering = gaussian_filtering
+        self.max_peaks = max_peaks
+        self.subpixel = subpixel
 
-    def load_model(self):
-        self.model = self._create_model()
+    def load_model(self, openpose_raw=None):
+        self.model = self._create_model(openpose_raw)
         print('Model loaded successfully')
         return self.model
 
-    def _read_config(self):
-        config = ConfigObj(self.config_path)
-        param = config['param']
-        model_id = param['modelID']
-        model = config['models'][model_id]
-        model['boxsize'] = int(model['boxsize'])
-        model['stride'] = int(model['stride'])
-        model['padValue'] = int(model['padValue'])
-        param['octave'] = int(param['octave'])
-        param['use_gpu'] = int(param['use_gpu'])
-        param['starting_range'] = float(param['starting_range'])
-        param['ending_range'] = float(param['ending_range'])
-        param['scale_search'] = list(map(float, param['scale_search']))
-        param['thre1'] = float(param['thre1'])
-        param['thre2'] = float(param['thre2'])
-        param['thre3'] = float(param['thre3'])
-        param['mid_num'] = int(param['mid_num'])
-        param['min_num'] = int(param['min_num'])
-        param['crop_ratio'] = float(param['crop_ratio'])
-        param['bbox_ratio'] = float(param['bbox_ratio'])
-        param['GPUdeviceNumber'] = int(param['GPUdeviceNumber'])
-        return param, model
-
-    def _create_model(self):
-        openpose_model = OpenPoseModel()
-        openpose_raw = openpose_model.create_model()
-        openpose_raw.load_weights(self.weights_path)
+    def _create_model(self, openpose_raw=None):
+        if openpose_raw is None:
+            openpose_model = OpenPoseModel()
+            openpose_raw = openpose_model.create_model()
+            if self.weights_path is not None:  # randomly initialized, e.g. for benchmarks
+                openpose_raw.load_weights(self.weights_path)
 
         input_tensor = tfkl.Input(shape=(self.input_h, self.input_w, 3))
         x = openpose_raw(input_tensor)
@@ -1381,10 +1734,48 @@ class FastOpenPoseModel:
         binary_hm = tf.reduce_all(stacked, axis=-1)
 
         masked_hm = tf.multiply(tf.cast(binary_hm, tf.float32), hm)
+        if self.max_peaks is None:
+            return tfk.Model(input_tensor, [paf, masked_hm])
+
+        # top max_peaks of every part as (x, y, score), everything but the peaks is zero after the NMS
+        scores, flat_indices = tf.math.top_k(self._flatten_parts(masked_hm), k=self.max_peaks)
+        xs = tf.cast(tf.math.floormod(flat_indices, self.input_w), tf.float32)
+        ys = tf.cast(tf.math.floordiv(flat_indices, self.input_w), tf.float32)
+
+        if self.subpixel is not None:
+            dx, dy = self._subpixel_offset_maps(hm, slice1, slice2, slice3, slice4)
+            xs = tf.clip_by_value(xs + tf.gather(self._flatten_parts(dx), flat_indices, batch_dims=2),
+                                  0, self.input_w - 1)
+            ys = tf.clip_by_value(ys + tf.gather(self._flatten_parts(dy), flat_indices, batch_dims=2),
+                                  0, self.input_h - 1)
 
-        model = tfk.Model(input_tensor, [paf, masked_hm])
+        peaks = tf.stack([xs, ys, scores], axis=-1)
+
+        model = tfk.Model(input_tensor, [paf, peaks])
         return model
 
+    def _subpixel_offset_maps(self, hm, up, down, left, right):
+        """Per pixel x and y offsets of a peak at that pixel, in-graph equivalent of subpixel_offsets."""
+
+        if self.subpixel == 'quadratic':
+            dx = tf.math.divide_no_nan(right - left, 2 * tf.nn.relu(2 * hm - left - right))
+            dy = tf.math.divide_no_nan(down - up, 2 * tf.nn.relu(2 * hm - up - down))
+        else:
+            weights = tf.nn.relu(hm)
+            kernels = np.stack([np.tile([[-1., 0., 1.]], (3, 1)),
+                                np.tile([[-1.], [0.], [1.]], (1, 3)),
+                                np.ones((3, 3))])
+            kernels = np.tile(kernels.transpose(1, 2, 0)[:, :, np.newaxis, :], (1, 1, 19, 1)).astype(np.float32)
+            moments = tf.nn.depthwise_conv2d(weights, kernels, [1, 1, 1, 1], 'SAME')
+            dx = tf.math.divide_no_nan(moments[..., 0::3], moments[..., 2::3])
+            dy = tf.math.divide_no_nan(moments[..., 1::3], moments[..., 2::3])
+        return tf.clip_by_value(dx, -0.5, 0.5), tf.clip_by_value(dy, -0.5, 0.5)
+
+    def _flatten_parts(self, maps):
+        """(batch, h, w, 19) -> (batch, 18, h * w), dropping the background channel."""
+
+        return tf.reshape(tf.transpose(maps[..., :18], perm=(0, 3, 1, 2)), (-1, 18, self.input_h * self.input_w))
+
     @staticmethod
     def _get_gaussian_kernel(mean=0, sigma=3):
         size = sigma * 3
@@ -1394,6 +1785,247 @@ class FastOpenPoseModel:
         return gauss_kernel
 
 
+class HourglassPose:
+
+    """Single person pose estimation with StackedHourglassNetwork, decoded in-graph without peak grouping.
+
+    Every joint is the argmax or the soft-argmax of its heatmap, computed by the model itself, so post-processing
+    reduces to mapping n_parts coordinates back to the image; there is no _get_connections or _get_subset. Use like
+    this:
+        pose = HourglassPose(weights_path, n_stacks=2)
+        keypoints = pose.predict_batch(frames)
+    """
+
+    decoders = ('argmax', 'soft_argmax')
+
+    def __init__(self,
+                 weights_path,
+                 input_shape=(256, 256),
+                 n_stacks=2,
+                 n_filters=128,
+                 n_parts=16,
+                 decoder='argmax',
+                 beta=50.,
+                 thre=0.1):
+        """
+        :param weights_path: str - weights of a StackedHourglassNetwork of the same configuration, e.g. trained with
+            train.Trainer on MPII, None initializes randomly
+        :param decoder: str - one of decoders. soft_argmax is the softmax weighted mean of the pixel coordinates,
+            which is sub-pixel accurate and differentiable
+        :param beta: float - softmax temperature of soft_argmax, higher values approach the argmax
+        :param thre: float - joints whose heatmap maximum is below thre are missing
+        """
+
+        if decoder not in self.decoders:
+            raise ValueError('decoder must be one of {}, got {}'.format(self.decoders, decoder))
+        self.input_h, self.input_w = input_shape
+        self.model_def = StackedHourglassNetwork((self.input_h, self.input_w, 3), n_stacks, n_filters,
+                                                 n_parts=n_parts)
+        self.n_parts = n_parts
+        self.decoder = decoder
+        self.beta = beta
+        self.thre = thre
+        self.weights_path = weights_path
+        self.model = self._create_model()
+
+    def predict_batch(self, imgs):
+        """Runs the model once over a batch of BGR images of any size.
+
+        Returns a list with an array of shape (1, n_parts, 3) per image, holding x, y and score of every joint in the
+        image's coordinates, NaN for missing joints, or of shape (0, n_parts, 3) if all joints are missing.
+        """
+
+        with stats.span('resize'):
+            batch = np.stack([tf.image.resize_with_pad(img[:, :, ::-1], self.input_h, self.input_w).numpy()
+                              for img in imgs])
+        with stats.span('model_forward'):
+            joints = self.model.predict(batch, verbose=0)
+
+        keypoints = list()
+        for img, img_joints in zip(imgs, joints):
+            visible = img_joints[:, 2] >= self.thre
+            if not visible.any():
+                keypoints.append(np.zeros((0, self.n_parts, 3), dtype=float_dtype))
+                continue
+            kps = FastOpenPose.inverse_transform_kps(img.shape[0], img.shape[1], self.input_h, self.input_w,
+                                                     img_joints)
+            kps[~visible] = np.nan
+            keypoints.append(kps[np.newaxis])
+        return keypoints
+
+    def _create_model(self):
+        hourglass = self.model_def.create_model()
+        if self.weights_path is not None:  # randomly initialized, e.g. for benchmarks
+            hourglass.load_weights(self.weights_path)
+
+        input_tensor = tfkl.Input(shape=(self.input_h, self.input_w, 3))
+        hm = hourglass(input_tensor)
+        stride = self.model_def.stride
+        map_h, map_w = self.input_h // stride, self.input_w // stride
+        flat = tf.reshape(tf.transpose(hm, perm=(0, 3, 1, 2)), (-1, self.n_parts, map_h * map_w))
+        scores = tf.reduce_max(flat, axis=-1)
+
+        if self.decoder == 'argmax':
+            indices = tf.argmax(flat, axis=-1, output_type=tf.int32)
+            xs = tf.cast(tf.math.floormod(indices, map_w), tf.float32)
+            ys = tf.cast(tf.math.floordiv(indices, map_w), tf.float32)
+        else:
+            probs = tf.nn.softmax(self.beta * (flat - scores[..., tf.newaxis]), axis=-1)
+            grid_x = np.tile(np.arange(map_w, dtype=np.float32), map_h)
+            grid_y = np.repeat(np.arange(map_h, dtype=np.float32), map_w)
+            xs = tf.reduce_sum(probs * grid_x, axis=-1)
+            ys = tf.reduce_sum(probs * grid_y, axis=-1)
+
+        # heatmap pixel centers onto input pixel centers
+        xs = (xs + 0.5) * stride - 0.5
+        ys = (ys + 0.5) * stride - 0.5
+        return tfk.Model(input_tensor, tf.stack([xs, ys, scores], axis=-1))
+
+
+class PoseBoxDetector:
+
+    """Person boxes from the key-points of a cheap low resolution FastOpenPose pass.
+
+    Use like this:
+        detector = PoseBoxDetector(FastOpenPose(weights_path, config_path, input_shape=(96, 96)))
+        boxes = detector.detect_batch(frames)
+    """
+
+    def __init__(self, pose, margin=None, min_joints=4):
+        """
+        :param pose: FastOpenPose - a small input_shape suffices, as only boxes are needed
+        :param margin: float - boxes grow by this fraction of their size on every side, None takes bbox_ratio of the
+            pose's config
+        :param min_joints: int - people with fewer detected joints are ignored
+        """
+
+        self.pose = pose
+        self.margin = pose.settings.bbox_ratio if margin is None else margin
+        self.min_joints = min_joints
+
+    def detect_batch(self, imgs):
+        """Returns an array of (x_min, y_min, x_max, y_max) boxes, of shape (n_people, 4), per image."""
+
+        boxes = list()
+        for people in self.pose.predict_batch(imgs):
+            img_boxes = list()
+            for person in people:
+                kps = [kp[:2] for kp in person if not np.isnan(kp[0])]
+                if len(kps) < self.min_joints:
+                    continue
+                x_min, y_min, x_max, y_max = FastOpenPose._get_ul_lr(kps)
+                dx, dy = self.margin * (x_max - x_min), self.margin * (y_max - y_min)
+                img_boxes.append([x_min - dx, y_min - dy, x_max + dx, y_max + dy])
+            boxes.append(np.array(img_boxes, dtype=float_dtype).reshape(-1, 4))
+        return boxes
+
+
+class TopDownPose:
+
+    """Top-down multi person pose estimation, person boxes first, then one CPM call over fixed size crops of all people.
+
+    The detector may run at a low resolution and the crops have a fixed size, so the cost grows with the number of
+    people rather than with the frame resolution. Use like this:
+        detector = PoseBoxDetector(FastOpenPose(weights_path, config_path, input_shape=(96, 96)))
+        pose = TopDownPose(cpm_weights_path, detector)
+        keypoints = pose.predict_batch(frames)
+    """
+
+    def __init__(self, weights_path, detector, crop_shape=(256, 256), n_parts=16, thre=0.1):
+        """
+        :param weights_path: str - weights of a CPM with n_parts, e.g. trained by distillation.DistillationTrainer on
+            BGR(0, 1) images, None initializes randomly
+        :param detector: object whose detect_batch(imgs) returns an (n_people, 4) array of (x_min, y_min, x_max,
+            y_max) boxes per image, e.g. PoseBoxDetector or any lightweight person detector
+        :param crop_shape: (height, width) - every box is resized to fit into it, keeping its aspect ratio
+        :param thre: float - joints whose heatmap maximum is below thre are missing
+        """
+
+        self.detector = detector
+        self.crop_h, self.crop_w = crop_shape
+        self.n_parts = n_parts
+        self.thre = thre
+        self.model = CPM(input_shape=(self.crop_h, self.crop_w, 3), n_parts=n_parts).create_model()
+        if weights_path is not None:  # randomly initialized, e.g. for benchmarks
+            self.model.load_weights(weights_path)
+        self.stride = self.crop_h // self.model.output_shape[1]
+
+    def predict_batch(self, imgs):
+        """Detects the people of all images and runs the crops of all of them through CPM as one batch.
+
+        Returns a list with an array of shape (n_people, n_parts, 3) per image, holding x, y and score of every joint
+        in the image's coordinates, NaN for missing joints.
+        """
+
+        with stats.span('detection'):
+            boxes = self.detector.detect_batch(imgs)
+
+        with stats.span('resize'):
+            crops, transforms = list(), list()
+            for img, img_boxes in zip(imgs, boxes):
+                for box in img_boxes:
+                    transform = self._crop_transform(box)
+                    crop = cv2.warpAffine(img, transform, (self.crop_w, self.crop_h), flags=cv2.INTER_LINEAR)
+                    crops.append(crop.astype(np.float32) / 255)
+                    transforms.append(transform)
+        stats.count('people', len(crops))
+        if not crops:
+            return [np.zeros((0, self.n_parts, 3), dtype=float_dtype) for _ in imgs]
+
+        with stats.span('model_forward'):
+            heatmaps = self.model.predict(np.stack(crops), verbose=0)
+        with stats.span('decode'):
+            keypoints = self._decode(heatmaps, np.array(transforms, dtype=float_dtype))
+        return np.split(keypoints, np.cumsum([len(img_boxes) for img_boxes in boxes])[:-1])
+
+    def _crop_transform(self, box):
+        """Affine transform of the image that centers box in the crop and scales it to fit."""
+
+        x_min, y_min, x_max, y_max = box
+        scale = min(self.crop_w / max(x_max - x_min, 1), self.crop_h / max(y_max - y_min, 1))
+        return np.array([[scale, 0, self.crop_w / 2 - scale * (x_min + x_max) / 2],
+                         [0, scale, self.crop_h / 2 - scale * (y_min + y_max) / 2]])
+
+    def _decode(self, heatmaps, transforms):
+        """Maps the argmax of every heatmap channel back to image coordinates, (n_people, n_parts, 3)."""
+
+        n, map_h, map_w, _ = heatmaps.shape
+        flat = heatmaps.reshape(n, map_h * map_w, self.n_parts)
+        indices = flat.argmax(axis=1)
+        scores = np.take_along_axis(flat, indices[:, np.newaxis], axis=1)[:, 0]
+
+        # heatmap pixel centers onto crop pixel centers, then undo the crop transform
+        xs = (indices % map_w + 0.5) * self.stride - 0.5
+        ys = (indices // map_w + 0.5) * self.stride - 0.5
+        scale = transforms[:, 0, 0, np.newaxis]
+        offset_x, offset_y = transforms[:, 0, 2, np.newaxis], transforms[:, 1, 2, np.newaxis]
+        keypoints = np.stack([(xs - offset_x) / scale, (ys - offset_y) / scale, scores], axis=-1).astype(float_dtype)
+        keypoints[scores < self.thre] = np.nan
+        return keypoints
+
+
+class TFLiteModel:
+
+    def __init__(self, model_path, num_threads=None, output_keys=('paf', 'heatmap')):
+        """Runs a TFLite graph exported by export.TFLiteExporter with the Keras model's predict interface.
+
+        :param model_path: str - path to the .tflite file
+        :param num_threads: int - number of CPU threads used by the interpreter, None lets TFLite decide
+        :param output_keys: names of the signature outputs, returned in this order
+        """
+
+        self.model_path = model_path
+        self.num_threads = num_threads
+        self.output_keys = output_keys
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads)
+        self.runner = self.interpreter.get_signature_runner()
+        self.input_key = list(self.interpreter.get_signature_list()['serving_default']['inputs'])[0]
+
+    def predict(self, x):
+        outputs = self.runner(**{self.input_key: x.astype(np.float32)})
+        return [outputs[k] for k in self.output_keys]
+
+
 class FeatureExtractor:
     def __init__(self):
         self.points_comb = np.array([[4, 3, 2],
@@ -1442,11 +2074,202 @@ class FeatureExtractor:
         return angle
 
 
+class PoseRenderer:
+
+    """Blends limbs, circles and text of a whole frame into the image at once.
+
+    Shapes are drawn into one overlay plus mask and blended only inside their bounding boxes, instead of copying and
+    blending the full image for every shape. Overlay and mask buffers are reused across frames of the same size, so
+    a renderer must not be used by several threads at once; the drawing methods of the poses use the one of their
+    thread, see shared.
+    Use like this:
+        renderer = PoseRenderer()
+        img = renderer.prepare_output(img)
+        renderer.add_limbs(subset, candidate)
+        img = renderer.blend(img)
+    """
+
+    def __init__(self, stick_width=4, alpha=0.6):
+        self.stick_width = stick_width
+        self.alpha = alpha
+        self._overlay = None
+        self._mask = None
+        self._boxes = list()
+
+    @staticmethod
+    def shared():
+        """Returns the renderer of the calling thread, so threads drawing at the same time never share buffers."""
+
+        renderer = getattr(_renderers, 'renderer', None)
+        if renderer is None:
+            renderer = _renderers.renderer = PoseRenderer()
+        return renderer
+
+    def draw_keypoints(self, img, keypoints, out=None, radius=4):
+        """Draws joints and limbs of an (n_people, 18, 3) key-point array, NaN for missing joints, see
+        FastOpenPose.predict_batch.
+        """
+
+        img = self.prepare_output(img, out)
+        n_people, n_joints = keypoints.shape[:2]
+        candidate = keypoints.reshape(-1, keypoints.shape[2])
+        found = ~np.isnan(candidate[:, 0])
+        subset = np.where(found, np.arange(len(candidate)), -1).reshape(n_people, n_joints)
+
+        for ind in np.flatnonzero(found):
+            x, y = candidate[ind, :2]
+            cv2.circle(img, (int(x), int(y)), radius, OpenPose.colors[ind % n_joints], thickness=-1)
+        self.add_limbs(subset, candidate)
+        return self.blend(img)
+
+    def add_limbs(self, subset, candidate, n_limbs=17):
+        """Adds limbs of all people in subset, candidate holds x and y of every peak in its first two columns."""
+
+        for i in range(n_limbs):
+            for n in range(len(subset)):
+                index = subset[n][np.array(OpenPose.limb_seq[i]) - 1]
+                if -1 in index:
+                    continue
+                index = index.astype(int)
+                self.add_limb(candidate[index[0], :2], candidate[index[1], :2], OpenPose.colors[i])
+
+    def add_limb(self, point_a, point_b, color):
+        (x_a, y_a), (x_b, y_b) = point_a, point_b
+        length = np.sqrt((x_a - x_b) ** 2 + (y_a - y_b) ** 2)
+        angle = np.degrees(np.arctan2(y_a - y_b, x_a - x_b))
+        polygon = cv2.ellipse2Poly((int((x_a + x_b) / 2), int((y_a + y_b) / 2)),
+                                   (int(length / 2), self.stick_width),
+                                   int(angle),
+                                   0,
+                                   360,
+                                   1)
+        self._fill(polygon, color)
+
+    def add_circle(self, center, radius, color):
+        polygon = cv2.ellipse2Poly((int(center[0]), int(center[1])), (radius, radius), 0, 0, 360, 1)
+        self._fill(polygon, color)
+
+    def add_text(self, text, origin, color, font_scale=1, thickness=2):
+        self._check_prepared()
+        origin = (int(origin[0]), int(origin[1]))
+        cv2.putText(self._overlay, text, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, color, thickness)
+        cv2.putText(self._mask, text, origin, cv2.FONT_HERSHEY_SIMPLEX, font_scale, 1, thickness)
+        (w, h), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, font_scale, thickness)
+        x, y = origin
+        self._add_box(x - thickness, y - h - thickness, x + w + thickness, y + baseline + thickness)
+
+    def prepare_output(self, img, out=None):
+        """Returns the array to draw into, copying img into out if given, and sizes the buffers for it."""
+
+        if out is not None and out is not img:
+            np.copyto(out, img)
+            img = out
+        if self._overlay is None or self._overlay.shape != img.shape or self._overlay.dtype != img.dtype:
+            self._overlay = np.zeros_like(img)
+            self._mask = np.zeros(img.shape[:2], dtype=np.uint8)
+        return img
+
+    def blend(self, img):
+        """Blends the added shapes into img in place and returns it, img must be the array of prepare_output."""
+
+        for x_min, y_min, x_max, y_max in self._boxes:
+            mask = self._mask[y_min: y_max, x_min: x_max]
+            if not mask.any():
+                continue
+            roi = img[y_min: y_max, x_min: x_max]
+            blended = cv2.addWeighted(roi, 1 - self.alpha, self._overlay[y_min: y_max, x_min: x_max], self.alpha, 0)
+            np.copyto(roi, blended, where=mask.view(bool)[:, :, np.newaxis])
+            # overlapping boxes must not blend the same pixels twice
+            mask[:] = 0
+        self._boxes = list()
+        return img
+
+    def _check_prepared(self):
+        if self._overlay is None:
+            raise RuntimeError('PoseRenderer.prepare_output must be called before adding shapes.')
+
+    def _fill(self, polygon, color):
+        self._check_prepared()
+        cv2.fillConvexPoly(self._overlay, polygon, color)
+        cv2.fillConvexPoly(self._mask, polygon, 1)
+        x_min, y_min = polygon.min(axis=0)
+        x_max, y_max = polygon.max(axis=0)
+        self._add_box(x_min, y_min, x_max + 1, y_max + 1)
+
+    def _add_box(self, x_min, y_min, x_max, y_max):
+        h, w = self._mask.shape
+        x_min, x_max = max(0, int(x_min)), min(w, int(x_max))
+        y_min, y_max = max(0, int(y_min)), min(h, int(y_max))
+        if x_min < x_max and y_min < y_max:
+            self._boxes.append((x_min, y_min, x_max, y_max))
+
+
+
+def count_frame(all_peaks, connection_all, subset):
+    """Records the number of peaks, connections and people of one frame."""
+
+    if not stats.enabled:
+        return
+    stats.count('peaks', sum(len(peaks) for peaks in all_peaks))
+    stats.count('connections', sum(len(limb_ids) for limb_ids, _ in connection_all))
+    stats.count('people', len(subset))
+
+
 def timing(func):
     def inner(*args, **kwargs):
-        t = time()
-        ret = func(*args, **kwargs)
-        print('{} execution time: {} s'.format(func.__name__, time() - t))
-        return ret
+        with stats.span(func.__name__):
+            return func(*args, **kwargs)
 
     return inner
+
+
+def subpixel_offsets(heatmap, xs, ys, parts, method='quadratic'):
+    """Sub-pixel offsets of integer peaks from their 3x3 neighbourhood in a (h, w, c) heatmap.
+
+    'quadratic' fits a parabola through each peak and its horizontal and vertical neighbours, 'soft_argmax' takes the
+    score weighted mean position of the 3x3 patch. All peaks are refined at once.
+
+    :param xs: int array - x coordinates of the peaks
+    :param ys: int array - y coordinates of the peaks
+    :param parts: int or int array - heatmap channel of every peak
+    :return: (dx, dy) arrays in [-0.5, 0.5], refined peaks stay inside the heatmap
+    """
+
+    if method not in subpixel_methods:
+        raise ValueError('method must be one of {}, got {}'.format(subpixel_methods, method))
+    xs = np.asarray(xs, dtype=int)
+    ys = np.asarray(ys, dtype=int)
+    parts = np.broadcast_to(parts, xs.shape)
+    if len(xs) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    padded = np.pad(heatmap, ((1, 1), (1, 1), (0, 0)), mode='edge')
+    shifts = np.arange(3)
+    # (n, 3, 3) patches, rows are y - 1, y, y + 1
+    patches = padded[ys[:, np.newaxis, np.newaxis] + shifts[:, np.newaxis],
+                     xs[:, np.newaxis, np.newaxis] + shifts,
+                     parts[:, np.newaxis, np.newaxis]].astype(np.float64)
+
+    if method == 'quadratic':
+        center = patches[:, 1, 1]
+        left, right = patches[:, 1, 0], patches[:, 1, 2]
+        up, down = patches[:, 0, 1], patches[:, 2, 1]
+        dx = _parabola_vertex(left, center, right)
+        dy = _parabola_vertex(up, center, down)
+    else:
+        weights = np.maximum(patches, 0)
+        total = weights.sum(axis=(1, 2))
+        total[total == 0] = 1
+        dx = (weights[:, :, 2].sum(axis=1) - weights[:, :, 0].sum(axis=1)) / total
+        dy = (weights[:, 2].sum(axis=1) - weights[:, 0].sum(axis=1)) / total
+    dx = np.clip(xs + np.clip(dx, -0.5, 0.5), 0, heatmap.shape[1] - 1) - xs
+    dy = np.clip(ys + np.clip(dy, -0.5, 0.5), 0, heatmap.shape[0] - 1) - ys
+    return dx, dy
+
+
+def _parabola_vertex(before, center, after):
+    curvature = 2 * center - before - after
+    offset = np.zeros(len(center))
+    np.divide(after - before, 2 * curvature, out=offset, where=curvature > 0)
+    return offset
+
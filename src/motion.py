@@ -0,0 +1,122 @@
+from time import perf_counter
+
+import numpy as np
+import cv2
+
+from instrumentation import stats
+
+
+class MotionGate:
+
+    """Reuses the last inference result for frames that barely differ from the last inferred frame.
+
+    Frames are compared as grayscale thumbnails of size shape, every thumbnail pixel is the mean of a block of the
+    frame, so the largest absolute difference of two thumbnails is the largest change of any block. Comparing with
+    the last inferred frame, and not the previous one, lets slow drifts add up until they trigger an inference. Use
+    like this:
+        pose = FastOpenPose(weights_path, config_path, motion_gate=MotionGate(threshold=6, max_age=15))
+        ...
+        print(pose.motion_gate.hit_rate)
+    """
+
+    def __init__(self, threshold=6., max_age=10, shape=(24, 32)):
+        """
+        :param threshold: float - frames whose largest block change, in gray levels, is below it are static
+        :param max_age: int - a result is reused for at most this many consecutive frames
+        :param shape: (height, width) of the thumbnails, i.e. number of blocks
+        """
+
+        self.threshold = threshold
+        self.max_age = max_age
+        self.shape = shape
+        self.reference = None
+        self.result = None
+        self.age = 0
+        self.n_frames = 0
+        self.n_hits = 0
+        self._thumbnail = None
+
+    @property
+    def hit_rate(self):
+        return self.n_hits / self.n_frames if self.n_frames else 0.
+
+    def lookup(self, img):
+        """Returns the result of the last inferred frame if img is static, otherwise None."""
+
+        self.n_frames += 1
+        self._thumbnail = self.thumbnail(img)
+        if self.reference is not None and self.age < self.max_age and self.motion(self._thumbnail) < self.threshold:
+            self.age += 1
+            self.n_hits += 1
+            stats.count('motion_gate_hit', 1)
+            return self.result
+        stats.count('motion_gate_hit', 0)
+        return None
+
+    def store(self, result):
+        """Keeps result as the one of the frame last passed to lookup."""
+
+        self.reference = self._thumbnail
+        self.result = result
+        self.age = 0
+
+    def motion(self, thumbnail):
+        return float(np.abs(thumbnail - self.reference).max())
+
+    def thumbnail(self, img):
+        img = np.asarray(img)
+        if img.dtype != np.uint8:
+            img = np.clip(img, 0, 255).astype(np.uint8)
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+        return cv2.resize(gray, (self.shape[1], self.shape[0]), interpolation=cv2.INTER_AREA).astype(np.float32)
+
+    def reset(self):
+        self.reference = None
+        self.result = None
+        self.age = 0
+
+
+def evaluate(pose, frames, gate):
+    """Runs FastOpenPose._inference over frames with and without gate and reports what gating costs in accuracy.
+
+    Frames must have the model's input shape. Returns the hit rate, both run times, the mean and maximum distance in
+    input pixels between gated and ungated joints found in both, and the fraction of frames with a different number
+    of people. gate starts without a reference frame and the hit rate counts these frames only; the motion gate of
+    pose is restored afterwards.
+    """
+
+    results = dict()
+    times = dict()
+    original_gate = pose.motion_gate
+    gate.reset()
+    n_frames, n_hits = gate.n_frames, gate.n_hits
+    try:
+        for name, motion_gate in (('reference', None), ('gated', gate)):
+            pose.motion_gate = motion_gate
+            t = perf_counter()
+            results[name] = [pose.get_keypoints_array(*pose._inference(frame)[1:]) for frame in frames]
+            times[name] = perf_counter() - t
+    finally:
+        pose.motion_gate = original_gate
+
+    errors = list()
+    n_mismatched = 0
+    for reference, gated in zip(results['reference'], results['gated']):
+        if len(reference) != len(gated):
+            n_mismatched += 1
+        for person in reference:
+            if not len(gated):
+                break
+            distances = np.linalg.norm(gated[:, :, :2] - person[:, :2], axis=-1)
+            found = ~np.isnan(distances)
+            mean_distances = np.where(found, distances, 0).sum(axis=1) / np.maximum(found.sum(axis=1), 1)
+            nearest = np.where(found.any(axis=1), mean_distances, np.inf).argmin()
+            errors.extend(distances[nearest][found[nearest]].tolist())
+
+    n_frames, n_hits = gate.n_frames - n_frames, gate.n_hits - n_hits
+    return {'hit_rate': n_hits / n_frames if n_frames else 0.,
+            'reference_sec': times['reference'],
+            'gated_sec': times['gated'],
+            'mean_error_px': float(np.mean(errors)) if errors else 0.,
+            'max_error_px': float(np.max(errors)) if errors else 0.,
+            'people_mismatch_rate': n_mismatched / max(len(frames), 1)}
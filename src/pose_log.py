@@ -0,0 +1,380 @@
+from bisect import bisect_right
+from queue import Queue
+from threading import Thread
+from time import time
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from data_handler import MPII
+from instrumentation import stats
+
+# file header: magic, version, joints per person, keypoint dtype code, records per chunk of the index
+HEADER = struct.Struct('<8sHHBxI')
+MAGIC = b'POSELOG\x00'
+VERSION = 1
+# record header: frame index, timestamp in seconds, number of people
+RECORD = struct.Struct('<qdHxx')
+DTYPES = ('float16', 'float32')
+
+
+class PoseLogWriter:
+
+    """Appends per-frame key-points to a compact binary pose log from a background thread.
+
+    A log starts with a header and holds one record per frame: frame index, timestamp and number of people, a uint32
+    visibility bitmask per person with bit j set if joint j was found, and the (n_people, n_joints, 3) x, y and score
+    of all people in float16 or float32, zeros for missing joints. float16 rounds coordinates by at most 0.5 px below
+    2048 and 1 px below 4096. Every chunk_size-th record is listed with its frame index and byte offset in a sidecar
+    file path.idx, which PoseLogReader uses for random access. write only queues the key-points, encoding and writing
+    happen in the writer thread; it blocks once queue_size frames are waiting. Use like this:
+        with PoseLogWriter('poses.log') as log:
+            for i, keypoints in enumerate(keypoints_per_frame):
+                log.write(i, keypoints)
+    """
+
+    def __init__(self, path, n_joints=18, dtype='float16', chunk_size=256, queue_size=1024, append=False,
+                 n_records=None):
+        """
+        :param dtype: str - storage type of the key-points, one of DTYPES
+        :param chunk_size: int - records per entry of the chunk index
+        :param append: bool - continue an existing log, whose header must match, instead of replacing it
+        :param n_records: int - with append, keep only the first n_records records of the log, e.g. those up to a
+            checkpoint, and drop the rest; None keeps all complete records
+        """
+
+        if dtype not in DTYPES:
+            raise ValueError('dtype must be one of {}, got {}'.format(DTYPES, dtype))
+        if not 0 < n_joints <= 32:
+            raise ValueError('n_joints must be in [1, 32], got {}'.format(n_joints))
+        self.path = path
+        self.n_joints = n_joints
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.chunk_size = chunk_size
+        self.error = None
+
+        if append and os.path.exists(path):
+            with PoseLogReader(path) as reader:
+                if (reader.n_joints, reader.dtype, reader.chunk_size) != (n_joints, self.dtype, chunk_size):
+                    raise ValueError('Cannot append to {}, it stores {} joints as {} in chunks of {}.'.format(
+                        path, reader.n_joints, reader.dtype, reader.chunk_size))
+                self.n_records = len(reader) if n_records is None else min(n_records, len(reader))
+                end = reader.end if self.n_records == len(reader) else reader.offset(self.n_records)
+                n_chunks = -(-self.n_records // chunk_size)
+                index = np.array([reader.chunk_frames[:n_chunks], reader.chunk_offsets[:n_chunks]], dtype='<i8').T
+            self.file = open(path, 'r+b')
+            self.file.truncate(end)  # drops a partial last record of an interrupted run and the records after n_records
+            self.file.seek(end)
+            self.index_file = open(path + '.idx', 'wb')
+            self.index_file.write(index.tobytes())
+        else:
+            self.n_records = 0
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, VERSION, n_joints, DTYPES.index(dtype), chunk_size))
+            self.index_file = open(path + '.idx', 'wb')
+
+        self.queue = Queue(maxsize=queue_size)
+        self.thread = Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def write(self, frame_index, keypoints, timestamp=None):
+        """Queues the key-points of a frame.
+
+        :param keypoints: array of shape (n_people, n_joints, 3) with NaN for missing joints, e.g. an entry of
+            FastOpenPose.predict_batch, or a list of (x, y) or None per joint of one person, as get_img_pose_kps
+            returns
+        :param timestamp: float - seconds, time() if None
+        """
+
+        if self.error is not None:
+            raise self.error
+        if isinstance(keypoints, list):
+            keypoints = keypoints_array(keypoints)
+        self.queue.put((frame_index, time() if timestamp is None else timestamp, keypoints))
+
+    def flush(self):
+        """Waits until all queued key-points are written and flushes them to the file."""
+
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        self.index_file.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _write(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            try:
+                if self.error is None:
+                    with stats.span('pose_log_write'):
+                        self._write_record(*item)
+                    if self.queue.empty():
+                        self.file.flush()
+                        self.index_file.flush()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write_record(self, frame_index, timestamp, keypoints):
+        keypoints = np.asarray(keypoints, dtype=np.float32).reshape(-1, self.n_joints, 3)
+        found = ~np.isnan(keypoints[:, :, :2]).any(axis=2)
+        masks = (found.astype('<u4') << np.arange(self.n_joints, dtype='<u4')).sum(axis=1, dtype='<u4')
+        values = np.where(found[:, :, np.newaxis], keypoints, 0).astype(self.dtype)
+
+        if self.n_records % self.chunk_size == 0:
+            self.index_file.write(np.array([frame_index, self.file.tell()], dtype='<i8').tobytes())
+        self.file.write(RECORD.pack(frame_index, timestamp, len(keypoints)))
+        self.file.write(masks.tobytes())
+        self.file.write(values.tobytes())
+        self.n_records += 1
+
+
+class PoseLogReader:
+
+    """Memory-maps a pose log written by PoseLogWriter for analytics.
+
+    Records are read by position, log[i], or by frame index, find(frame_index), both jump to their chunk through the
+    index and walk at most chunk_size records. Key-points come back as float32 (n_people, n_joints, 3) arrays with
+    NaN for missing joints. A partial last record, e.g. of a log being written, is ignored. Use like this:
+        with PoseLogReader('poses.log') as log:
+            for frame_index, timestamp, keypoints in log:
+                ...
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise ValueError('{} is not a pose log.'.format(path))
+        magic, version, self.n_joints, dtype_code, self.chunk_size = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} pose log.'.format(path, VERSION))
+        self.dtype = np.dtype(DTYPES[dtype_code]).newbyteorder('<')
+        self.person_size = 4 + 3 * self.n_joints * self.dtype.itemsize
+        self.file = open(path, 'rb')
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._load_index()
+
+    def __len__(self):
+        return self.n_records
+
+    def __getitem__(self, i):
+        """Returns frame index, timestamp and key-points of record i."""
+
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record {} out of range'.format(i))
+        return self._read(self.offset(i))
+
+    def __iter__(self):
+        offset = HEADER.size
+        for _ in range(len(self)):
+            yield self._read(offset)
+            offset = self._record_end(offset)
+
+    def find(self, frame_index):
+        """Returns the record of frame_index, or None; frame indices must increase through the log."""
+
+        chunk = bisect_right(self.chunk_frames, frame_index) - 1
+        if chunk < 0:
+            return None
+        offset = self.chunk_offsets[chunk]
+        for _ in range(min(self.chunk_size, self.n_records - chunk * self.chunk_size)):
+            record_frame, _, _ = RECORD.unpack_from(self.buffer, offset)
+            if record_frame == frame_index:
+                return self._read(offset)
+            if record_frame > frame_index:
+                break
+            offset = self._record_end(offset)
+        return None
+
+    def offset(self, i):
+        """Returns the byte offset of record i, 0 <= i < len(self)."""
+
+        offset = self.chunk_offsets[i // self.chunk_size]
+        for _ in range(i % self.chunk_size):
+            offset = self._record_end(offset)
+        return offset
+
+    def frame_indices(self):
+        return np.array([record_frame for record_frame, _, _ in self._headers()], dtype=np.int64)
+
+    def timestamps(self):
+        return np.array([timestamp for _, timestamp, _ in self._headers()])
+
+    def close(self):
+        self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _load_index(self):
+        """Reads path.idx, drops entries without a complete record and indexes the records after the last entry.
+
+        A missing or stale index, e.g. of an interrupted writer, is so rebuilt by walking the records.
+        """
+
+        entries = list()
+        if os.path.exists(self.path + '.idx'):
+            index = np.fromfile(self.path + '.idx', dtype='<i8')
+            entries = index[:len(index) // 2 * 2].reshape(-1, 2).tolist()
+        while entries and self._record_end(entries[-1][1]) is None:
+            entries.pop()
+        if not entries and self._record_end(HEADER.size) is not None:
+            entries = [[RECORD.unpack_from(self.buffer, HEADER.size)[0], HEADER.size]]
+
+        n_records = 0
+        offset = HEADER.size
+        if entries:
+            n_records = (len(entries) - 1) * self.chunk_size
+            offset = entries[-1][1]
+        end = self._record_end(offset)
+        while end is not None:
+            if n_records % self.chunk_size == 0 and offset != entries[-1][1]:
+                entries.append([RECORD.unpack_from(self.buffer, offset)[0], offset])
+            n_records += 1
+            offset, end = end, self._record_end(end)
+
+        self.chunk_frames = [frame for frame, _ in entries]
+        self.chunk_offsets = [offset for _, offset in entries]
+        self.n_records = n_records
+        self.end = offset
+
+    def _headers(self):
+        offset = HEADER.size
+        for _ in range(len(self)):
+            yield RECORD.unpack_from(self.buffer, offset)
+            offset = self._record_end(offset)
+
+    def _record_end(self, offset):
+        """Offset after the record at offset, None if there is no complete record."""
+
+        if offset + RECORD.size > len(self.buffer):
+            return None
+        _, _, n_people = RECORD.unpack_from(self.buffer, offset)
+        end = offset + RECORD.size + n_people * self.person_size
+        return end if end <= len(self.buffer) else None
+
+    def _read(self, offset):
+        frame_index, timestamp, n_people = RECORD.unpack_from(self.buffer, offset)
+        offset += RECORD.size
+        masks = np.frombuffer(self.buffer, dtype='<u4', count=n_people, offset=offset)
+        offset += 4 * n_people
+        keypoints = np.frombuffer(self.buffer, dtype=self.dtype, count=n_people * self.n_joints * 3, offset=offset)
+        keypoints = keypoints.reshape(n_people, self.n_joints, 3).astype(np.float32)
+        found = (masks[:, np.newaxis] >> np.arange(self.n_joints, dtype='<u4')) & 1
+        keypoints[found == 0] = np.nan
+        return frame_index, timestamp, keypoints
+
+
+def keypoints_array(kps, n_joints=18):
+    """Converts a list of (x, y) or None per joint of one person to an array of shape (1, n_joints, 3), score 1."""
+
+    keypoints = np.full((1, n_joints, 3), np.nan, dtype=np.float32)
+    for j, kp in enumerate(kps):
+        if kp is not None:
+            keypoints[0, j] = kp[0], kp[1], 1
+    return keypoints
+
+
+def from_mpii_jsonl(jsonl_path, log_path, dtype='float32'):
+    """Converts MPII annotations, as MPII._save_joints writes them, to a pose log of 16 joints.
+
+    Every image becomes a record, in order of first appearance, with the annotated joints as found and their
+    is_visible flag as score. Returns the file names of the records.
+    """
+
+    people = dict()
+    with open(jsonl_path) as f:
+        for line in f:
+            record = json.loads(line)
+            vis = record['is_visible'] or dict()
+            keypoints = np.full((len(MPII.coco_to_mpii), 3), np.nan, dtype=np.float32)
+            for j, (x, y) in record['joint_pos'].items():
+                if x >= 0 and y >= 0:  # MPII marks joints without annotation with -1
+                    keypoints[int(j)] = x, y, vis.get(j, 1)
+            people.setdefault(record['filename'], list()).append(keypoints)
+
+    with PoseLogWriter(log_path, n_joints=len(MPII.coco_to_mpii), dtype=dtype) as log:
+        for i, persons in enumerate(people.values()):
+            log.write(i, np.stack(persons), timestamp=0.)
+    return list(people)
+
+
+def to_mpii_jsonl(log_path, jsonl_path, filenames=None, train=0):
+    """Writes the people of a pose log as MPII annotation lines, readable by MPII and evaluate.Evaluator.
+
+    Logs of 18 COCO joints are mapped with MPII.coco_to_mpii like Evaluator does, a joint averages its sources that
+    were found and is missing only if all of them are, e.g. head_top of a profile view is its visible eye and ear.
+    Missing joints are written as (-1, -1) and not visible, scores of 0.5 and more count as visible. head_rect is
+    estimated as the square around upper_neck and head_top whose side is their distance, None if either is missing;
+    Evaluator skips people without head_rect.
+
+    :param filenames: list of str - file name of every frame index, 'frame_{index:06d}.jpg' if None
+    """
+
+    with PoseLogReader(log_path) as log, open(jsonl_path, 'w') as f:
+        if log.n_joints not in (len(MPII.coco_to_mpii), 18):
+            raise ValueError('Logs of 16 MPII or 18 COCO joints can be converted, {} has {}.'.format(log_path,
+                                                                                                   log.n_joints))
+        for frame_index, _, keypoints in log:
+            if log.n_joints == 18:
+                keypoints = _coco_to_mpii(keypoints)
+            filename = 'frame_{:06d}.jpg'.format(frame_index) if filenames is None else filenames[frame_index]
+            for person in keypoints:
+                missing = np.isnan(person[:, :2]).any(axis=1)
+                data = {'filename': filename,
+                        'train': train,
+                        'head_rect': _head_rect(person, missing),
+                        'is_visible': {str(j): int(not missing[j] and person[j, 2] >= 0.5)
+                                       for j in range(len(person))},
+                        'joint_pos': {str(j): [-1., -1.] if missing[j] else [float(person[j, 0]),
+                                                                              float(person[j, 1])]
+                                      for j in range(len(person))}}
+                print(json.dumps(data), file=f)
+
+
+def _coco_to_mpii(keypoints):
+    mpii_keypoints = np.full((keypoints.shape[0], len(MPII.coco_to_mpii), 3), np.nan, dtype=keypoints.dtype)
+    for i, joints in enumerate(MPII.coco_to_mpii):
+        sources = keypoints[:, joints]
+        found = ~np.isnan(sources).any(axis=-1, keepdims=True)
+        n_found = found.sum(axis=1)
+        total = np.where(found, sources, 0).sum(axis=1)
+        mpii_keypoints[:, i] = np.where(n_found > 0, total / np.maximum(n_found, 1), np.nan)
+    return mpii_keypoints
+
+
+def _head_rect(person, missing, upper_neck=8, head_top=9):
+    if missing[upper_neck] or missing[head_top]:
+        return None
+    neck, top = person[upper_neck, :2].astype(np.float64), person[head_top, :2].astype(np.float64)
+    half = np.linalg.norm(top - neck) / 2
+    if half == 0:
+        return None
+    cx, cy = (neck + top) / 2
+    return [float(cx - half), float(cy - half), float(cx + half), float(cy + half)]
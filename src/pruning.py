@@ -0,0 +1,170 @@
+import numpy as np
+
+from tensorflow import keras as tfk
+
+from export import measure_latency
+from models import OpenPoseModelV2
+
+tfkl = tfk.layers
+
+
+class ChannelPruner:
+
+    """Magnitude based channel pruning for Keras conv nets like OpenPoseModelV2.
+
+    Removes the output channels with the smallest L1 kernel norm from every hidden Conv2D layer and builds a new,
+    physically smaller model, i.e. the kernels of the pruned layers and of the layers consuming them are sliced,
+    not masked. Use like this:
+        model = OpenPoseModelV2(input_shape=(368, 368, 3)).create_model()
+        pruned = ChannelPruner(model, ratio=0.3).prune()
+
+    Only convolutions whose outputs go exclusively into activations are pruned, so PAF and confidence map outputs
+    keep their channels.
+    """
+
+    def __init__(self, model, ratio=0.25, min_filters=8, skip_layers=()):
+        """
+        :param model: tf.keras.Model - functional model to prune
+        :param ratio: float - fraction of channels to remove from every prunable Conv2D layer
+        :param min_filters: int - a layer never keeps less filters than this
+        :param skip_layers: names of Conv2D layers that must not be pruned
+        """
+
+        if not 0 <= ratio < 1:
+            raise ValueError('ratio must be in [0, 1), got {}'.format(ratio))
+        self.model = model
+        self.ratio = ratio
+        self.min_filters = min_filters
+        self.skip_layers = set(skip_layers)
+        self.kept_filters = None
+
+    def prune(self):
+        self.kept_filters = self._select_filters()
+        kept_channels = self._propagate_channels()
+        pruned_model = tfk.models.clone_model(self.model, clone_function=self._clone_layer)
+
+        for layer in self.model.layers:
+            weights = layer.get_weights()
+            if not weights:
+                continue
+            in_channels = kept_channels[self._inbound_layers(layer)[0].name]
+            if isinstance(layer, tfkl.Conv2D):
+                kernel, bias = weights
+                if in_channels is not None:
+                    kernel = kernel[:, :, in_channels, :]
+                out_channels = self.kept_filters.get(layer.name)
+                if out_channels is not None:
+                    kernel = kernel[..., out_channels]
+                    bias = bias[out_channels]
+                weights = [kernel, bias]
+            elif in_channels is not None:
+                # per channel weights, e.g. BatchNormalization
+                weights = [w[..., in_channels] for w in weights]
+            pruned_model.get_layer(layer.name).set_weights(weights)
+
+        print('Pruned {} layers, parameters: {} -> {}'.format(len(self.kept_filters),
+                                                             self.model.count_params(),
+                                                             pruned_model.count_params()))
+        return pruned_model
+
+    def _select_filters(self):
+        kept_filters = dict()
+        for layer in self.model.layers:
+            if not self._is_prunable(layer):
+                continue
+            kernel = layer.get_weights()[0]
+            n_filters = kernel.shape[-1]
+            n_keep = max(self.min_filters, int(round(n_filters * (1 - self.ratio))))
+            if n_keep >= n_filters:
+                continue
+            magnitudes = np.abs(kernel).sum(axis=(0, 1, 2))
+            kept_filters[layer.name] = np.sort(np.argsort(magnitudes)[-n_keep:])
+        return kept_filters
+
+    def _is_prunable(self, layer):
+        if not isinstance(layer, tfkl.Conv2D) or layer.name in self.skip_layers:
+            return False
+        consumers = [node.outbound_layer for node in layer._outbound_nodes]
+        return len(consumers) > 0 and all(isinstance(c, tfkl.Activation) for c in consumers)
+
+    def _propagate_channels(self):
+        """Maps every layer name to the indices of the original output channels it keeps, None means all."""
+
+        kept_channels = dict()
+        for layer in self.model.layers:
+            if isinstance(layer, tfkl.InputLayer):
+                kept_channels[layer.name] = None
+            elif isinstance(layer, tfkl.Conv2D):
+                kept_channels[layer.name] = self.kept_filters.get(layer.name)
+            elif isinstance(layer, tfkl.Concatenate):
+                inbound = self._inbound_layers(layer)
+                if all(kept_channels[l.name] is None for l in inbound):
+                    kept_channels[layer.name] = None
+                    continue
+                indices = list()
+                offset = 0
+                for l in inbound:
+                    n_channels = l.output_shape[-1]
+                    kept = kept_channels[l.name]
+                    indices.append((np.arange(n_channels) if kept is None else kept) + offset)
+                    offset += n_channels
+                kept_channels[layer.name] = np.concatenate(indices)
+            else:
+                inbound = self._inbound_layers(layer)
+                kept = [kept_channels[l.name] for l in inbound]
+                if any(not np.array_equal(kept[0], k) for k in kept[1:]):
+                    raise ValueError('Layer {} merges inputs with different pruned channels, '
+                                     'add its producers to skip_layers.'.format(layer.name))
+                kept_channels[layer.name] = kept[0]
+        return kept_channels
+
+    def _clone_layer(self, layer):
+        config = layer.get_config()
+        if layer.name in self.kept_filters:
+            config['filters'] = len(self.kept_filters[layer.name])
+        return layer.__class__.from_config(config)
+
+    @staticmethod
+    def _inbound_layers(layer):
+        inbound = layer._inbound_nodes[0].inbound_layers
+        return inbound if isinstance(inbound, list) else [inbound]
+
+
+def count_flops(model):
+    """Returns the number of floating point operations of all Conv2D layers, the model needs a fixed input shape."""
+
+    flops = 0
+    for layer in model.layers:
+        if isinstance(layer, tfkl.Conv2D):
+            kh, kw, c_in, c_out = layer.kernel.shape
+            _, h, w, _ = layer.output_shape
+            if h is None or w is None:
+                raise ValueError('count_flops needs a model with fixed input height and width.')
+            flops += 2 * kh * kw * c_in * c_out * h * w
+    return flops
+
+
+def profile_configurations(configs, input_shape=(368, 368, 3), n_runs=10):
+    """Reports parameters, GFLOPs and CPU latency per model configuration.
+
+    :param configs: dict - name -> OpenPoseModelV2 keyword arguments or an already built tf.keras.Model, e.g.
+        {'full': {}, 'half_backbone': {'backbone_width': 0.5}, 'pruned': pruned_model}
+    :param input_shape: (height, width, n_channels) used for the kwargs configurations and the latency runs
+    :return: list of dicts, one per configuration
+    """
+
+    inputs = [np.random.uniform(0, 255, (1,) + tuple(input_shape)).astype(np.float32) for _ in range(n_runs)]
+    report = list()
+    for name, config in configs.items():
+        if isinstance(config, tfk.Model):
+            model = config
+        else:
+            model = OpenPoseModelV2(input_shape=input_shape, **config).create_model()
+        row = dict(config=name,
+                   params=model.count_params(),
+                   gflops=count_flops(model) / 1e9,
+                   **measure_latency(lambda x: model(x, training=False), inputs))
+        report.append(row)
+        print('{config:>20}: {params:>10} params, {gflops:8.2f} GFLOPs, '
+              '{mean_ms:8.1f} ms (p95 {p95_ms:8.1f} ms)'.format(**row))
+    return report
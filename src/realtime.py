@@ -0,0 +1,288 @@
+from queue import Full, Queue
+from threading import Lock, Thread
+from time import perf_counter
+
+import numpy as np
+
+from instrumentation import stats
+from models import PoseRenderer, float_dtype
+
+
+class OneEuroFilter:
+
+    """One Euro filter (Casiez et al., CHI 2012) of key-point arrays, NaN for missing joints.
+
+    Smooths jitter of slow joints with a low cutoff and follows fast ones with a cutoff rising with their speed. The
+    filtered speed is kept as well, it extrapolates joints between inferences.
+    """
+
+    def __init__(self, min_cutoff=1., beta=0.05, d_cutoff=1.):
+        """
+        :param min_cutoff: float - cutoff frequency in Hz at zero speed, lower values smooth more
+        :param beta: float - increase of the cutoff per pixel per second of speed, higher values lag less
+        :param d_cutoff: float - cutoff frequency in Hz of the speed
+        """
+
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+        self.x = None
+        self.dx = None
+        self.t = None
+
+    def __call__(self, x, t):
+        if self.x is None:
+            self.x, self.dx, self.t = x, np.zeros_like(x), t
+            return x
+
+        dt = max(t - self.t, 1e-6)
+        dx = (x - self.x) / dt
+        a_d = self._alpha(self.d_cutoff, dt)
+        dx_hat = a_d * dx + (1 - a_d) * self.dx
+        a = self._alpha(self.min_cutoff + self.beta * np.abs(dx_hat), dt)
+        x_hat = a * x + (1 - a) * self.x
+
+        # joints appearing start over, disappearing ones are missing
+        new = np.isnan(self.x) & ~np.isnan(x)
+        x_hat[new] = x[new]
+        dx_hat[new | np.isnan(x)] = 0
+        self.x, self.dx, self.t = x_hat, dx_hat, t
+        return x_hat
+
+    @staticmethod
+    def _alpha(cutoff, dt):
+        tau = 1 / (2 * np.pi * cutoff)
+        return 1 / (1 + tau / dt)
+
+
+class _Track:
+
+    def __init__(self, keypoints, t, method, filter_params):
+        self.method = method
+        self.filter = OneEuroFilter(**filter_params) if method == 'one_euro' else None
+        self.xy = None
+        self.velocity = None
+        self.t = None
+        self.scores = None
+        self.update(keypoints, t)
+
+    def update(self, keypoints, t):
+        xy = keypoints[:, :2].astype(np.float64)
+        if self.method == 'one_euro':
+            self.xy = self.filter(xy, t)
+            self.velocity = self.filter.dx
+        else:
+            velocity = np.zeros_like(xy) if self.xy is None else (xy - self.xy) / max(t - self.t, 1e-6)
+            self.xy, self.velocity = xy, np.nan_to_num(velocity)
+        self.t = t
+        self.scores = keypoints[:, 2]
+
+    def predict(self, t, max_horizon):
+        dt = min(max(t - self.t, 0), max_horizon)
+        return np.concatenate([self.xy + self.velocity * dt, self.scores[:, np.newaxis]], axis=1)
+
+
+class KeypointPredictor:
+
+    """Tracks people across inferences and estimates their key-points at any later time.
+
+    People of a new inference are matched greedily to the closest tracks by mean joint distance; joints move on with
+    a constant velocity, either the raw one between the last two inferences or the one of a OneEuroFilter. Use like
+    this:
+        predictor = KeypointPredictor('one_euro')
+        predictor.update(keypoints, t)
+        keypoints = predictor.predict(t + 1 / fps)
+    """
+
+    methods = ('constant_velocity', 'one_euro')
+
+    def __init__(self, method='one_euro', max_horizon=0.5, max_distance=100, **filter_params):
+        """
+        :param method: str - one of methods
+        :param max_horizon: float - seconds joints are extrapolated at most, they stand still afterwards
+        :param max_distance: float - people further than this many pixels from every track start a new track
+        :param filter_params: parameters of OneEuroFilter
+        """
+
+        if method not in self.methods:
+            raise ValueError('method must be one of {}, got {}'.format(self.methods, method))
+        self.method = method
+        self.max_horizon = max_horizon
+        self.max_distance = max_distance
+        self.filter_params = filter_params
+        self.tracks = list()
+
+    def update(self, keypoints, t):
+        """Updates the tracks with the (n_people, n_joints, 3) key-points of an inference on a frame from time t."""
+
+        distances = np.array([[self._distance(track.xy, person[:, :2]) for track in self.tracks]
+                              for person in keypoints]).reshape(len(keypoints), len(self.tracks))
+        tracks = list()
+        used, used_tracks = set(), set()
+        for flat in np.argsort(distances, axis=None, kind='stable'):
+            i, j = divmod(int(flat), len(self.tracks))
+            if distances[i, j] > self.max_distance:
+                break
+            if i in used or j in used_tracks:
+                continue
+            self.tracks[j].update(keypoints[i], t)
+            tracks.append(self.tracks[j])
+            used.add(i)
+            used_tracks.add(j)
+        for i, person in enumerate(keypoints):
+            if i not in used:
+                tracks.append(_Track(person, t, self.method, self.filter_params))
+        self.tracks = tracks
+
+    def predict(self, t):
+        """Returns the (n_people, n_joints, 3) key-points estimated at time t."""
+
+        if not self.tracks:
+            return np.zeros((0, 18, 3), dtype=float_dtype)
+        return np.stack([track.predict(t, self.max_horizon) for track in self.tracks]).astype(float_dtype)
+
+    @property
+    def last_update(self):
+        return max((track.t for track in self.tracks), default=None)
+
+    @staticmethod
+    def _distance(a, b):
+        both = ~np.isnan(a[:, 0]) & ~np.isnan(b[:, 0])
+        if not both.any():
+            return np.inf
+        return np.linalg.norm(a[both] - b[both], axis=1).mean()
+
+
+class RealtimePose:
+
+    """Keeps pose estimation of a live feed at the source frame rate with bounded latency.
+
+    Every infer_every-th frame is offered to an inference thread through a queue of queue_size frames, it is dropped
+    if the queue is full. process returns at once with the key-points of the latest inferences extrapolated to the
+    frame's time, so output never waits for the model. Queued frames are copies, the caller may reuse or draw on its
+    frame right away. An error of the model is raised by the next process and by close. Use like this:
+        with RealtimePose(FastOpenPose(weights_path, config_path)) as realtime:
+            realtime.run(cv2.VideoCapture(0), lambda frame, kps: cv2.imshow('pose', frame))
+        print(realtime.metrics())
+    """
+
+    def __init__(self, pose, infer_every=1, queue_size=1, predictor=None):
+        """
+        :param pose: pipeline with predict_batch, e.g. FastOpenPose
+        :param infer_every: int - only every infer_every-th frame is offered for inference
+        :param queue_size: int - frames waiting for inference at most, more are dropped
+        :param predictor: KeypointPredictor, by default with the One Euro filter
+        """
+
+        if infer_every < 1 or queue_size < 1:
+            raise ValueError('infer_every and queue_size must be at least 1, got {} and {}'.format(infer_every,
+                                                                                                  queue_size))
+        self.pose = pose
+        self.infer_every = infer_every
+        self.predictor = KeypointPredictor() if predictor is None else predictor
+        self.renderer = PoseRenderer()
+        self.queue = Queue(maxsize=queue_size)
+        self.lock = Lock()
+        self.n_frames = 0
+        self.n_skipped = 0
+        self.n_dropped = 0
+        self.n_inferred = 0
+        self.inference_time = 0.
+        self.staleness = 0.
+        self.start_time = None
+        self.error = None
+        self.thread = Thread(target=self._infer, daemon=True)
+        self.thread.start()
+
+    def process(self, frame, timestamp=None):
+        """Queues frame for inference if selected and returns its estimated (n_people, n_joints, 3) key-points.
+
+        :param timestamp: float - capture time of frame in seconds, perf_counter if None
+        """
+
+        if self.error is not None:
+            raise self.error
+        t = perf_counter() if timestamp is None else timestamp
+        if self.start_time is None:
+            self.start_time = perf_counter()
+        self.n_frames += 1
+
+        if (self.n_frames - 1) % self.infer_every:
+            self.n_skipped += 1
+        else:
+            try:
+                self.queue.put_nowait((frame.copy(), t))
+            except Full:
+                self.n_dropped += 1
+
+        with self.lock:
+            keypoints = self.predictor.predict(t)
+            last_update = self.predictor.last_update
+        if last_update is not None:
+            self.staleness += t - last_update
+            stats.count('keypoint_age_ms', (t - last_update) * 1000)
+        return keypoints
+
+    def run(self, capture, on_frame=None, max_frames=None, draw=True):
+        """Processes the frames of a cv2.VideoCapture as they come and passes each with its key-points to on_frame.
+
+        Returns the number of frames processed.
+        """
+
+        n_frames = 0
+        while max_frames is None or n_frames < max_frames:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            keypoints = self.process(frame)
+            if draw and len(keypoints):
+                frame = self.renderer.draw_keypoints(frame, keypoints)
+            if on_frame is not None:
+                on_frame(frame, keypoints)
+            n_frames += 1
+        return n_frames
+
+    def metrics(self):
+        """Returns frame counts, output and effective inference rates and the mean age of the key-points used."""
+
+        elapsed = perf_counter() - self.start_time if self.start_time is not None else 0.
+        return {'frames': self.n_frames,
+                'inferred': self.n_inferred,
+                'skipped': self.n_skipped,
+                'dropped': self.n_dropped,
+                'output_fps': self.n_frames / elapsed if elapsed > 0 else 0.,
+                'inference_fps': self.n_inferred / elapsed if elapsed > 0 else 0.,
+                'inference_ms': 1000 * self.inference_time / max(self.n_inferred, 1),
+                'keypoint_age_ms': 1000 * self.staleness / max(self.n_frames, 1)}
+
+    def close(self):
+        if self.thread.is_alive():  # the thread drains the queue until None, even after an error
+            self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _infer(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            frame, t = item
+            start = perf_counter()
+            try:
+                keypoints = self.pose.predict_batch([frame])[0]
+            except Exception as e:
+                self.error = e
+                continue
+            with self.lock:
+                self.predictor.update(keypoints, t)
+                self.n_inferred += 1
+                self.inference_time += perf_counter() - start
@@ -0,0 +1,129 @@
+from threading import Lock
+import os
+
+from configobj import ConfigObj
+import numpy as np
+
+
+class Settings:
+
+    """Typed, immutable settings of the OpenPose pipelines, parsed once per config file.
+
+    Besides the [param] and [models] sections of the OpenPose config, an optional [performance] section holds the
+    runtime knobs:
+        [performance]
+        batch_size = 16              # images per model call in FastOpenPose.predict_batch
+        num_threads = 4              # TFLite interpreter threads, omit to let TFLite decide
+        precision = float32          # dtype of the OpenPose post-processing maps, float32 or float64
+        max_peaks = 32               # peaks kept per part, 0 keeps all; FastOpenPose keeps 32 and OpenPose all if unset
+        legacy_stages = connections  # post-processing stages run with the original loop implementation
+    Use like this:
+        settings = Settings.load(config_path)
+        settings.thre1
+    """
+
+    __slots__ = ('config_path', 'use_gpu', 'gpu_device_number', 'model_id', 'octave', 'starting_range',
+                 'ending_range', 'scale_search', 'thre1', 'thre2', 'thre3', 'mid_num', 'min_num', 'crop_ratio',
+                 'bbox_ratio', 'box_size', 'stride', 'pad_value', 'batch_size', 'num_threads', 'precision',
+                 'max_peaks', 'legacy_stages')
+
+    precisions = ('float32', 'float64')
+    stages = ('peaks', 'connections')
+
+    _cache = dict()
+    _cache_lock = Lock()
+
+    def __init__(self, config_path, **values):
+        object.__setattr__(self, 'config_path', config_path)
+        for name in self.__slots__[1:]:
+            object.__setattr__(self, name, values[name])
+        self._validate()
+
+    @classmethod
+    def load(cls, config_path):
+        """Returns the settings of config_path, parsed on first use and again only if the file changed."""
+
+        key = (os.path.abspath(config_path), os.path.getmtime(config_path))
+        with cls._cache_lock:
+            if key not in cls._cache:
+                cls._cache[key] = cls._parse(config_path)
+            return cls._cache[key]
+
+    @classmethod
+    def clear_cache(cls):
+        with cls._cache_lock:
+            cls._cache.clear()
+
+    @property
+    def dtype(self):
+        return np.dtype(self.precision)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Settings are immutable, create a new config file instead.')
+
+    def __delattr__(self, name):
+        raise AttributeError('Settings are immutable.')
+
+    def __repr__(self):
+        return 'Settings({})'.format(', '.join('{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+    @classmethod
+    def _parse(cls, config_path):
+        config = ConfigObj(config_path, file_error=True)
+        param = config['param']
+        model = config['models'][param['modelID']]
+        performance = config.get('performance', dict())
+
+        num_threads = performance.get('num_threads')
+        max_peaks = performance.get('max_peaks')
+        legacy_stages = performance.get('legacy_stages', ())
+        if isinstance(legacy_stages, str):
+            legacy_stages = (legacy_stages, )
+
+        return cls(config_path,
+                   use_gpu=int(param['use_gpu']),
+                   gpu_device_number=int(param['GPUdeviceNumber']),
+                   model_id=param['modelID'],
+                   octave=int(param['octave']),
+                   starting_range=float(param['starting_range']),
+                   ending_range=float(param['ending_range']),
+                   scale_search=tuple(map(float, param['scale_search'])),
+                   thre1=float(param['thre1']),
+                   thre2=float(param['thre2']),
+                   thre3=float(param['thre3']),
+                   mid_num=int(param['mid_num']),
+                   min_num=int(param['min_num']),
+                   crop_ratio=float(param['crop_ratio']),
+                   bbox_ratio=float(param['bbox_ratio']),
+                   box_size=int(model['boxsize']),
+                   stride=int(model['stride']),
+                   pad_value=int(model['padValue']),
+                   batch_size=int(performance.get('batch_size', 16)),
+                   num_threads=None if num_threads is None else int(num_threads),
+                   precision=performance.get('precision', 'float32'),
+                   max_peaks=None if max_peaks is None else int(max_peaks),
+                   legacy_stages=tuple(s for s in legacy_stages if s))
+
+    def _validate(self):
+        errors = list()
+        if not 0 <= self.thre1 < 1 or not 0 <= self.thre2 < 1:
+            errors.append('thre1 and thre2 must be in [0, 1), got {} and {}'.format(self.thre1, self.thre2))
+        if self.stride < 1 or self.box_size % self.stride:
+            errors.append('boxsize must be a multiple of stride, got {} and {}'.format(self.box_size, self.stride))
+        if not self.scale_search or min(self.scale_search) <= 0:
+            errors.append('scale_search must hold positive scales, got {}'.format(self.scale_search))
+        if self.mid_num < 2:
+            errors.append('mid_num must be at least 2, got {}'.format(self.mid_num))
+        if self.batch_size < 1:
+            errors.append('batch_size must be at least 1, got {}'.format(self.batch_size))
+        if self.num_threads is not None and self.num_threads < 1:
+            errors.append('num_threads must be at least 1, got {}'.format(self.num_threads))
+        if self.precision not in self.precisions:
+            errors.append('precision must be one of {}, got {}'.format(self.precisions, self.precision))
+        if self.max_peaks is not None and self.max_peaks < 0:
+            errors.append('max_peaks must be 0 (keep all) or positive, got {}'.format(self.max_peaks))
+        unknown = set(self.legacy_stages) - set(self.stages)
+        if unknown:
+            errors.append('legacy_stages must be among {}, got {}'.format(self.stages, sorted(unknown)))
+        if errors:
+            raise ValueError('Invalid config {}: {}'.format(self.config_path, '; '.join(errors)))
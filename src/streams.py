@@ -0,0 +1,232 @@
+from collections import deque
+from threading import Condition, Thread
+from time import perf_counter
+
+import numpy as np
+
+from instrumentation import stats
+from realtime import KeypointPredictor
+
+
+class _Stream:
+
+    def __init__(self, name, deadline, queue_size, predictor, n_latencies=1000):
+        self.name = name
+        self.deadline = deadline
+        self.frames = deque(maxlen=queue_size)
+        self.predictor = predictor
+        self.n_frames = 0
+        self.n_inferred = 0
+        self.n_dropped = 0
+        self.n_expired = 0
+        self.n_failed = 0
+        self.error = None  # of the latest failed batch, raised by the next submit
+        self.waiting_since = None  # first frame since the stream was served last, dropped and expired ones count
+        self.latencies = deque(maxlen=n_latencies)  # of the latest inferences, memory stays flat
+
+    def metrics(self):
+        latencies = np.array(self.latencies) * 1000
+        return {'frames': self.n_frames,
+                'inferred': self.n_inferred,
+                'dropped': self.n_dropped,
+                'expired': self.n_expired,
+                'failed': self.n_failed,
+                'latency_ms': latencies.mean() if len(latencies) else 0.,
+                'latency_p95_ms': np.percentile(latencies, 95) if len(latencies) else 0.,
+                'queued': len(self.frames)}
+
+
+class StreamScheduler:
+
+    """Serves several camera streams with one shared pose model by batching their frames together.
+
+    Every stream has a queue of queue_size frames, a full queue drops its oldest frame. An inference thread takes at
+    most one frame per stream per round, so every stream gets its turn however many there are. Within a round the
+    most urgent frames go first, frames waiting longer than their stream's deadline are skipped as expired. Batches
+    of up to batch_size frames run through pose.predict_batch and the key-points of each frame update the tracker of
+    its stream. A batch that fails is counted in metrics and its error is raised by the next submit of each of its
+    streams, the scheduler keeps serving. The model and its memory are shared, so adding a stream only adds a queue
+    and a tracker. Use like this:
+        with StreamScheduler(FastOpenPose(weights_path, config_path)) as scheduler:
+            for name in ('door', 'hall'):
+                scheduler.add_stream(name, deadline=0.1)
+            ...
+            scheduler.submit('door', frame)
+            keypoints = scheduler.keypoints('door')
+        print(scheduler.metrics())
+    """
+
+    def __init__(self, pose, batch_size=None, deadline=0.2, queue_size=1):
+        """
+        :param pose: pipeline with predict_batch, e.g. FastOpenPose
+        :param batch_size: int - frames per model call at most, None takes batch_size of pose.settings, else 16
+        :param deadline: float - default seconds a frame may wait for inference before it is skipped
+        :param queue_size: int - default number of frames a stream keeps waiting
+        """
+
+        if batch_size is None:
+            settings = getattr(pose, 'settings', None)
+            batch_size = 16 if settings is None else settings.batch_size
+        if batch_size < 1 or queue_size < 1:
+            raise ValueError('batch_size and queue_size must be at least 1, got {} and {}'.format(batch_size,
+                                                                                                 queue_size))
+        self.pose = pose
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.queue_size = queue_size
+        self.streams = dict()
+        self.order = list()
+        self.next_stream = 0
+        self.condition = Condition()
+        self.closed = False
+        self.n_batches = 0
+        self.n_batch_frames = 0
+        self.n_failed_batches = 0
+        self.last_error = None
+        self.inference_time = 0.
+        self.start_time = None
+        self.thread = Thread(target=self._infer, daemon=True)
+        self.thread.start()
+
+    def add_stream(self, name, deadline=None, queue_size=None, predictor=None):
+        """Registers a stream, by default with the scheduler's deadline and queue size and a KeypointPredictor."""
+
+        with self.condition:
+            if name in self.streams:
+                raise ValueError('Stream {} already exists.'.format(name))
+            self.streams[name] = _Stream(name,
+                                         self.deadline if deadline is None else deadline,
+                                         self.queue_size if queue_size is None else queue_size,
+                                         KeypointPredictor() if predictor is None else predictor)
+            self.order.append(name)
+
+    def remove_stream(self, name):
+        with self.condition:
+            del self.streams[name]
+            self.order.remove(name)
+            self.next_stream = 0
+
+    def submit(self, name, frame, timestamp=None):
+        """Queues a copy of frame of stream name for inference, so the caller may reuse its capture buffer.
+
+        Raises the error of a failed batch with frames of this stream once, frame is not queued then.
+
+        :param timestamp: float - capture time of frame in seconds, perf_counter if None
+        """
+
+        now = perf_counter()
+        frame = frame.copy()
+        with self.condition:
+            if self.start_time is None:
+                self.start_time = now
+            stream = self.streams[name]
+            if stream.error is not None:
+                error, stream.error = stream.error, None
+                raise error
+            stream.n_frames += 1
+            if len(stream.frames) == stream.frames.maxlen:
+                stream.n_dropped += 1
+            stream.frames.append((frame, now if timestamp is None else timestamp, now))
+            if stream.waiting_since is None:
+                stream.waiting_since = now
+            self.condition.notify()
+
+    def keypoints(self, name, timestamp=None):
+        """Returns the (n_people, n_joints, 3) key-points of stream name estimated at timestamp, by default now."""
+
+        with self.condition:
+            return self.streams[name].predictor.predict(perf_counter() if timestamp is None else timestamp)
+
+    def metrics(self):
+        """Returns overall batch statistics and the frame counts and latencies of every stream."""
+
+        with self.condition:
+            elapsed = perf_counter() - self.start_time if self.start_time is not None else 0.
+            return {'batches': self.n_batches,
+                    'mean_batch_size': self.n_batch_frames / max(self.n_batches, 1),
+                    'inference_fps': self.n_batch_frames / elapsed if elapsed > 0 else 0.,
+                    'inference_ms': 1000 * self.inference_time / max(self.n_batches, 1),
+                    'failed_batches': self.n_failed_batches,
+                    'last_error': None if self.last_error is None else repr(self.last_error),
+                    'streams': {name: stream.metrics() for name, stream in self.streams.items()}}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _next_batch(self):
+        """Takes up to batch_size frames, round by round one per stream, the most urgent first within a round.
+
+        Urgency is the deadline counted from the time a stream started waiting, which frames dropped or expired in the
+        meantime do not reset, so streams left over are served first next time; ties go to the streams after the first
+        one of the previous batch.
+        """
+
+        now = perf_counter()
+        batch = list()
+        n_streams = len(self.order)
+        names = self.order[self.next_stream:] + self.order[:self.next_stream]
+        while len(batch) < self.batch_size:
+            heads = list()
+            for position, name in enumerate(names):
+                stream = self.streams[name]
+                while stream.frames and now - stream.frames[0][2] > stream.deadline:
+                    stream.frames.popleft()
+                    stream.n_expired += 1
+                if stream.frames:
+                    heads.append((stream.waiting_since + stream.deadline, position, name))
+            if not heads:
+                break
+            for _, _, name in sorted(heads)[:self.batch_size - len(batch)]:
+                stream = self.streams[name]
+                frame, timestamp, queued = stream.frames.popleft()
+                stream.waiting_since = stream.frames[0][2] if stream.frames else None
+                batch.append((name, frame, timestamp, queued))
+        if batch:
+            self.next_stream = (self.next_stream + 1) % n_streams
+        return batch
+
+    def _infer(self):
+        while True:
+            with self.condition:
+                batch = self._next_batch()
+                while not batch and not self.closed:
+                    self.condition.wait()
+                    batch = self._next_batch()
+                if not batch:
+                    break
+            start = perf_counter()
+            try:
+                with stats.span('stream_batch'):
+                    keypoints = self.pose.predict_batch([frame for _, frame, _, _ in batch])
+            except Exception as e:
+                with self.condition:
+                    self.n_failed_batches += 1
+                    self.last_error = e
+                    for name, _, _, _ in batch:
+                        stream = self.streams.get(name)
+                        if stream is not None:
+                            stream.n_failed += 1
+                            stream.error = e
+                continue
+            end = perf_counter()
+            stats.count('stream_batch_size', len(batch))
+            with self.condition:
+                self.n_batches += 1
+                self.n_batch_frames += len(batch)
+                self.inference_time += end - start
+                for (name, _, timestamp, queued), frame_keypoints in zip(batch, keypoints):
+                    stream = self.streams.get(name)
+                    if stream is None:  # removed meanwhile
+                        continue
+                    stream.predictor.update(frame_keypoints, timestamp)
+                    stream.n_inferred += 1
+                    stream.latencies.append(end - queued)
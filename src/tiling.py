@@ -0,0 +1,144 @@
+import cv2
+import numpy as np
+
+from instrumentation import stats
+from models import FastOpenPose, OpenPose
+
+
+class TiledOpenPose:
+
+    """Runs an OpenPose over overlapping tiles of a large image at full resolution.
+
+    Tiles are run in batches of batch_size of the config and their raw outputs, at the model stride, are stitched
+    into one heatmap and PAF of the whole image: overlaps are blended with linear ramps, so the maps are seamless and
+    people crossing tile borders are assembled once from the stitched maps. Only one batch of tiles is in the model
+    at a time and the stitched maps are float32 at 1 / stride of the image size, instead of full size float64 maps,
+    so memory stays small however large the image. Use like this:
+        tiled = TiledOpenPose(OpenPose(weights_path, config_path), tile_size=368, overlap=96)
+        keypoints = tiled.get_keypoints(group_photo)
+    """
+
+    def __init__(self, pose, tile_size=368, overlap=96, scale=1.):
+        """
+        :param pose: OpenPose - provides model, config and post-processing options
+        :param tile_size: int - side of the square tiles, a multiple of the model stride
+        :param overlap: int - pixels shared by neighbouring tiles, a multiple of the model stride; should exceed the
+            receptive field a joint needs, a few tens of pixels at the scale people appear in the image
+        :param scale: float - the image is resized by this factor before tiling, >1 enlarges tiny people
+        """
+
+        stride = pose.settings.stride
+        if tile_size % stride or overlap % stride:
+            raise ValueError('tile_size and overlap must be multiples of the stride {}, got {} and {}'.format(
+                stride, tile_size, overlap))
+        if not 0 <= overlap < tile_size:
+            raise ValueError('overlap must be in [0, tile_size), got {}'.format(overlap))
+        self.pose = pose
+        self.settings = pose.settings
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.scale = scale
+
+    def predict(self, img):
+        """Returns all_peaks, subset and candidate like OpenPose.predict, in the coordinates of img."""
+
+        settings = self.settings
+        if self.scale != 1:
+            with stats.span('resize'):
+                img = cv2.resize(img, (0, 0), fx=self.scale, fy=self.scale, interpolation=cv2.INTER_CUBIC)
+        heatmap, paf = self.get_maps(img)
+
+        with stats.span('peaks'):
+            if self.pose.legacy_peaks:
+                all_peaks = OpenPose._get_peaks_legacy(heatmap, settings.thre1)
+            else:
+                all_peaks = OpenPose._get_peaks(heatmap, settings.thre1, self.pose.subpixel, self.pose.max_peaks)
+        with stats.span('connections'):
+            if self.pose.legacy_connections:
+                connection_all, special_k = OpenPose._get_connections_legacy(paf, all_peaks, settings.thre2,
+                                                                             heatmap.shape, settings.mid_num)
+            else:
+                connection_all, special_k = OpenPose._get_connections(paf, all_peaks, settings.thre2,
+                                                                      heatmap.shape[0], settings.mid_num)
+        factor = settings.stride / self.scale
+        all_peaks = OpenPose._scale_peaks(all_peaks, factor, factor)
+        with stats.span('subset'):
+            subset, candidate = OpenPose._get_subset(all_peaks, special_k, connection_all)
+        return all_peaks, subset, candidate
+
+    def get_keypoints(self, img):
+        """Returns an array of shape (n_people, 18, 3) with x, y and score, NaN for missing joints."""
+
+        all_peaks, subset, candidate = self.predict(img)
+        return FastOpenPose.get_keypoints_array(subset, candidate.reshape(-1, 4))
+
+    def draw_pose(self, img):
+        all_peaks, subset, candidate = self.predict(img)
+        if not subset.any():
+            return None
+        return OpenPose.draw_inverse_transformed_parts(img, all_peaks, subset, candidate)
+
+    def get_maps(self, img):
+        """Returns the stitched heatmap and PAF of img, of shape (ceil(h / stride), ceil(w / stride), 19 and 38)."""
+
+        stride = self.settings.stride
+        h, w = img.shape[:2]
+        map_h, map_w = -(-h // stride), -(-w // stride)
+        dtype = self.pose.dtype
+        heatmap = np.zeros((map_h, map_w, 19), dtype=dtype)
+        paf = np.zeros((map_h, map_w, 38), dtype=dtype)
+        weights = np.zeros((map_h, map_w, 1), dtype=dtype)
+
+        tiles = [(y, x) for y in self._origins(h) for x in self._origins(w)]
+        stats.count('tiles', len(tiles))
+        batch_size = self.settings.batch_size
+        for start in range(0, len(tiles), batch_size):
+            origins = tiles[start: start + batch_size]
+            with stats.span('tiling'):
+                batch = np.stack([self._cut(img, y, x) for y, x in origins])
+            with stats.span('model_forward'):
+                pafs, heatmaps = self.pose.model.predict(batch)
+            with stats.span('stitching'):
+                for (y, x), tile_paf, tile_heatmap in zip(origins, pafs, heatmaps):
+                    my, mx = y // stride, x // stride
+                    th, tw = min(map_h - my, tile_paf.shape[0]), min(map_w - mx, tile_paf.shape[1])
+                    weight = self._window(y, h, th)[:, np.newaxis] * self._window(x, w, tw)[np.newaxis]
+                    weight = weight[:, :, np.newaxis].astype(dtype)
+                    heatmap[my: my + th, mx: mx + tw] += weight * tile_heatmap[:th, :tw]
+                    paf[my: my + th, mx: mx + tw] += weight * tile_paf[:th, :tw]
+                    weights[my: my + th, mx: mx + tw] += weight
+        heatmap /= weights
+        paf /= weights
+        return heatmap, paf
+
+    def _origins(self, length):
+        """Tile offsets along one axis, evenly stepped and the last one flush with the end."""
+
+        stride = self.settings.stride
+        step = self.tile_size - self.overlap
+        # rounded up onto the stride grid, the last tile reaches at most stride - 1 padded pixels past the end
+        last = -(-max(length - self.tile_size, 0) // stride) * stride
+        return list(range(0, last, step)) + [last]
+
+    def _cut(self, img, y, x):
+        tile = np.full((self.tile_size, self.tile_size, 3), self.settings.pad_value, dtype=np.float32)
+        part = img[y: y + self.tile_size, x: x + self.tile_size]
+        tile[:part.shape[0], :part.shape[1]] = part
+        return tile
+
+    def _window(self, origin, length, n):
+        """Blending weights of n map cells of a tile at origin, ramping up and down over the overlap.
+
+        Sides at the image border are not faded, there is no neighbour to blend with.
+        """
+
+        ramp = self.overlap // self.settings.stride
+        window = np.ones(n)
+        if ramp == 0:
+            return window
+        cells = np.arange(n) + 0.5
+        if origin > 0:
+            window = np.minimum(window, cells / ramp)
+        if origin + self.tile_size < length:
+            window = np.minimum(window, (self.tile_size // self.settings.stride - cells) / ramp)
+        return window
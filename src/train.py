@@ -0,0 +1,174 @@
+from time import time
+
+import tensorflow as tf
+from tensorflow import keras as tfk
+
+
+class Trainer:
+
+    """Trains OpenPoseModelV2, or StackedHourglassNetwork, with intermediate supervision over all stages.
+
+    Datasets must yield (images, targets) where images are RGB(0, 255) and targets is a dict with a 'cm' entry of
+    shape (batch, h / stride, w / stride, np_cm) and an optional 'paf' entry (batch, h / stride, w / stride, np_paf).
+    If 'paf' is missing, only the confidence map stages are supervised. Use like this:
+        mpii = MPII(batch_size=8)
+        train_ds, test_ds = mpii.generate_dataset(input_shape=(368, 368))
+        trainer = Trainer(OpenPoseModelV2(np_cm=mpii.n_parts), checkpoint_dir='checkpoints')
+        trainer.fit(trainer.mpii_targets(train_ds), steps=10000)
+    A single person StackedHourglassNetwork trains the same way, on images of its input shape and with its stride:
+        train_ds, test_ds = mpii.generate_dataset(input_shape=(256, 256))
+        trainer = Trainer(StackedHourglassNetwork(input_shape=(256, 256, 3), n_stacks=2), checkpoint_dir='checkpoints')
+        trainer.fit(trainer.mpii_targets(train_ds, stride=StackedHourglassNetwork.stride), steps=10000)
+    """
+
+    def __init__(self,
+                 model_def,
+                 learning_rate=1e-4,
+                 accumulation_steps=1,
+                 mixed_precision=False,
+                 checkpoint_dir=None,
+                 checkpoint_every=1000,
+                 max_checkpoints=3,
+                 log_every=50,
+                 paf_weight=1.0,
+                 cm_weight=1.0):
+        """
+        :param model_def: OpenPoseModelV2 or StackedHourglassNetwork - model definition, the model is created with
+            intermediate outputs
+        :param accumulation_steps: int - number of batches whose gradients are summed up before an optimizer step,
+            i.e. the effective batch size is accumulation_steps * batch_size
+        :param mixed_precision: bool - compute in bfloat16 on CPU and float16 on GPU, variables stay float32
+        :param checkpoint_dir: str - if given, training resumes from the latest checkpoint in this directory
+        :param log_every: int - number of optimizer steps between loss and throughput logs
+        """
+
+        if accumulation_steps < 1:
+            raise ValueError('accumulation_steps must be at least 1, got {}'.format(accumulation_steps))
+
+        self.model_def = model_def
+        self.accumulation_steps = accumulation_steps
+        self.mixed_precision = mixed_precision
+        self.checkpoint_every = checkpoint_every
+        self.log_every = log_every
+        self.paf_weight = paf_weight
+        self.cm_weight = cm_weight
+
+        previous_policy = policy = tfk.mixed_precision.global_policy()
+        if mixed_precision:
+            policy = tfk.mixed_precision.Policy('mixed_float16' if tf.config.list_physical_devices('GPU')
+                                                else 'mixed_bfloat16')
+            print('Using {} mixed precision policy.'.format(policy.name))
+
+        # the policy holds for the layers of this model only, models built later in the process keep the previous one
+        tfk.mixed_precision.set_global_policy(policy)
+        try:
+            self.model = model_def.create_model(intermediate_outputs=True)
+        finally:
+            tfk.mixed_precision.set_global_policy(previous_policy)
+        self.optimizer = tfk.optimizers.Adam(learning_rate)
+        if policy.name == 'mixed_float16':
+            self.optimizer = tfk.mixed_precision.LossScaleOptimizer(self.optimizer)
+
+        self.accumulated_gradients = [tf.Variable(tf.zeros_like(v), trainable=False)
+                                      for v in self.model.trainable_variables]
+
+        self.step = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.checkpoint = tf.train.Checkpoint(model=self.model, optimizer=self.optimizer, step=self.step)
+        self.checkpoint_manager = None
+        if checkpoint_dir is not None:
+            self.checkpoint_manager = tf.train.CheckpointManager(self.checkpoint, checkpoint_dir, max_checkpoints)
+            if self.checkpoint_manager.latest_checkpoint:
+                self.checkpoint.restore(self.checkpoint_manager.latest_checkpoint)
+                print('Resumed from {} at step {}'.format(self.checkpoint_manager.latest_checkpoint,
+                                                          int(self.step.numpy())))
+
+    def fit(self, dataset, steps):
+        """Runs steps optimizer steps, each over accumulation_steps batches of dataset."""
+
+        iterator = iter(dataset)
+        n_samples = 0
+        t = time()
+        while int(self.step.numpy()) < steps:
+            for _ in range(self.accumulation_steps):
+                images, targets = next(iterator)
+                if self.accumulation_steps == 1:
+                    loss = self._train_step(images, targets)
+                else:
+                    loss = self._accumulate_step(images, targets)
+                n_samples += int(images.shape[0])
+            if self.accumulation_steps > 1:
+                self._apply_accumulated()
+            self.step.assign_add(1)
+
+            step = int(self.step.numpy())
+            if step % self.log_every == 0:
+                elapsed = time() - t
+                print('step {}: loss {:.5f}, {:.1f} samples/sec'.format(step, float(loss), n_samples / elapsed))
+                n_samples = 0
+                t = time()
+            if self.checkpoint_manager is not None and step % self.checkpoint_every == 0:
+                self.checkpoint_manager.save(checkpoint_number=step)
+
+        if self.checkpoint_manager is not None:
+            self.checkpoint_manager.save(checkpoint_number=int(self.step.numpy()))
+        return self.model
+
+    @staticmethod
+    def mpii_targets(dataset, stride=8):
+        """Maps a dataset made by MPII.create_dataset with a fixed input_shape to (images, {'cm': ...}).
+
+        Belief maps are max pooled by stride, so the gaussian peaks survive the downsampling.
+        """
+
+        def to_targets(images, belief_maps):
+            cm = tf.nn.max_pool2d(belief_maps, stride, stride, 'SAME')
+            return images * 255, {'cm': cm}
+
+        return dataset.map(to_targets, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    def _compute_loss(self, images, targets):
+        outputs = self.model(images, training=True)
+        if not isinstance(outputs, (list, tuple)):  # Keras returns single outputs as a tensor
+            outputs = [outputs]
+        paf_outputs = outputs[:self.model_def.paf_stages]
+        cm_outputs = outputs[self.model_def.paf_stages:]
+
+        loss = 0.
+        for cm in cm_outputs:
+            loss += self.cm_weight * tf.reduce_mean(tf.square(tf.cast(cm, tf.float32) - targets['cm']))
+        if 'paf' in targets:
+            for paf in paf_outputs:
+                loss += self.paf_weight * tf.reduce_mean(tf.square(tf.cast(paf, tf.float32) - targets['paf']))
+        return loss
+
+    def _compute_gradients(self, images, targets):
+        with tf.GradientTape() as tape:
+            loss = self._compute_loss(images, targets)
+            if isinstance(self.optimizer, tfk.mixed_precision.LossScaleOptimizer):
+                scaled_loss = self.optimizer.get_scaled_loss(loss)
+            else:
+                scaled_loss = loss
+        gradients = tape.gradient(scaled_loss, self.model.trainable_variables)
+        if isinstance(self.optimizer, tfk.mixed_precision.LossScaleOptimizer):
+            gradients = self.optimizer.get_unscaled_gradients(gradients)
+        return loss, gradients
+
+    @tf.function
+    def _train_step(self, images, targets):
+        loss, gradients = self._compute_gradients(images, targets)
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        return loss
+
+    @tf.function
+    def _accumulate_step(self, images, targets):
+        loss, gradients = self._compute_gradients(images, targets)
+        for accumulated, gradient in zip(self.accumulated_gradients, gradients):
+            accumulated.assign_add(gradient)
+        return loss
+
+    @tf.function
+    def _apply_accumulated(self):
+        gradients = [g / self.accumulation_steps for g in self.accumulated_gradients]
+        self.optimizer.apply_gradients(zip(gradients, self.model.trainable_variables))
+        for accumulated in self.accumulated_gradients:
+            accumulated.assign(tf.zeros_like(accumulated))
@@ -0,0 +1,185 @@
+from queue import Queue
+from threading import Thread
+
+import numpy as np
+import cv2
+
+from models import PoseRenderer
+
+
+class MapVisualizer:
+
+    """Renders heatmap and PAF channels as colorized tiles of one mosaic image.
+
+    All channels are normalized and tiled with array operations and colorized by a single applyColorMap call, so
+    rendering the 19 + 38 channels of an OpenPose output costs about as much as colorizing one image. Use like this:
+        visualizer = MapVisualizer()
+        paf, heatmap = model.predict(img[np.newaxis])
+        debug_img = visualizer.render(heatmap[0], paf[0])
+    """
+
+    def __init__(self, tile_size=(92, 92), n_cols=8, colormap=cv2.COLORMAP_JET, border=2):
+        """
+        :param tile_size: (height, width) of a single channel tile
+        :param n_cols: int - number of tiles per row
+        """
+
+        self.tile_h, self.tile_w = tile_size
+        self.n_cols = n_cols
+        self.colormap = colormap
+        self.border = border
+
+    def render(self, heatmap, paf):
+        """Returns heatmap tiles above PAF tiles as one BGR image."""
+
+        heatmap_tiles = self.render_heatmaps(heatmap)
+        paf_tiles = self.render_pafs(paf)
+        return np.concatenate([heatmap_tiles, paf_tiles], axis=0)
+
+    def render_heatmaps(self, heatmap):
+        """Colorizes every channel of a (h, w, c) heatmap, each scaled to its own [0, max]."""
+
+        maxima = heatmap.max(axis=(0, 1), keepdims=True)
+        normalized = heatmap / np.maximum(maxima, 1e-6)
+        return self._colorize(self._tile(np.clip(normalized, 0, 1)))
+
+    def render_pafs(self, paf):
+        """Colorizes every channel of a (h, w, c) PAF, zero maps to the middle of the color map."""
+
+        normalized = (np.clip(paf, -1, 1) + 1) / 2
+        return self._colorize(self._tile(normalized))
+
+    def _tile(self, maps):
+        """Resizes (h, w, c) maps to the tile size and arranges them row by row into one 2D mosaic."""
+
+        n_channels = maps.shape[2]
+        n_rows = int(np.ceil(n_channels / self.n_cols))
+
+        # cv2.resize handles at most 512 channels at once, OpenPose outputs have at most 57
+        resized = cv2.resize(maps.astype(np.float32), (self.tile_w, self.tile_h), interpolation=cv2.INTER_LINEAR)
+        resized = resized.reshape(self.tile_h, self.tile_w, n_channels)
+
+        b = self.border
+        tiles = np.zeros((self.tile_h + 2 * b, self.tile_w + 2 * b, n_rows * self.n_cols), dtype=np.float32)
+        tiles[b: b + self.tile_h, b: b + self.tile_w, :n_channels] = resized
+
+        # (tile_h, tile_w, rows * cols) -> (rows * tile_h, cols * tile_w)
+        tiles = tiles.reshape(tiles.shape[0], tiles.shape[1], n_rows, self.n_cols)
+        return tiles.transpose(2, 0, 3, 1).reshape(n_rows * tiles.shape[0], self.n_cols * tiles.shape[1])
+
+    def _colorize(self, mosaic):
+        return cv2.applyColorMap((mosaic * 255).astype(np.uint8), self.colormap)
+
+
+class StreamingVideoWriter:
+
+    """Encodes frames on a background thread as they are produced, without collecting them in memory.
+
+    write blocks only when more than max_queue frames are waiting for the encoder. An encoder error, e.g. a video
+    that cannot be opened, is raised by the next write and by close. Use like this:
+        with StreamingVideoWriter('out.mp4', fps=30) as writer:
+            for frame in frames:
+                writer.write(frame)
+    """
+
+    def __init__(self, output_path, fps, fourcc='mp4v', max_queue=32):
+        self.output_path = output_path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self.queue = Queue(maxsize=max_queue)
+        self.writer = None
+        self.n_frames = 0
+        self.error = None
+        self.thread = Thread(target=self._encode, daemon=True)
+        self.thread.start()
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+        self.n_frames += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _encode(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue  # keep draining, so write does not block
+            try:
+                if self.writer is None:
+                    h, w = frame.shape[:2]
+                    self.writer = cv2.VideoWriter(self.output_path, self.fourcc, self.fps, (w, h))
+                    if not self.writer.isOpened():
+                        raise IOError('Cannot open {} for writing.'.format(self.output_path))
+                self.writer.write(frame)
+            except Exception as e:
+                self.error = e
+        if self.writer is not None:
+            self.writer.release()
+
+
+class ComparisonVideo:
+
+    """Side by side video of a reference performance and a trainee, with the trainee's errors drawn.
+
+    Poses of the reference frames are the targets of FastOpenPose.compare_draw on the matching trainee frames. Use
+    like this:
+        ComparisonVideo(FastOpenPose(weights_path, config_path)).create('reference.mp4', 'trainee.mp4', 'out.mp4')
+    """
+
+    def __init__(self, pose, height=480):
+        """
+        :param pose: FastOpenPose
+        :param height: int - height of each half of the output video
+        """
+
+        self.pose = pose
+        self.height = height
+        self.renderer = PoseRenderer()
+
+    def create(self, reference_path, trainee_path, output_path, max_frames=None):
+        reference = cv2.VideoCapture(reference_path)
+        trainee = cv2.VideoCapture(trainee_path)
+        fps = trainee.get(cv2.CAP_PROP_FPS) or 30
+
+        n_frames = 0
+        with StreamingVideoWriter(output_path, fps) as writer:
+            while max_frames is None or n_frames < max_frames:
+                ok_ref, ref_frame = reference.read()
+                ok_tr, trainee_frame = trainee.read()
+                if not (ok_ref and ok_tr):
+                    break
+                writer.write(self.compose(ref_frame, trainee_frame))
+                n_frames += 1
+
+        reference.release()
+        trainee.release()
+        return n_frames
+
+    def compose(self, ref_frame, trainee_frame):
+        """Returns the side by side frame, the reference with its pose, the trainee with its errors."""
+
+        ref_kps = self.pose.predict_batch([ref_frame])[0]
+        if len(ref_kps):
+            target_kps = [None if np.isnan(kp[0]) else kp[:2].astype(int) for kp in ref_kps[0]]
+            ref_frame = self.renderer.draw_keypoints(ref_frame, ref_kps[:1])
+            trainee_frame = self.pose.compare_draw(trainee_frame, target_kps)
+
+        return np.concatenate([self._resize(ref_frame), self._resize(trainee_frame)], axis=1)
+
+    def _resize(self, frame):
+        h, w = frame.shape[:2]
+        return cv2.resize(frame, (int(round(w * self.height / h)), self.height))
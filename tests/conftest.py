@@ -0,0 +1,41 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the modules of src import each other by their flat names
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from benchmark import DEFAULT_CONFIG, SyntheticScene
+
+
+class SceneModel:
+
+    """Stands in for the model of a FastOpenPose and returns the maps of a synthetic scene for every input."""
+
+    def __init__(self, scene, max_peaks):
+        self.scene = scene
+        self.max_peaks = max_peaks
+
+    def predict(self, x, verbose=0):
+        peaks = self.scene.masked_heatmap if not self.max_peaks else self.scene.sparse_peaks(self.max_peaks)
+        return np.repeat(self.scene.paf[np.newaxis], len(x), axis=0), np.repeat(peaks, len(x), axis=0)
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = tmp_path / 'config'
+    path.write_text(DEFAULT_CONFIG)
+    return str(path)
+
+
+@pytest.fixture
+def scene_pose(config_path):
+    """FastOpenPose with random weights whose model outputs are those of a synthetic scene of one person."""
+
+    from models import FastOpenPose
+
+    pose = FastOpenPose(None, config_path)
+    pose.model = SceneModel(SyntheticScene(1, seed=1), pose.openpose_model.max_peaks)
+    return pose
@@ -0,0 +1,15 @@
+from benchmark import Benchmark, main
+
+
+def test_main_smoke(tmp_path):
+    output = str(tmp_path / 'bench.json')
+    assert main(['--no-model', '--people', '1', '--repeats', '2', '--output', output]) == 0
+    results = Benchmark.load(output)
+    assert set(results['results']['people_1']) == {'peaks', 'connections', 'subset', 'inverse_transform_kps',
+                                                    'generate_features', 'drawing'}
+    assert main(['--no-model', '--people', '1', '--repeats', '2', '--output', output, '--baseline', output,
+                 '--tolerance', '100']) == 0
+
+
+def test_parity():
+    assert Benchmark.parity(n_scenes=4) == []
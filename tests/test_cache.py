@@ -0,0 +1,21 @@
+import os
+
+import numpy as np
+
+from cache import ResultCache
+
+
+def test_disk_store_drops_least_recently_used(tmp_path):
+    value = {'array': np.zeros(1000)}
+    cache = ResultCache(cache_dir=str(tmp_path))
+    cache.put('a', value)
+    file_size = os.path.getsize(cache._path('a'))
+
+    cache = ResultCache(max_bytes=0, cache_dir=str(tmp_path), max_disk_bytes=2 * file_size)
+    assert cache.n_disk_bytes == file_size
+    cache.put('b', value)
+    assert cache._load('a') is not None  # a is now used more recently than b
+    cache.put('c', value)
+    assert sorted(name for name in os.listdir(str(tmp_path))) == ['a.npz', 'c.npz']
+    assert list(cache.disk_files) == ['a', 'c']
+    assert cache.n_disk_bytes == 2 * file_size
@@ -0,0 +1,18 @@
+from extract import Extractor
+
+
+def test_run_skips_done_and_unreadable_inputs(tmp_path):
+    inputs, output = tmp_path / 'inputs', tmp_path / 'poses'
+    inputs.mkdir()
+    output.mkdir()
+    for name in ('a.jpg', 'b.jpg', 'c.mp4'):
+        (inputs / name).write_bytes(b'')
+    a, b, c = Extractor.scan([str(inputs)])
+    (output / 'shard-000.done').write_text('{}\t0\t1\n{}\t1'.format(a, c))  # the last line was cut off
+    (output / 'shard-001.failed').write_text('{}\n'.format(b))
+
+    extractor = Extractor('weights.h5', 'config', str(output), n_workers=2)
+    assert extractor.done() == {a: (0, 0, 1)}
+    assert extractor.failed() == {b}
+    (output / 'shard-001.done').write_text('{}\t0\t5\n'.format(c))
+    assert extractor.run([str(inputs)]) == 0
@@ -0,0 +1,54 @@
+from threading import Thread
+
+import numpy as np
+
+from benchmark import SyntheticScene
+from models import OpenPose, PoseRenderer
+
+
+def _scene_result(n_people=2):
+    scene = SyntheticScene(n_people, seed=n_people)
+    all_peaks = OpenPose._get_peaks(scene.heatmap, 0.1)
+    connection_all, special_k = OpenPose._get_connections(scene.paf, all_peaks, 0.05, scene.h)
+    subset, candidate = OpenPose._get_subset(all_peaks, special_k, connection_all)
+    return all_peaks, subset, candidate
+
+
+def test_draw_inverse_transformed_parts():
+    all_peaks, subset, candidate = _scene_result()
+    assert len(subset) == 2
+    img = np.zeros((184, 184, 3), dtype=np.uint8)
+    out = OpenPose.draw_inverse_transformed_parts(img, all_peaks, subset, candidate)
+    assert out is img and img.any()
+
+
+def test_extract_keypoints():
+    _, subset, candidate = _scene_result()
+    kps = OpenPose._extract_keypoints(subset[0], candidate)
+    assert len(kps) == 18
+    assert all(kp is None or kp.dtype.kind == 'i' for kp in kps)
+
+
+def test_shared_renderer_per_thread():
+    renderers = list()
+    threads = [Thread(target=lambda: renderers.append(PoseRenderer.shared())) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert renderers[0] is not renderers[1]
+    assert PoseRenderer.shared() is PoseRenderer.shared()
+
+
+def test_connections_and_subset_keep_int32_ids():
+    scene = SyntheticScene(2, seed=2)
+    all_peaks = OpenPose._get_peaks(scene.heatmap, 0.1)
+    for get_connections, shape in ((OpenPose._get_connections, scene.h),
+                                   (OpenPose._get_connections_legacy, scene.heatmap.shape)):
+        connection_all, special_k = get_connections(scene.paf, all_peaks, 0.05, shape)
+        for limb_ids, limb_scores in connection_all:
+            assert limb_ids.dtype == np.int32 and limb_ids.shape[1] == 4
+            assert limb_scores.dtype == np.float32 and len(limb_scores) == len(limb_ids)
+    subset, candidate = OpenPose._get_subset(all_peaks, special_k, connection_all)
+    assert subset.dtype == np.int32 and subset.shape == (2, 19)
+    assert (subset[:, 18] == (subset[:, :18] >= 0).sum(axis=1)).all()
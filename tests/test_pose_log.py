@@ -0,0 +1,44 @@
+from types import SimpleNamespace
+import json
+
+import numpy as np
+
+from evaluate import Evaluator
+from pose_log import PoseLogReader, PoseLogWriter, to_mpii_jsonl
+
+
+def test_mpii_round_trip_with_partially_visible_head(tmp_path):
+    log_path, jsonl_path = str(tmp_path / 'poses.log'), str(tmp_path / 'poses.jsonl')
+    person = np.full((18, 3), np.nan, dtype=np.float32)
+    person[0] = 50, 40, 0.9  # nose
+    person[1] = 50, 60, 0.9  # neck
+    person[14] = 46, 36, 0.8  # right eye, the left eye and ear are not visible in profile
+    person[16] = 40, 38, 0.4  # right ear
+    with PoseLogWriter(log_path, dtype='float32') as log:
+        log.write(0, person[np.newaxis], timestamp=0.)
+    to_mpii_jsonl(log_path, jsonl_path)
+
+    with open(jsonl_path) as f:
+        record = json.loads(f.read())
+    assert record['joint_pos']['9'] == [43., 37.]  # head_top averages the eye and ear that were found
+    assert record['joint_pos']['8'] == [50., 50.]
+    assert record['is_visible']['9'] == 1 and record['joint_pos']['0'] == [-1., -1.]
+
+    evaluator = Evaluator(None, SimpleNamespace(test_ind=None, joints_path=jsonl_path, n_parts=16))
+    joints, annotated, head_sizes = evaluator.ground_truth['frame_000000.jpg']
+    assert annotated[0].tolist() == [False] * 7 + [True] * 3 + [False] * 6
+    assert np.allclose(joints[0, 9], [43, 37]) and head_sizes[0] > 0
+
+
+def test_append_keeps_the_first_n_records(tmp_path):
+    log_path = str(tmp_path / 'poses.log')
+    with PoseLogWriter(log_path, dtype='float32', chunk_size=2) as log:
+        for i in range(5):
+            log.write(i, np.full((i % 2 + 1, 18, 3), i, dtype=np.float32), timestamp=0.)
+    with PoseLogWriter(log_path, dtype='float32', chunk_size=2, append=True, n_records=3) as log:
+        assert log.n_records == 3
+        log.write(10, np.zeros((1, 18, 3), dtype=np.float32), timestamp=0.)
+    with PoseLogReader(log_path) as log:
+        assert log.frame_indices().tolist() == [0, 1, 2, 10]
+        assert log.chunk_frames == [0, 2]
+        assert log.find(10)[2].shape == (1, 18, 3)
@@ -0,0 +1,24 @@
+import numpy as np
+
+from streams import StreamScheduler
+
+
+class RecordingPose:
+
+    def __init__(self):
+        self.frames = list()
+
+    def predict_batch(self, frames):
+        self.frames.extend(frames)
+        return [np.zeros((0, 18, 3)) for _ in frames]
+
+
+def test_submit_does_not_keep_the_callers_buffer():
+    pose = RecordingPose()
+    buffer = np.zeros((4, 4, 3), dtype=np.uint8)
+    with StreamScheduler(pose, batch_size=1, deadline=10.) as scheduler:
+        scheduler.add_stream('cam')
+        scheduler.submit('cam', buffer)
+        buffer[:] = 255  # the next capture into the same buffer
+    assert len(pose.frames) == 1
+    assert pose.frames[0] is not buffer and not pose.frames[0].any()
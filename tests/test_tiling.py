@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from benchmark import SyntheticScene
+from settings import Settings
+from tiling import TiledOpenPose
+
+
+class TileModel:
+
+    """Stands in for the model of an OpenPose and returns the stride sized maps of a synthetic scene for every tile."""
+
+    def __init__(self, scene):
+        self.scene = scene
+
+    def predict(self, x):
+        return (np.repeat(self.scene.paf[np.newaxis], len(x), axis=0),
+                np.repeat(self.scene.heatmap[np.newaxis], len(x), axis=0))
+
+
+def _tiled_pose(config_path, scene):
+    settings = Settings.load(config_path)
+    pose = SimpleNamespace(settings=settings, model=TileModel(scene), dtype=settings.dtype, legacy_peaks=False,
+                           legacy_connections=False, subpixel=None, max_peaks=None)
+    return TiledOpenPose(pose, tile_size=736, overlap=96)
+
+
+def test_single_tile_keypoints_and_drawing(config_path):
+    scene = SyntheticScene(1, shape=(92, 92), sigma=1.5, seed=1)
+    tiled = _tiled_pose(config_path, scene)
+    img = np.zeros((736, 736, 3), dtype=np.uint8)
+
+    keypoints = tiled.get_keypoints(img)
+    assert keypoints.shape == (1, 18, 3)
+    found = ~np.isnan(keypoints[0, :, 0])
+    assert found.sum() >= 16
+    assert np.allclose(keypoints[0, found, :2], scene.keypoints[0, found] * 8, atol=8)
+
+    out = tiled.draw_pose(img)
+    assert out is img and img.any()
@@ -0,0 +1,26 @@
+import cv2
+import numpy as np
+
+from visualize import ComparisonVideo
+
+
+def test_compose_draws_both_halves(scene_pose):
+    frame = np.full((184, 184, 3), 128, dtype=np.uint8)
+    composed = ComparisonVideo(scene_pose, height=92).compose(frame.copy(), frame.copy())
+    assert composed.shape == (92, 184, 3)
+    assert (composed[:, :92] != 128).any() and (composed[:, 92:] != 128).any()
+
+
+def test_create_writes_all_frames(scene_pose, tmp_path):
+    paths = [str(tmp_path / name) for name in ('reference.avi', 'trainee.avi')]
+    for path in paths:
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 10, (184, 184))
+        for _ in range(2):
+            writer.write(np.full((184, 184, 3), 128, dtype=np.uint8))
+        writer.release()
+    output_path = str(tmp_path / 'comparison.avi')
+    assert ComparisonVideo(scene_pose, height=92).create(*paths, output_path) == 2
+    capture = cv2.VideoCapture(output_path)
+    ok, frame = capture.read()
+    capture.release()
+    assert ok and frame.shape == (92, 184, 3)